@@ -11,14 +11,11 @@ import os
 from contextlib import contextmanager
 import glob
 import json
-import logging
-import logging.handlers
 
 from invoke import task
-from envbash import load_envbash
 from fabric import Config, Connection
 from jinja2 import Template
-from tempd.agent import Main
+from tempd.__main__ import main as launch
 
 _script_dir = os.path.dirname(__file__)
 _file_encoding = 'utf-8'
@@ -62,6 +59,22 @@ def release(c):
         with print_title("Running pylint linter"):
             c.run('pylint tasks.py tempd')
 
+@task
+def benchmark(c, cycles=10000, memory_cycles=1000000, latency=0.05, error_rate=0.0):
+    """
+    Run the benchmarks of the agent on this host, printing the results as JSON.
+    Run it on each board to compare their capacity, e.g. on the agent root of
+    a deployed agent. See `python -m tempd.benchmark --help` for more options
+
+    Example:
+        inv benchmark --memory-cycles=100000 --error-rate=0.1
+    """
+    with c.cd(_script_dir):
+        with print_title("Running benchmarks"):
+            c.run(f"python -m tempd.benchmark --cycles={cycles} "
+                  f"--memory-cycles={memory_cycles} --latency={latency} "
+                  f"--error-rate={error_rate}")
+
 @task
 def package(c):
     """
@@ -148,7 +161,8 @@ def deploy(c, conf):
     def setup_systemd():
         """https://www.raspberrypi.org/documentation/linux/usage/systemd.md"""
         service_name=config['deploy']['service_name']
-        launch_cmd=f"/bin/bash -c 'source {_activate_virtualenv} && inv launch-agent --conf={conf}'"
+        launch_cmd=f"/bin/bash -c 'source {_activate_virtualenv} && " \
+            f"exec python -m tempd --conf={conf}'"
         service_file_contents = _service_file_template.render(
             service_name=service_name,
             launch_cmd=launch_cmd,
@@ -212,54 +226,14 @@ def systemctl_agent(c, command, conf): # pylint: disable=unused-argument
     service_name = get_service_name(config)
     return rc.sudo(f"systemctl {command} {service_name}")
 
-def setup_logging(c, config, agent_root=None):
-    """
-    Setup logging
-
-    Params:
-    - config: a configuration dictionary
-    - agent_root: path for the root directory or None.
-    If not None logs will be stored in a "log" subdirectory
-    of `agent_root`
-    """
-    loggging_conf = config['logging']
-    logger = logging.getLogger()
-    logger.setLevel(loggging_conf['level'])
-    formatter = \
-        logging.Formatter('%(asctime)s [%(levelname)s] - [%(process)d] - %(name)s: %(message)s')
-    def setup_handler(handler):
-        handler.setFormatter(formatter)
-        handler.setLevel(loggging_conf['level'])
-        logger.addHandler(handler)
-    stdoutHandler = logging.StreamHandler()
-    setup_handler(stdoutHandler)
-    if agent_root is not None:
-        logging_root = os.path.join(agent_root, 'log')
-        c.run(f"mkdir -p {logging_root}")
-        service_name=config['deploy']['service_name']
-        log_filename = os.path.join(logging_root, f"{service_name}.log")
-        rotating_handler = logging.handlers.TimedRotatingFileHandler(
-            log_filename,
-            when=loggging_conf['rotationIntervalUnit'],
-            interval=loggging_conf['rotationInterval'],
-            backupCount=loggging_conf['maxLogFiles']
-        )
-        setup_handler(rotating_handler)
-
 @task
 def launch_agent(c, conf): # pylint: disable=unused-argument
     """Launch agent and block while it measures. Use Control+C to stop
-    the program
+    the program. This is the same as `python -m tempd --conf=<conf>`, that
+    starts faster as it doesn't import the tools for these tasks
 
     Example:
         inv launch-agent --conf=conf/dev.json
         inv launch-agent --conf=conf/prod.json
     """
-    config = read_conf(conf)
-    conf_root = os.path.dirname(conf)
-    agent_root = os.path.dirname(conf_root)
-    aws_credentials_file = os.path.join(conf_root, config['aws']['credentials_filename'])
-    load_envbash(aws_credentials_file)
-
-    setup_logging(c, config, agent_root)
-    Main(config).run()
+    launch([f"--conf={conf}"])
@@ -0,0 +1,92 @@
+"""
+Runtime entry point of the agent, launched with `python -m tempd --conf=<path>`
+
+Unlike `inv launch-agent`, this doesn't import the deployment tools of
+`tasks.py`, and the agent only imports the sensor drivers and the clients
+of the sinks enabled in the configuration, so it starts measuring sooner
+and with less memory, e.g. when systemd restarts it after a crash
+"""
+
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import shlex
+from typing import Optional, Sequence
+
+from .agent import Main
+
+_FILE_ENCODING = 'utf-8'
+
+def read_conf(path: str) -> dict:
+    """Read a configuration file"""
+    with open(path, 'r', encoding=_FILE_ENCODING) as in_f:
+        config: dict = json.load(in_f)
+        return config
+
+def load_credentials(path: str):
+    """Set the environment variables assigned in a shell file like
+    `conf/aws_credentials.template.sh`, with a `NAME=value` assignment
+    per line, optionally exported and quoted, without running a shell.
+    Variables already in the environment, e.g. set by systemd, are kept"""
+    with open(path, 'r', encoding=_FILE_ENCODING) as in_f:
+        for line in in_f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            if line.startswith('export '):
+                line = line[len('export '):]
+            name, _, value = line.partition('=')
+            values = shlex.split(value, comments=True)
+            os.environ.setdefault(name.strip(), values[0] if len(values) > 0 else '')
+
+def setup_logging(config: dict, agent_root: Optional[str] = None):
+    """
+    Setup logging
+
+    Params:
+    - config: a configuration dictionary
+    - agent_root: path for the root directory or None.
+    If not None logs will be stored in a "log" subdirectory
+    of `agent_root`
+    """
+    logging_conf = config['logging']
+    logger = logging.getLogger()
+    logger.setLevel(logging_conf['level'])
+    formatter = \
+        logging.Formatter('%(asctime)s [%(levelname)s] - [%(process)d] - %(name)s: %(message)s')
+    def setup_handler(handler: logging.Handler):
+        handler.setFormatter(formatter)
+        handler.setLevel(logging_conf['level'])
+        logger.addHandler(handler)
+    setup_handler(logging.StreamHandler())
+    if agent_root is not None:
+        logging_root = os.path.join(agent_root, 'log')
+        os.makedirs(logging_root, exist_ok=True)
+        service_name = config['deploy']['service_name']
+        setup_handler(logging.handlers.TimedRotatingFileHandler(
+            os.path.join(logging_root, f"{service_name}.log"),
+            when=logging_conf['rotationIntervalUnit'],
+            interval=logging_conf['rotationInterval'],
+            backupCount=logging_conf['maxLogFiles']
+        ))
+
+def main(args: Optional[Sequence[str]] = None):
+    """Launch the agent and block while it measures. The root of the agent is
+    the parent of the directory of the configuration file"""
+    parser = argparse.ArgumentParser(prog='python -m tempd',
+                                     description='Temperature metrics agent')
+    parser.add_argument('--conf', required=True, help='path of the configuration file')
+    options = parser.parse_args(args)
+    config = read_conf(options.conf)
+    conf_root = os.path.dirname(options.conf)
+    agent_root = os.path.dirname(conf_root)
+    aws_conf = config.get('aws')
+    if aws_conf is not None:
+        load_credentials(os.path.join(conf_root, aws_conf['credentials_filename']))
+    setup_logging(config, agent_root)
+    Main(config, agent_root).run()
+
+if __name__ == '__main__':
+    main()
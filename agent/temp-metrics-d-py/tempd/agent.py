@@ -1,79 +1,160 @@
 """
 Temperature metrics agent
 """
+# pylint: disable=too-many-lines
 
-import time
 import math
 import signal
 import logging
 import os
 import json
 import threading
-from dataclasses import dataclass, replace
-from collections.abc import Iterable
-from typing import Callable, Optional
-from typing_extensions import Protocol
-import boto3
-from prometheus_client import Gauge, start_http_server
+import time
+import queue
+import heapq
+import ipaddress
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from prometheus_client import Counter, Gauge, Histogram, Summary
 
+from .types import TempMeasurement, MeasurementFilter, MeasurementRecorder, Timer, TimeTimer
+from .types import RetryPolicy, StatisticSet, StatisticsRecorder, TempStatistics
+from .aggregation import AggregatingMeasurementRecorder, aggregate, window_start
+from .sampling import AdaptiveSampling
 from .sensors.types import TempSensor
-from .sensors import dht11, sht31
+from .sensors import locked
 
-@dataclass
-class TempMeasurement:
-    """A temperature measurement
+if TYPE_CHECKING:
+    # The sensor drivers, the clients of the sinks, and the optional
+    # subsystems are only imported when the configuration uses them, to
+    # start faster and use less memory
+    import boto3
+    from . import cloudwatch
+    from .gateway import GatewayMeasurementRecorder
+    from .history import MeasurementHistory
+    from .profiling import Profiler
+    from .remote_write import RemoteWriteMeasurementRecorder
+    from .sensors import sht31, synthetic
+    from .spool import Spool, SpoolDrainer
+    from .storage import MeasurementStorage
+    from .throttling import AdaptiveRateLimiter
 
-    Args:
-        timestamp (int): timestamp as a unix epoch time
-    """
-    source: str
-    timestamp: int
-    temperature: float
-    humidity: float
-
-class MeasurementRecorder(Protocol): # pylint: disable=too-few-public-methods
-    """A measurement recorder is able to record measurements in some
-    permanent storage"""
-    def record(self, measurement: TempMeasurement):
-        """Records a measurement in some permanent storage"""
+_timer = TimeTimer()
+_schedule_lag: Histogram = Histogram("tempd_schedule_lag_seconds",
+    "delay between the deadline of a daemon action and the start of its execution")
+_cycle_duration: Histogram = Histogram("tempd_cycle_seconds",
+    "time to measure, filter and record a measurement", labelnames=['source'])
+_startup_seconds: Gauge = Gauge("tempd_startup_seconds",
+    "time from the start of the process to its first measurement")
+_startup_memory: Gauge = Gauge("tempd_startup_resident_memory_bytes",
+    "resident memory of the process when it took its first measurement")
+_cloudwatch_rate: Gauge = Gauge("tempd_cloudwatch_allowed_calls_per_second",
+    "put_metric_data calls per second allowed by the adaptive rate limiter")
+_cloudwatch_backpressure: Gauge = Gauge("tempd_cloudwatch_backpressure",
+    "fraction of the buffer of metrics for CloudWatch in use")
+_cloudwatch_deferred_flushes: Counter = Counter("tempd_cloudwatch_deferred_flushes",
+    "flushes of the metrics for CloudWatch deferred by the rate limiter")
+_cloudwatch_compactions: Counter = Counter("tempd_cloudwatch_compactions",
+    "compactions of the buffered metrics for CloudWatch into statistic sets")
+_import_time = time.time()
 
-class Timer(Protocol):
-    """A timer.
-    This makes the code more testeable, because even if
-    we patch the time module, we don't know how other third modules
-    might be using the time module"""
-    def sleep(self, sleep_time:float):
-        """Block this thread for a number of milliseconds"""
+def process_start_time() -> float:
+    """Epoch time when this process started, or when this module was
+    imported if that is not available"""
+    try:
+        with open('/proc/self/stat', 'rb') as stat:
+            # The process name might have spaces, so split after it
+            fields = stat.read().rsplit(b')', 1)[1].split()
+        with open('/proc/stat', 'rb') as system_stat:
+            boot_time = next(float(line.split()[1]) for line in system_stat
+                             if line.startswith(b'btime'))
+        return boot_time + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, StopIteration):
+        return _import_time
 
-    def time(self) -> float:
-        """Give the current epoch time in milliseconds"""
+def resident_memory() -> int:
+    """Resident set size of the process in bytes, or the maximum resident
+    set size if the current one is not available"""
+    try:
+        with open('/proc/self/statm', 'r', encoding='utf-8') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource # pylint: disable=import-outside-toplevel
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
-class TimeTimer(Timer):
-    """Timer based on time module"""
-    def sleep(self, sleep_time):
-        time.sleep(sleep_time)
+def _record_startup():
+    startup_seconds = time.time() - process_start_time()
+    memory = resident_memory()
+    _startup_seconds.set(startup_seconds)
+    _startup_memory.set(memory)
+    logging.info('First measurement %.3f seconds after starting, with %d bytes of resident memory',
+                 startup_seconds, memory)
 
-    def time(self):
-        return time.time()
+class Schedule:
+    """The deadlines of an action that runs each `seconds` seconds.
 
-_timer = TimeTimer()
+    If `align_to` is not None the deadlines are aligned to multiples of that
+    number of seconds of the epoch time, e.g. use 60 to run the action on
+    the minute"""
+    def __init__(self, seconds: float, align_to: Optional[float] = None):
+        self.seconds = seconds
+        self.align_to = align_to
+
+    def first_deadline(self, current_time: float) -> float:
+        """The first deadline at or after `current_time`"""
+        if self.align_to is None:
+            return current_time
+        return math.ceil(current_time / self.align_to) * self.align_to
+
+    def next_deadline(self, deadline: float, current_time: float) -> Tuple[float, int]:
+        """The deadline following `deadline`, skipping the deadlines that were
+        missed by more than a period at `current_time`, and the number of
+        skipped deadlines"""
+        next_deadline = deadline + self.seconds
+        missed_deadlines = max(math.floor((current_time - next_deadline) / self.seconds), 0)
+        return next_deadline + missed_deadlines * self.seconds, missed_deadlines
 
-class ThreadDaemon:
+def run_on_stop(on_stop: Optional[Callable[[], None]], logger: logging.Logger):
+    """Run the stop action of a daemon, if any, logging any exception"""
+    if on_stop is None:
+        return
+    try:
+        on_stop()
+    except Exception as exception: # pylint: disable=broad-except
+        logger.error('Exception executing stop action: %s', exception)
+
+class ThreadDaemon: # pylint: disable=too-many-instance-attributes
     """
     A deamon that runs an action on a scheduled periodicity,
     running on its own thread
+
+    The action runs on fixed deadlines, so the period doesn't drift
+    with the time spent running the action. If `align_to` is not None the
+    deadlines are aligned to multiples of that number of seconds of the
+    epoch time, e.g. use 60 to run the action on the minute. When the
+    action runs for longer than the period the missed deadlines are
+    skipped, and counted in `missed_deadlines`
     """
 
     logger = logging.getLogger('ThreadDaemon')
 
-    def __init__(self, seconds: float,
+    def __init__(self, seconds: float, # pylint: disable=too-many-arguments
                        action: Callable[[], None],
-                       timer: Timer = _timer):
-        """Schedule the process to run each `seconds` seconds"""
-        self.__seconds = seconds
+                       timer: Timer = _timer,
+                       on_stop: Optional[Callable[[], None]] = None,
+                       align_to: Optional[float] = None):
+        """Schedule the process to run each `seconds` seconds
+
+        If `on_stop` is not None, it is run on the daemon thread after
+        the daemon is stopped, e.g. to flush buffered measurements
+        """
+        self.__schedule = Schedule(seconds, align_to)
         self.__action = action
         self.__timer = timer
-        self.__running = False
+        self.__on_stop = on_stop
+        self.__stopped = threading.Event()
+        self.__missed_deadlines = 0
         self.__thread: Optional[threading.Thread] = None
 
     @property
@@ -82,8 +163,23 @@ class ThreadDaemon:
         return self.__thread.is_alive() if self.__thread is not None\
                else False
 
+    @property
+    def missed_deadlines(self) -> int:
+        """Number of times the action was not run on schedule because
+        the previous execution took too long"""
+        return self.__missed_deadlines
+
+    @property
+    def period(self) -> float:
+        """Seconds between runs of the action"""
+        return self.__schedule.seconds
+
+    @period.setter
+    def period(self, seconds: float):
+        """Change the period, e.g. from the action, starting
+        with the next deadline"""
+        self.__schedule.seconds = seconds
 
-    __polling_interval = 0.1
     def start(self, blocking:bool=False):
         """Launch the daemon
 
@@ -91,19 +187,26 @@ class ThreadDaemon:
         to join this deamon's thread
         """
         signal.signal(signal.SIGINT, lambda _signal, _stack: self.stop())
-        self.__running = True
+        self.__stopped.clear()
         def thread_function():
             self.__class__.logger.info("Starting deamon")
-            latest_exec_time = 0
-            while self.__running:
-                current_time = self.__timer.time()
-                if current_time - latest_exec_time > self.__seconds:
-                    try:
-                        self.__action()
-                    except Exception as exception: # pylint: disable=broad-except
-                        self.__class__.logger.error('Exception executing action: %s', exception)
-                    latest_exec_time = current_time
-                self.__timer.sleep(ThreadDaemon.__polling_interval)
+            deadline = self.__schedule.first_deadline(self.__timer.time())
+            while not self.__stopped.is_set():
+                wait_time = deadline - self.__timer.time()
+                if wait_time > 0:
+                    self.__timer.wait(self.__stopped, wait_time)
+                    continue
+                _schedule_lag.observe(-wait_time)
+                try:
+                    self.__action()
+                except Exception as exception: # pylint: disable=broad-except
+                    self.__class__.logger.error('Exception executing action: %s', exception)
+                deadline, missed_deadlines = \
+                    self.__schedule.next_deadline(deadline, self.__timer.time())
+                if missed_deadlines > 0:
+                    self.__class__.logger.warning('Missed %d deadlines', missed_deadlines)
+                    self.__missed_deadlines += missed_deadlines
+            run_on_stop(self.__on_stop, self.__class__.logger)
         self.__thread = threading.Thread(target=thread_function, daemon=True)
         self.__thread.start()
         if blocking:
@@ -113,7 +216,114 @@ class ThreadDaemon:
     def stop(self):
         """Stop the deamon"""
         self.__class__.logger.info("Stopping deamon")
-        self.__running = False
+        self.__stopped.set()
+
+    def wait_for_completion(self, timeout: float):
+        """Block waiting for the daemon to stop"""
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+class PoolDaemon: # pylint: disable=too-many-instance-attributes
+    """
+    A deamon that runs several actions, each with its own periodicity,
+    on a pool of `max_workers` threads, and a thread for scheduling
+
+    Each action runs on fixed deadlines like for ThreadDaemon. An action
+    doesn't run again until its previous execution completes, and its
+    deadlines missed meanwhile are skipped and counted in `missed_deadlines`
+    """
+
+    logger = logging.getLogger('PoolDaemon')
+
+    def __init__(self, actions: Sequence[Tuple[float, Callable[[], None]]], # pylint: disable=too-many-arguments
+                       max_workers: int = 2,
+                       timer: Timer = _timer,
+                       on_stop: Optional[Callable[[], None]] = None,
+                       align_to: Optional[float] = None):
+        """Schedule each action with its period in seconds"""
+        self.__schedules = [Schedule(seconds, align_to) for seconds, _action in actions]
+        self.__actions = [action for _seconds, action in actions]
+        self.__max_workers = max_workers
+        self.__timer = timer
+        self.__on_stop = on_stop
+        self.__stopped = threading.Event()
+        self.__missed_deadlines = 0
+        self.__thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        """Whether this deamon is running or not"""
+        return self.__thread.is_alive() if self.__thread is not None\
+               else False
+
+    @property
+    def missed_deadlines(self) -> int:
+        """Number of times an action was not run on schedule because
+        its previous execution took too long"""
+        return self.__missed_deadlines
+
+    def set_period(self, index: int, seconds: float):
+        """Change the period of an action, e.g. from the action. As the next
+        deadline of an action is set when it starts running, the new period
+        is used starting with the deadline after that"""
+        self.__schedules[index].seconds = seconds
+
+    def __run_action(self, index: int):
+        try:
+            self.__actions[index]()
+        except Exception as exception: # pylint: disable=broad-except
+            self.__class__.logger.error('Exception executing action %d: %s', index, exception)
+
+    def __schedule_actions(self, executor: ThreadPoolExecutor):
+        current_time = self.__timer.time()
+        deadlines = [(schedule.first_deadline(current_time), index)
+                     for index, schedule in enumerate(self.__schedules)]
+        heapq.heapify(deadlines)
+        executions: List[Optional[Future]] = [None] * len(self.__actions)
+        while not self.__stopped.is_set():
+            deadline, index = deadlines[0]
+            wait_time = deadline - self.__timer.time()
+            if wait_time > 0:
+                self.__timer.wait(self.__stopped, wait_time)
+                continue
+            execution = executions[index]
+            if execution is None or execution.done():
+                _schedule_lag.observe(-wait_time)
+                executions[index] = executor.submit(self.__run_action, index)
+                missed_deadlines = 0
+            else:
+                missed_deadlines = 1
+            next_deadline, skipped_deadlines = \
+                self.__schedules[index].next_deadline(deadline, self.__timer.time())
+            missed_deadlines += skipped_deadlines
+            if missed_deadlines > 0:
+                self.__class__.logger.warning('Missed %d deadlines for action %d',
+                    missed_deadlines, index)
+                self.__missed_deadlines += missed_deadlines
+            heapq.heapreplace(deadlines, (next_deadline, index))
+
+    def start(self, blocking:bool=False):
+        """Launch the daemon
+
+        If blocking is true the current thread blocks
+        to join this deamon's thread
+        """
+        signal.signal(signal.SIGINT, lambda _signal, _stack: self.stop())
+        self.__stopped.clear()
+        def thread_function():
+            self.__class__.logger.info("Starting deamon")
+            with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+                self.__schedule_actions(executor)
+            run_on_stop(self.__on_stop, self.__class__.logger)
+        self.__thread = threading.Thread(target=thread_function, daemon=True)
+        self.__thread.start()
+        if blocking:
+            self.__thread.join()
+
+    def stop(self):
+        """Stop the deamon, after waiting for the running actions"""
+        self.__class__.logger.info("Stopping deamon")
+        self.__stopped.set()
 
     def wait_for_completion(self, timeout: float):
         """Block waiting for the daemon to stop"""
@@ -123,18 +333,32 @@ class ThreadDaemon:
 
 @dataclass
 class TempMeterConfig:
-    """The configuration of a TempMeter"""
+    """The configuration of a TempMeter. If `sensor` is None the
+    meter uses a DHT11 sensor on port 7"""
     retry_sleep_time: float = 0.05
-    sensor: TempSensor = dht11.Sensor(7, 0)
+    sensor: Optional[TempSensor] = None
     timer: Timer = _timer
+    sampling: Optional[AdaptiveSampling] = None
 
 class TempMeter: # pylint: disable=too-few-public-methods
     """A temperature meter is able to get temperature measurements
 
     Only valid measurements are returned, e.g. by discarding NaN
     returned by the driver and retry until a valid measurement is
-    obtained"""
+    obtained.
+
+    If the configuration has an AdaptiveSampling, each measurement updates
+    the period until the next measurement.
 
+    The time to get each measurement and the NaN readings retried for each
+    measurement are observed in Prometheus histograms labeled by source"""
+
+    _label_names = ['source']
+    read_latency: Histogram = Histogram("tempd_sensor_read_seconds",
+        "time to get a valid measurement from a sensor", labelnames=_label_names)
+    nan_retries: Histogram = Histogram("tempd_sensor_nan_retries",
+        "NaN readings retried to get each measurement from a sensor",
+        labelnames=_label_names, buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
     logger = logging.getLogger('TempMeter')
 
     def __init__(self, source_name: str,
@@ -142,49 +366,108 @@ class TempMeter: # pylint: disable=too-few-public-methods
         self.__source_name = source_name
         self.__retry_sleep_time = config.retry_sleep_time
         self.__timer = config.timer
-        self.__sensor = config.sensor
+        self.__sensor = config.sensor if config.sensor is not None \
+            else Main.create_sensor({'sensor_type': 'dht11'})
+        self.__sampling = config.sampling
+        self.__read_latency = self.__class__.read_latency.labels(source_name)
+        self.__nan_retries = self.__class__.nan_retries.labels(source_name)
+
+    @property
+    def source_name(self) -> str:
+        """Source of the measurements"""
+        return self.__source_name
+
+    @property
+    def period(self) -> Optional[float]:
+        """Seconds until the next measurement for adaptive sampling, or
+        None if the period is fixed"""
+        return self.__sampling.period if self.__sampling is not None else None
 
     def __get_current_timestamp(self):
         return math.floor(self.__timer.time())
 
     def measure(self) -> TempMeasurement:
         """Get a measurement from the sensor"""
-        (temperature, humidity) = self.__sensor.measure()
-        while math.isnan(temperature) or math.isnan(humidity):
-            self.__class__.logger.debug("Retrying measurement")
-            self.__timer.sleep(self.__retry_sleep_time)
+        retries = 0
+        with self.__read_latency.time():
             (temperature, humidity) = self.__sensor.measure()
+            while math.isnan(temperature) or math.isnan(humidity):
+                self.__class__.logger.debug("Retrying measurement")
+                retries += 1
+                self.__timer.sleep(self.__retry_sleep_time)
+                (temperature, humidity) = self.__sensor.measure()
+        self.__nan_retries.observe(retries)
         measurement = TempMeasurement(self.__source_name,
                                self.__get_current_timestamp(),
                                temperature, humidity)
         self.__class__.logger.info('Measured %s', measurement)
+        if self.__sampling is not None:
+            self.__sampling.update(measurement)
         return measurement
 
 class PrometheusMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-few-public-methods
     """A MeasurementRecorder that exposes the measurements as Prometheus metrics, thus
     turning this process into a Prometheus target.
+
+    If `summaries` is true each measurement is also observed in a summary,
+    so the number and the sum of the measurements between scrapes are
+    available too, e.g. to compute averages when measuring more often
+    than scraping
     """
     _label_names = ['source']
     temperature: Gauge = Gauge("tempd_temperature", "room temperature in Celsius",
         labelnames=_label_names)
     humidity: Gauge = Gauge("tempd_humidity", "room humidity percentage",
         labelnames=_label_names)
+    temperature_samples: Summary = Summary("tempd_temperature_samples",
+        "room temperature measurements in Celsius", labelnames=_label_names)
+    humidity_samples: Summary = Summary("tempd_humidity_samples",
+        "room humidity percentage measurements", labelnames=_label_names)
     logger = logging.getLogger('PrometheusMeasurementRecorder')
 
+    def __init__(self, summaries: bool = False):
+        self.__summaries = summaries
+
     def record(self, measurement: TempMeasurement):
         # Ignoring timestamp as that is the prometheus way
         temperature, humidity = measurement.temperature, measurement.humidity
         source = measurement.source
         self.__class__.temperature.labels(source).set(temperature)
         self.__class__.humidity.labels(source).set(humidity)
+        if self.__summaries:
+            self.__class__.temperature_samples.labels(source).observe(temperature)
+            self.__class__.humidity_samples.labels(source).observe(humidity)
         self.__class__.logger.info('Measurement recorded in Prometheus client %s',
             f"{{Temperature: {temperature}, Humidity: {humidity}, Source: {source}}}")
 
 
-class CloudwatchMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-few-public-methods
+class CloudwatchMeasurementRecorder(StatisticsRecorder): # pylint: disable=too-many-instance-attributes
     """A MeasurementRecorder that stores the measurements
     as AWS Cloudwatch metrics. 2 metrics are emitted per
-    measurement, one for temperature and one for humidity
+    measurement, one for temperature and one for humidity.
+    Statistics are stored as CloudWatch statistic sets in the same metrics
+
+    Metrics are buffered in memory and sent with a single `put_metric_data`
+    call per `max_metric_data_per_call` metrics, when either `batch_size`
+    measurements or statistics are buffered or the oldest buffered measurement is older
+    than `max_batch_age` seconds. Note the age is only checked when a new
+    measurement is recorded, so it is rounded up to the recording period.
+    If `put_metric_data` fails then the metrics are kept in the buffer to
+    be retried on the next flush, up to `max_buffered_metric_data` metrics.
+    Beyond that the buffered metrics of each metric and source are merged into
+    statistic sets per window of each of the `compaction_windows` seconds, until
+    the buffer is down to half of its size, and only then the oldest metrics
+    are discarded, so the buffer is compacted at most once per
+    `max_buffered_metric_data / 2` metrics.
+
+    With a `rate_limiter` a flush only calls `put_metric_data` while the limiter
+    allows it, and otherwise the metrics stay in the buffer, so the calls send
+    larger batches instead of waiting on the recording thread. `flush` and the
+    `publish` methods wait up to `max_flush_wait` seconds for the limiter. The
+    `backpressure` is the fraction of the buffer in use.
+
+    `session` is either a boto3 session, or a tempd.cloudwatch.Session
+    that doesn't need boto3.
 
     Attributes:
 
@@ -194,55 +477,393 @@ class CloudwatchMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-
       for temperature metrics
     - humidity_metric_name: name of the cloudwatch metrics used to
       for humidity metrics
+    - max_metric_data_per_call: maximum number of metrics accepted by
+      put_metric_data, see https://docs.aws.amazon.com/AmazonCloudWatch/latest/APIReference/API_PutMetricData.html # pylint: disable=line-too-long
     """
     source_dimension = 'source'
     temperature_metric_name = 'temperature'
     humidity_metric_name = 'humidity'
+    max_metric_data_per_call = 1000
+    max_buffered_metric_data = 10 * max_metric_data_per_call
+    compaction_windows = (60, 300, 3600)
+    max_flush_wait = 10.0
     logger = logging.getLogger('CloudwatchMeasurementRecorder')
 
-    def __init__(self, session: "boto3.session.Session",
+    def __init__(self, # pylint: disable=too-many-arguments
+                 session: Union["boto3.session.Session", "cloudwatch.Session"],
                  namespace:str='temp_agent',
                  # Union[Literal[1], Literal[60]] would be better,
                  # but it's only available in Python 3.8+
-                 storage_resolution:int=60):
+                 storage_resolution:int=60,
+                 *,
+                 batch_size:int=1,
+                 max_batch_age:Optional[float]=None,
+                 rate_limiter: Optional['AdaptiveRateLimiter'] = None,
+                 timer: Timer = _timer):
         """
         These arguments match with parameters used put a
         metric into CloudWatch metrics, see https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/publishingMetrics.html#high-resolution-metrics # pylint: disable=line-too-long
         for more details.
+
+        The default `batch_size` of 1 sends each measurement as soon as
+        it is recorded, and a `max_batch_age` of None means the batches
+        never expire.
         """
         self.__metrics_namespace = namespace
         self.__storage_resolution = storage_resolution
+        self.__batch_size = batch_size
+        self.__max_batch_age = max_batch_age
+        self.__rate_limiter = rate_limiter
+        self.__timer = timer
         self.__cloudwatch = session.client('cloudwatch')
+        self.__buffer: List[dict] = []
+        self.__buffered_measurements = 0
+        self.__oldest_buffered_time = 0.0
 
-    def record(self, measurement: TempMeasurement):
-        def create_metric(metric_name, value):
-            return {
-                'MetricName': metric_name,
-                'Dimensions': [
-                    {
-                        'Name': self.__class__.source_dimension,
-                        'Value': measurement.source
-                    },
-                ],
-                'Timestamp': measurement.timestamp,
-                'Value': value,
-                'StorageResolution': self.__storage_resolution
+    def __create_metric(self, metric_name: str, source: str, timestamp: int,
+                        values: dict) -> dict:
+        return {
+            'MetricName': metric_name,
+            'Dimensions': [
+                {
+                    'Name': self.__class__.source_dimension,
+                    'Value': source
+                },
+            ],
+            'Timestamp': timestamp,
+            **values,
+            'StorageResolution': self.__storage_resolution
+        }
+
+    def __create_metric_data(self, measurement: TempMeasurement) -> List[dict]:
+        temp_metric = self.__create_metric(self.__class__.temperature_metric_name,
+            measurement.source, measurement.timestamp, {'Value': measurement.temperature})
+        humidity_metric = self.__create_metric(self.__class__.humidity_metric_name,
+            measurement.source, measurement.timestamp, {'Value': measurement.humidity})
+        return [temp_metric, humidity_metric]
+
+    @staticmethod
+    def __statistic_values(statistic_set: StatisticSet) -> dict:
+        return {
+            'StatisticValues': {
+                'SampleCount': float(statistic_set.count),
+                'Sum': statistic_set.sum,
+                'Minimum': statistic_set.minimum,
+                'Maximum': statistic_set.maximum
             }
+        }
+
+    def __create_statistics_metric_data(self, statistics: TempStatistics) -> List[dict]:
+        statistic_values = CloudwatchMeasurementRecorder.__statistic_values
+        temp_metric = self.__create_metric(self.__class__.temperature_metric_name,
+            statistics.source, statistics.timestamp, statistic_values(statistics.temperature))
+        humidity_metric = self.__create_metric(self.__class__.humidity_metric_name,
+            statistics.source, statistics.timestamp, statistic_values(statistics.humidity))
+        return [temp_metric, humidity_metric]
+
+    def __should_flush(self) -> bool:
+        if self.__buffered_measurements >= self.__batch_size:
+            return True
+        if self.__max_batch_age is None:
+            return False
+        return self.__timer.time() - self.__oldest_buffered_time >= self.__max_batch_age
+
+    def __buffer_metric_data(self, metric_data: List[dict]):
+        if len(self.__buffer) == 0:
+            self.__oldest_buffered_time = self.__timer.time()
+        self.__buffer.extend(metric_data)
+        self.__buffered_measurements += 1
+        if len(self.__buffer) > self.__class__.max_buffered_metric_data:
+            self.__compact(self.__class__.max_buffered_metric_data // 2)
+        if self.__should_flush():
+            self.__flush(block=False)
+        _cloudwatch_backpressure.set(self.backpressure)
 
-        temp_metric = create_metric(self.__class__.temperature_metric_name,
-                                    measurement.temperature)
-        humidity_metric = create_metric(self.__class__.humidity_metric_name,
-                                        measurement.humidity)
+    def __compact(self, size: int):
+        for window in self.__class__.compaction_windows:
+            if len(self.__buffer) <= size:
+                return
+            compacted: Dict[Tuple[str, str, int], StatisticSet] = {}
+            for metric in self.__buffer:
+                if 'Value' in metric:
+                    value = metric['Value']
+                    statistic_set = StatisticSet(value, value, value, 1)
+                else:
+                    values = metric['StatisticValues']
+                    statistic_set = StatisticSet(values['Minimum'], values['Maximum'],
+                                                 values['Sum'], int(values['SampleCount']))
+                key = (metric['MetricName'], metric['Dimensions'][0]['Value'],
+                       window_start(metric['Timestamp'], window))
+                if key in compacted:
+                    compacted[key].merge(statistic_set)
+                else:
+                    compacted[key] = statistic_set
+            self.__class__.logger.warning('Compacting %d buffered metrics into %d statistic '
+                'sets per %d seconds', len(self.__buffer), len(compacted), window)
+            _cloudwatch_compactions.inc()
+            statistic_values = CloudwatchMeasurementRecorder.__statistic_values
+            self.__buffer = [
+                self.__create_metric(metric_name, source, timestamp, statistic_values(statistics))
+                for (metric_name, source, timestamp), statistics in compacted.items()]
+        overflow = len(self.__buffer) - size
+        if overflow > 0:
+            self.__class__.logger.warning('Discarding %d buffered metrics', overflow)
+            del self.__buffer[:overflow]
+
+    @property
+    def backpressure(self) -> float:
+        """Fraction of the buffer in use, that grows while the metrics can't
+        be sent as fast as they are recorded"""
+        return min(len(self.__buffer) / self.__class__.max_buffered_metric_data, 1.0)
+
+    def record(self, measurement: TempMeasurement):
+        self.__buffer_metric_data(self.__create_metric_data(measurement))
+
+    def record_statistics(self, statistics: TempStatistics):
+        """Records the statistics as CloudWatch statistic sets, buffering them
+        like measurements"""
+        self.__buffer_metric_data(self.__create_statistics_metric_data(statistics))
+
+    def __put_metric_data(self, metric_data: List[dict]):
         put_metric_data_params = {
             'Namespace': self.__metrics_namespace,
-            'MetricData': [temp_metric, humidity_metric]
+            'MetricData': metric_data
         }
-        # This uses Boto's default retry strategy
+        # The clients retry failed calls, boto3 with its retry strategy
         # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/retries.html
-        self.__cloudwatch.put_metric_data(**put_metric_data_params)
-        self.__class__.logger.info('Measurement recorded in cloudwatch %s',
+        # and tempd.cloudwatch with a RetryPolicy, but for throttling errors
+        # when Main configures a rate limiter
+        rate_limiter = self.__rate_limiter
+        try:
+            self.__cloudwatch.put_metric_data(**put_metric_data_params)
+        except Exception as error:
+            if rate_limiter is not None:
+                from .cloudwatch import is_throttling # pylint: disable=import-outside-toplevel
+                if is_throttling(error):
+                    rate_limiter.on_throttling()
+                    _cloudwatch_rate.set(rate_limiter.rate)
+            raise
+        if rate_limiter is not None:
+            rate_limiter.on_success()
+            _cloudwatch_rate.set(rate_limiter.rate)
+        self.__class__.logger.info('%d metrics recorded in cloudwatch', len(metric_data))
+        self.__class__.logger.debug('Metrics recorded in cloudwatch %s',
             json.dumps(put_metric_data_params))
 
+    def __acquire(self, block: bool) -> bool:
+        rate_limiter = self.__rate_limiter
+        if rate_limiter is None:
+            return True
+        if block:
+            return rate_limiter.acquire(self.__class__.max_flush_wait)
+        return rate_limiter.try_acquire()
+
+    def __flush(self, block: bool):
+        max_metric_data = self.__class__.max_metric_data_per_call
+        while len(self.__buffer) > 0:
+            if not self.__acquire(block):
+                self.__class__.logger.info('Rate limited, keeping %d metrics buffered',
+                                           len(self.__buffer))
+                _cloudwatch_deferred_flushes.inc()
+                return
+            metric_data = self.__buffer[:max_metric_data]
+            self.__put_metric_data(metric_data)
+            del self.__buffer[:len(metric_data)]
+        self.__buffered_measurements = 0
+
+    def flush(self):
+        """Send all the buffered metrics to cloudwatch, using as few calls
+        to `put_metric_data` as possible"""
+        self.__flush(block=True)
+        _cloudwatch_backpressure.set(self.backpressure)
+
+    def __send(self, metric_data: List[dict]):
+        max_metric_data = self.__class__.max_metric_data_per_call
+        for start in range(0, len(metric_data), max_metric_data):
+            if not self.__acquire(block=True):
+                from .throttling import RateLimitExceeded # pylint: disable=import-outside-toplevel
+                raise RateLimitExceeded('Timeout waiting for the rate limiter')
+            self.__put_metric_data(metric_data[start:start + max_metric_data])
+
+    def publish(self, measurements: Sequence[TempMeasurement]):
+        """Send some measurements to cloudwatch right away, bypassing the
+        buffer, using as few calls to `put_metric_data` as possible.
+        Raises an exception if any call fails, in which case some of the
+        measurements might have been already sent"""
+        self.__send([metric for measurement in measurements
+                     for metric in self.__create_metric_data(measurement)])
+
+    def publish_statistics(self, statistics: Sequence[TempStatistics]):
+        """Like `publish`, for statistics"""
+        self.__send([metric for window_statistics in statistics
+                     for metric in self.__create_statistics_metric_data(window_statistics)])
+
+
+class AsyncMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """A MeasurementRecorder that records measurements with another recorder
+    on its own worker thread, so a slow or failing recorder doesn't delay
+    the measurements, nor the other recorders.
+
+    Measurements are passed to the worker through a queue of `queue_size`
+    elements. When the queue is full the `overflow_policy` decides what to do:
+
+    - 'drop_oldest': discard the oldest queued measurement to make room for
+      the new one. Pending flushes are never discarded
+    - 'drop_newest': discard the new measurement
+    - 'block': wait until the worker makes room in the queue
+
+    With a `backpressure` function, measurements are shed before they are
+    queued while the backpressure of the recorder, from 0 to 1, is at least
+    `shed_threshold`: only one in `1 / (1 - backpressure)` measurements of
+    each source is kept, up to one in `max_shed_stride`, so a recorder that
+    can't keep up degrades to a lower sampling rate instead of discarding
+    all the latest measurements.
+
+    The queue depth, the number of discarded and shed measurements, the time
+    spent recording each measurement, the number of failures recording or
+    flushing, and the number of flushes that timed out are exposed as
+    Prometheus metrics labeled by recorder
+    """
+    overflow_policies = ('drop_oldest', 'drop_newest', 'block')
+    max_shed_stride = 10
+    _label_names = ['recorder']
+    queue_depth: Gauge = Gauge("tempd_recorder_queue_depth",
+        "measurements waiting to be recorded", labelnames=_label_names)
+    dropped: Counter = Counter("tempd_recorder_dropped_measurements",
+        "measurements discarded because the recorder queue was full",
+        labelnames=_label_names)
+    record_latency: Histogram = Histogram("tempd_recorder_record_seconds",
+        "time spent recording a measurement", labelnames=_label_names)
+    failures: Counter = Counter("tempd_recorder_failures",
+        "exceptions recording or flushing measurements", labelnames=_label_names)
+    dropped_flushes: Counter = Counter("tempd_recorder_dropped_flushes",
+        "flushes that timed out waiting for the recorder", labelnames=_label_names)
+    shed: Counter = Counter("tempd_recorder_shed_measurements",
+        "measurements discarded because of the backpressure of the recorder",
+        labelnames=_label_names)
+    logger = logging.getLogger('AsyncMeasurementRecorder')
+
+    def __init__(self, recorder: MeasurementRecorder, # pylint: disable=too-many-arguments
+                 queue_size: int = 100,
+                 overflow_policy: str = 'drop_oldest',
+                 flush_timeout: float = 30.0,
+                 *,
+                 backpressure: Optional[Callable[[], float]] = None,
+                 shed_threshold: float = 0.5):
+        """
+        Params:
+        - recorder: recorder used on the worker thread
+        - flush_timeout: maximum time in seconds `flush` waits for the
+          queued measurements to be recorded
+        - backpressure: returns the backpressure of the recorder, or None
+          to never shed measurements
+        """
+        if overflow_policy not in self.__class__.overflow_policies:
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}'")
+        self.__recorder = recorder
+        self.__overflow_policy = overflow_policy
+        self.__flush_timeout = flush_timeout
+        self.__backpressure = backpressure
+        self.__shed_threshold = shed_threshold
+        self.__shed_counts: Dict[str, int] = {}
+        self.__name = type(recorder).__name__
+        self.__queue: "queue.Queue[object]" = queue.Queue(queue_size)
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__work, daemon=True,
+                                         name=f"{self.__name}-worker")
+        self.__thread.start()
+
+    def __work(self):
+        while True:
+            item = self.__queue.get()
+            self.__class__.queue_depth.labels(self.__name).set(self.__queue.qsize())
+            try:
+                if isinstance(item, threading.Event):
+                    self.__recorder.flush()
+                else:
+                    with self.__class__.record_latency.labels(self.__name).time():
+                        self.__recorder.record(item)
+            except Exception as exception: # pylint: disable=broad-except
+                self.__class__.logger.error('Exception recording with %s: %s',
+                    self.__name, exception)
+                self.__class__.failures.labels(self.__name).inc()
+            finally:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def __discard(self, measurement: object):
+        self.__class__.logger.warning('Discarding measurement %s for %s',
+                                      measurement, self.__name)
+        self.__class__.dropped.labels(self.__name).inc()
+
+    def __discard_oldest(self):
+        # Pending flushes are skipped, as discarding them would report the
+        # measurements queued before them as flushed
+        with self.__queue.mutex:
+            items = self.__queue.queue
+            oldest = next((index for index, item in enumerate(items)
+                           if not isinstance(item, threading.Event)), None)
+            if oldest is None:
+                return
+            measurement = items[oldest]
+            del items[oldest]
+        self.__discard(measurement)
+
+    def __enqueue(self, item: object, block: bool, timeout: Optional[float] = None):
+        if block:
+            self.__queue.put(item, timeout=timeout)
+        else:
+            with self.__lock:
+                try:
+                    self.__queue.put_nowait(item)
+                except queue.Full:
+                    if self.__overflow_policy == 'drop_newest':
+                        self.__discard(item)
+                    else:
+                        self.__discard_oldest()
+                        try:
+                            self.__queue.put_nowait(item)
+                        except queue.Full:
+                            # the queue only has pending flushes, or a flush
+                            # took the room
+                            self.__discard(item)
+        self.__class__.queue_depth.labels(self.__name).set(self.__queue.qsize())
+
+    def __shed(self, measurement: TempMeasurement) -> bool:
+        if self.__backpressure is None:
+            return False
+        backpressure = self.__backpressure()
+        if backpressure < self.__shed_threshold:
+            return False
+        stride = min(int(1 / max(1 - backpressure, 1 / self.__class__.max_shed_stride)),
+                     self.__class__.max_shed_stride)
+        with self.__lock:
+            count = self.__shed_counts.get(measurement.source, 0)
+            self.__shed_counts[measurement.source] = count + 1
+        if count % stride == 0:
+            return False
+        self.__class__.shed.labels(self.__name).inc()
+        return True
+
+    def record(self, measurement: TempMeasurement):
+        if self.__shed(measurement):
+            return
+        self.__enqueue(measurement, block=self.__overflow_policy == 'block')
+
+    def flush(self):
+        """Wait for the queued measurements to be recorded, and then
+        flush the wrapped recorder, for up to `flush_timeout` seconds in
+        total, so a stuck recorder doesn't block the shutdown"""
+        flushed = threading.Event()
+        deadline = time.monotonic() + self.__flush_timeout
+        try:
+            self.__enqueue(flushed, block=True, timeout=self.__flush_timeout)
+        except queue.Full:
+            pass
+        if not flushed.wait(max(deadline - time.monotonic(), 0)):
+            self.__class__.logger.warning('Timeout flushing %s', self.__name)
+            self.__class__.dropped_flushes.labels(self.__name).inc()
+
 class ConfigError(Exception):
     """Configuration error: some required configuration value is missing at runtime"""
 
@@ -251,19 +872,61 @@ class Main: # pylint: disable=too-few-public-methods
     """Analogous to a Guice module, this just builds
     a deamon that performs the measurement
     """
-    def __init__(self, config: dict):
+    # Configurations of the boto3 clients, that otherwise use the defaults of boto3
+    __boto3_client_keys = ('pool_size', 'connect_timeout_in_seconds', 'read_timeout_in_seconds',
+                           'tcp_keepalive', 'min_compression_size_in_bytes', 'throttling')
+
+    def __init__(self, config: dict, agent_root: Optional[str] = None):
         """
         Params:: dict[str, str]
         - config: a dictionary of keys corresponding to
           the JSON configuration documented in the readme
+        - agent_root: path for the root directory of the agent or None.
+          If not None the agent keeps its local state, like the spool,
+          in its "log" subdirectory
         """
         self.__config = config
+        self.__agent_root = agent_root
+        self.__history = self.create_history()
+        self.__storage = self.create_storage()
+        self.__profiler = self.create_profiler()
 
     @staticmethod
-    def __create_boto_session() -> "boto3.session.Session":
+    def __create_cloudwatch_session(cloudwatch_conf: dict) \
+        -> Union["boto3.session.Session", "cloudwatch.Session"]:
+        backend = Main.__get_choice(cloudwatch_conf, 'cloudwatch.backend', 'boto3',
+                                    ('boto3', 'slim'))
         if len(os.environ.get('AWS_ACCESS_KEY_ID', '')) > 0 \
             and len(os.environ.get('AWS_SECRET_ACCESS_KEY', '')) > 0:
-            return boto3.session.Session()
+            if backend == 'boto3' and \
+                all(key not in cloudwatch_conf for key in Main.__boto3_client_keys):
+                import boto3 # pylint: disable=import-outside-toplevel,redefined-outer-name
+                return boto3.session.Session()
+            from . import cloudwatch # pylint: disable=import-outside-toplevel,redefined-outer-name
+            min_compression_size = cloudwatch_conf.get('min_compression_size_in_bytes', 10240)
+            connection_policy = cloudwatch.ConnectionPolicy(
+                pool_size=int(cloudwatch_conf.get('pool_size', 1)),
+                connect_timeout=float(cloudwatch_conf.get('connect_timeout_in_seconds', 10)),
+                read_timeout=float(cloudwatch_conf.get('read_timeout_in_seconds', 30)),
+                tcp_keepalive=bool(cloudwatch_conf.get('tcp_keepalive', True)),
+                min_compression_size=(int(min_compression_size)
+                                      if min_compression_size is not None else None))
+            max_attempts = int(cloudwatch_conf.get('max_attempts', 3))
+            throttling = 'throttling' in cloudwatch_conf
+            if backend == 'slim':
+                # With a rate limiter the recorder backs off from throttling by
+                # batching more, instead of the client retrying on its thread
+                try:
+                    return cloudwatch.Session(retry_policy=RetryPolicy(
+                        max_attempts=max_attempts, retry_throttling=not throttling),
+                        connection_policy=connection_policy)
+                except ValueError as value_error:
+                    raise ConfigError(f"Invalid slim cloudwatch.backend: {value_error}") \
+                        from value_error
+            # boto3 retries all the errors, so the rate limiter only sees the
+            # throttling errors left after the standard retries
+            return cloudwatch.create_boto3_session(
+                connection_policy, max_attempts=max_attempts if throttling else None)
 
         # Useful for local devel, without polluting prod data
         logging.warning('Missing AWS credentials, using mock AWS clients for devel')
@@ -277,48 +940,524 @@ class Main: # pylint: disable=too-few-public-methods
         return session_mock
 
     def run(self):
-        """Application entry point"""
+        """Application entry point. Runs the gateway if it is configured,
+        and measures otherwise"""
+        if 'gateway_server' in self.__config:
+            self.run_gateway()
+            return
+        if self.__profiler is not None:
+            profiler = self.__profiler
+            signal.signal(signal.SIGUSR1, lambda _signal, _stack: profiler.request())
         self.__start_metrics_server()
         deamon = self.create_deamon()
         deamon.start(blocking=True)
 
-    def create_temp_meter(self) -> TempMeter:
-        """Factory for the TempMeter"""
-        temp_meter_config = TempMeterConfig()
-        measurement_conf = self.__config['measurement']
-        sensor_type = measurement_conf.get('sensor_type', 'dht11')
+    def run_gateway(self):
+        """Entry point of the gateway mode, that receives the measurements
+        pushed by the agents until interrupted, and records them with the
+        configured recorders"""
+        import asyncio # pylint: disable=import-outside-toplevel
+        from .gateway import Gateway # pylint: disable=import-outside-toplevel
+        gateway_conf = self.__config['gateway_server']
+        secret = self.__gateway_secret(gateway_conf)
+        allowed_networks = self.__gateway_allowed_networks(gateway_conf)
+        self.__start_metrics_server()
+        measurement_recorders, spool_drainer = self.create_measurement_recorders()
+        gateway = Gateway(measurement_recorders, self.create_filters(),
+            dedup_window=int(gateway_conf.get('dedup_window_in_seconds', 300)),
+            flush_interval=float(gateway_conf.get('flush_interval_in_seconds', 60)),
+            secret=secret, allowed_networks=allowed_networks)
+        try:
+            asyncio.run(gateway.serve(gateway_conf.get('address', '127.0.0.1'),
+                                      int(gateway_conf.get('port', 8100))))
+        except KeyboardInterrupt:
+            logging.info('Stopping gateway')
+        finally:
+            if spool_drainer is not None:
+                spool_drainer.stop()
+
+    @staticmethod
+    def create_sensor(sensor_conf: dict) -> TempSensor:
+        """Factory for a TempSensor, from the configuration of a sensor"""
+        sensor_type = sensor_conf.get('sensor_type', 'dht11')
         if sensor_type == 'dht11':
-            # captured by default conf
-            pass
-        elif sensor_type == 'sht31':
-            temp_meter_config = replace(temp_meter_config, sensor=sht31.Sensor())
-        else:
-            logging.warning('Unknown value for configuration measurement.sensor_type:  %s',
-                sensor_type)
-            msg = f"Unknown value for configuration measurement.sensor_type: '{sensor_type}'"
+            from .sensors import dht11 # pylint: disable=import-outside-toplevel
+            return dht11.Sensor(int(sensor_conf.get('port', 7)),
+                                int(sensor_conf.get('dht_type', 0)))
+        if sensor_type == 'sht31':
+            return Main.__create_sht31_sensor(sensor_conf)
+        if sensor_type == 'synthetic':
+            return Main.__create_synthetic_sensor(sensor_conf)
+        logging.warning('Unknown value for configuration measurement.sensor_type:  %s',
+            sensor_type)
+        msg = f"Unknown value for configuration measurement.sensor_type: '{sensor_type}'"
+        raise ConfigError(msg)
+
+    @staticmethod
+    def __get_choice(conf: dict, conf_path: str, default: object,
+                     choices: Sequence[object]) -> Any:
+        section, key = conf_path.rsplit('.', 1)
+        value = conf.get(key, default)
+        if value not in choices:
+            msg = f"Unknown value for configuration {section}.{key}: '{value}'"
             raise ConfigError(msg)
-        return TempMeter(measurement_conf['source_name'], config=temp_meter_config)
+        return value
+
+    @staticmethod
+    def __create_sht31_sensor(sensor_conf: dict) -> 'sht31.Sensor':
+        from .sensors import sht31 # pylint: disable=import-outside-toplevel,redefined-outer-name
+        address = sensor_conf.get('i2c_address', sht31.Sensor.DEFAULT_ADDRESS)
+        read_mode = Main.__get_choice(sensor_conf, 'measurement.read_mode', 'blocking',
+                                      ['blocking', 'deferred'])
+        repeatability = Main.__get_choice(sensor_conf, 'measurement.repeatability', 'high',
+                                          sht31.Sensor.REPEATABILITIES)
+        periodic_mps = sensor_conf.get('periodic_mps')
+        if periodic_mps is not None:
+            periodic_mps = Main.__get_choice({'periodic_mps': float(periodic_mps)},
+                'measurement.periodic_mps', None, sht31.Sensor.PERIODIC_MPS)
+        return sht31.Sensor(int(sensor_conf.get('i2c_bus', 1)), int(str(address), 0),
+            deferred=read_mode == 'deferred',
+            retry_budget=float(sensor_conf.get('retry_budget_in_seconds', 2.0)),
+            repeatability=repeatability,
+            periodic_mps=periodic_mps,
+            art=bool(sensor_conf.get('art', False)))
+
+    @staticmethod
+    def __create_synthetic_sensor(sensor_conf: dict) -> 'synthetic.Sensor':
+        from .sensors import synthetic # pylint: disable=import-outside-toplevel,redefined-outer-name
+        defaults = synthetic.SyntheticConfig()
+        def get(key: str, default: float) -> float:
+            return float(sensor_conf.get(key, default))
+        config = synthetic.SyntheticConfig(
+            mean_temperature=get('mean_temperature', defaults.mean_temperature),
+            temperature_amplitude=get('temperature_amplitude', defaults.temperature_amplitude),
+            temperature_noise=get('temperature_noise', defaults.temperature_noise),
+            mean_humidity=get('mean_humidity', defaults.mean_humidity),
+            humidity_amplitude=get('humidity_amplitude', defaults.humidity_amplitude),
+            humidity_noise=get('humidity_noise', defaults.humidity_noise),
+            peak_hour=get('peak_hour', defaults.peak_hour),
+            spike_rate=get('spike_rate', defaults.spike_rate),
+            spike_size=get('spike_size', defaults.spike_size),
+            nan_rate=get('nan_rate', defaults.nan_rate),
+            error_rate=get('error_rate', defaults.error_rate),
+            latency=get('latency_in_seconds', defaults.latency),
+            latency_sigma=get('latency_sigma', defaults.latency_sigma),
+            min_period=get('min_period_in_seconds', defaults.min_period))
+        return synthetic.Sensor(config, int(sensor_conf.get('seed', 0)))
+
+    @staticmethod
+    def __expand_fleets(sensor_confs: Sequence[dict]) -> List[dict]:
+        """Replace each synthetic sensor with a `fleet_size` by that number
+        of sensors, with consecutive seeds and the index as suffix of the source"""
+        expanded_confs = []
+        for sensor_conf in sensor_confs:
+            fleet_size = int(sensor_conf.get('fleet_size', 1))
+            if sensor_conf.get('sensor_type') != 'synthetic' or fleet_size == 1:
+                expanded_confs.append(sensor_conf)
+                continue
+            seed = int(sensor_conf.get('seed', 0))
+            expanded_confs.extend({**sensor_conf, 'seed': seed + index,
+                                   'source_name': f"{sensor_conf['source_name']}-{index}"}
+                                  for index in range(fleet_size))
+        return expanded_confs
+
+    @staticmethod
+    def __sensor_bus(sensor_conf: dict) -> Optional[str]:
+        """The bus of the sensor, or None if the sensor doesn't use a bus"""
+        sensor_type = sensor_conf.get('sensor_type', 'dht11')
+        if sensor_type == 'sht31':
+            return f"i2c-{sensor_conf.get('i2c_bus', 1)}"
+        if sensor_type == 'synthetic':
+            return None
+        # The GrovePi board that reads the DHT11 sensors uses the I2C bus 1
+        return 'i2c-1'
+
+    def create_temp_meter(self, sensor_conf: Optional[dict] = None,
+                          bus_locks: Optional[Dict[str, threading.Lock]] = None) -> TempMeter:
+        """Factory for the TempMeter of a sensor, by default the sensor
+        of the measurement configuration.
 
-    def create_deamon(self) -> ThreadDaemon:
-        """Factory for the daemon"""
+        If `bus_locks` is not None, a sensor on a bus holds the lock of
+        its bus while measuring, creating the lock if needed"""
         measurement_conf = self.__config['measurement']
-        meter: TempMeter = self.create_temp_meter()
-        boto_session = Main.__create_boto_session()
-        measurement_recorders: Iterable[MeasurementRecorder] = [ # pylint: disable=unsubscriptable-object
-            CloudwatchMeasurementRecorder(boto_session),
-            PrometheusMeasurementRecorder()
-        ]
-        def action():
-            measurement = meter.measure()
+        if sensor_conf is None:
+            sensor_conf = measurement_conf
+        sensor = Main.create_sensor(sensor_conf)
+        bus = Main.__sensor_bus(sensor_conf)
+        if bus_locks is not None and bus is not None:
+            sensor = locked.Sensor(sensor, bus_locks.setdefault(bus, threading.Lock()))
+        sampling: Optional[AdaptiveSampling] = None
+        sampling_conf = sensor_conf.get('adaptive_sampling',
+                                        measurement_conf.get('adaptive_sampling'))
+        if sampling_conf is not None:
+            period = float(sensor_conf.get('frequency_in_seconds',
+                                           measurement_conf.get('frequency_in_seconds')))
+            # Sensors without a limit, like the synthetic one, don't go
+            # faster than the configured period unless configured to
+            min_period = float(sampling_conf.get('min_period_in_seconds',
+                sensor.min_period if sensor.min_period > 0 else period))
+            try:
+                sampling = AdaptiveSampling(period,
+                    max(min_period, sensor.min_period),
+                    min(float(sampling_conf.get('max_period_in_seconds', 10 * period)),
+                        sensor.max_period),
+                    window_size=int(sampling_conf.get('window_size', 10)),
+                    temperature_threshold=float(sampling_conf.get('temperature_threshold', 0.5)),
+                    humidity_threshold=float(sampling_conf.get('humidity_threshold', 2.0)))
+            except ValueError as value_error:
+                raise ConfigError(f"Invalid adaptive_sampling: {value_error}") from value_error
+        return TempMeter(sensor_conf['source_name'],
+                         config=TempMeterConfig(sensor=sensor, sampling=sampling))
+
+    def create_temp_meters(self) -> List[Tuple[float, TempMeter]]:
+        """Factory for the TempMeter of each configured sensor, with
+        its period in seconds"""
+        measurement_conf = self.__config['measurement']
+        sensor_confs = measurement_conf.get('sensors')
+        if sensor_confs is None:
+            return [(float(measurement_conf['frequency_in_seconds']), self.create_temp_meter())]
+        bus_locks: Dict[str, threading.Lock] = {}
+        meters: List[Tuple[float, TempMeter]] = []
+        for sensor_conf in Main.__expand_fleets(sensor_confs):
+            frequency = sensor_conf.get('frequency_in_seconds',
+                                        measurement_conf.get('frequency_in_seconds'))
+            meters.append((float(frequency), self.create_temp_meter(sensor_conf, bus_locks)))
+        return meters
+
+    def create_deamon(self) -> Union[ThreadDaemon, PoolDaemon]:
+        """Factory for the daemon. A ThreadDaemon is used for the measurement
+        sensor, and a PoolDaemon when a list of sensors is configured"""
+        measurement_conf = self.__config['measurement']
+        meters = self.create_temp_meters()
+        measurement_recorders, spool_drainer = self.create_measurement_recorders()
+        filters = self.create_filters()
+        if len(filters) > 0:
+            from .filtering import apply_filters # pylint: disable=import-outside-toplevel
+        daemon: Union[ThreadDaemon, PoolDaemon]
+        def set_period(index: int, seconds: float):
+            if isinstance(daemon, ThreadDaemon):
+                daemon.period = seconds
+            else:
+                daemon.set_period(index, seconds)
+
+        measured = threading.Event()
+        def create_action(index: int, meter: TempMeter) -> Callable[[], None]:
+            def measure_and_record():
+                measurement = meter.measure()
+                if not measured.is_set():
+                    measured.set()
+                    _record_startup()
+                if meter.period is not None:
+                    set_period(index, meter.period)
+                if len(filters) > 0:
+                    measurement = apply_filters(filters, measurement)
+                    if measurement is None:
+                        return
+                for recorder in measurement_recorders:
+                    recorder.record(measurement)
+            def action():
+                with _cycle_duration.labels(meter.source_name).time():
+                    measure_and_record()
+            if self.__profiler is None:
+                return action
+            return self.__profiler.wrap(action, meter.source_name)
+
+        def flush_recorders():
+            if self.__profiler is not None:
+                self.__profiler.stop()
             for recorder in measurement_recorders:
-                recorder.record(measurement)
+                recorder.flush()
+            if spool_drainer is not None:
+                spool_drainer.stop()
+
+        align_to = measurement_conf.get('align_to_seconds')
+        if measurement_conf.get('sensors') is None:
+            frequency, meter = meters[0]
+            daemon = ThreadDaemon(
+                frequency,
+                create_action(0, meter),
+                on_stop=flush_recorders,
+                align_to=float(align_to) if align_to is not None else None
+            )
+        else:
+            daemon = PoolDaemon(
+                [(frequency, create_action(index, meter))
+                 for index, (frequency, meter) in enumerate(meters)],
+                max_workers=int(measurement_conf.get('max_workers', 2)),
+                on_stop=flush_recorders,
+                align_to=float(align_to) if align_to is not None else None
+            )
+        return daemon
+
+    def create_filters(self) -> List[MeasurementFilter]:
+        """Factory for the filters applied to the measurements before
+        recording them, that are only used if they are configured"""
+        filtering_conf = self.__config.get('filtering')
+        if filtering_conf is None:
+            return []
+        from .filtering import HampelFilter, RangeFilter # pylint: disable=import-outside-toplevel
+        filters: List[MeasurementFilter] = [RangeFilter(
+            tuple(filtering_conf.get('temperature_range', [-40, 125])),
+            tuple(filtering_conf.get('humidity_range', [0, 100])))]
+        hampel_conf = filtering_conf.get('hampel')
+        if hampel_conf is not None:
+            filters.append(HampelFilter(
+                window_size=int(hampel_conf.get('window_size', 7)),
+                threshold=float(hampel_conf.get('threshold', 3.0)),
+                min_deviation=float(hampel_conf.get('min_deviation', 1.0)),
+                action=Main.__get_choice(hampel_conf, 'filtering.hampel.action', 'drop',
+                                         HampelFilter.actions)))
+        return filters
+
+    def create_measurement_recorders(self) -> Tuple[List[MeasurementRecorder],
+                                                     Optional['SpoolDrainer']]:
+        """Factory for the recorders of the measurements. When the spool is
+        configured this also starts the drainer that publishes the spooled
+        measurements, that is returned so it can be stopped. When the
+        aggregation is configured the measurements are sent to CloudWatch
+        as statistics for each aggregation window. When the gateway is
+        configured the measurements are pushed to the gateway instead of
+        sending them to CloudWatch. When remote write is configured the
+        measurements are also pushed to Prometheus"""
+        spool_drainer: Optional['SpoolDrainer'] = None
+        backpressure: Optional[Callable[[], float]] = None
+        aggregation_window: Optional[float] = None
+        if 'aggregation' in self.__config:
+            aggregation_window = float(self.__config['aggregation']['window_in_seconds'])
+        deadband_conf = self.__config.get('cloudwatch', {}).get('deadband')
+        if deadband_conf is not None and aggregation_window is not None:
+            raise ConfigError("Configuration cloudwatch.deadband can't be used with aggregation")
+        measurement_recorder: MeasurementRecorder
+        if 'gateway' in self.__config:
+            if aggregation_window is not None or 'spool' in self.__config:
+                raise ConfigError("Configuration gateway can't be used with aggregation or spool")
+            measurement_recorder = self.create_gateway_recorder()
+        else:
+            measurement_recorder, spool_drainer, backpressure = \
+                self.create_cloudwatch_recorders(aggregation_window)
+        if deadband_conf is not None:
+            from .filtering import DeadbandFilter, FilteringMeasurementRecorder # pylint: disable=import-outside-toplevel
+            measurement_recorder = FilteringMeasurementRecorder(measurement_recorder, [
+                DeadbandFilter(float(deadband_conf.get('temperature_threshold', 0.0)),
+                               float(deadband_conf.get('humidity_threshold', 0.0)),
+                               float(deadband_conf.get('heartbeat_in_seconds', 300)))])
+        metrics_conf = self.__config.get("metrics", {})
+        measurement_recorders: List[MeasurementRecorder] = [
+            self.create_async_recorder(measurement_recorder, backpressure),
+            self.create_async_recorder(
+                PrometheusMeasurementRecorder(summaries=bool(metrics_conf.get('summaries', False))))
+        ]
+        if 'remote_write' in self.__config:
+            measurement_recorders.append(
+                self.create_async_recorder(self.create_remote_write_recorder()))
+        if self.__history is not None:
+            # Recording in memory is cheap, so it doesn't need a worker thread
+            measurement_recorders.append(self.__history)
+        if self.__storage is not None:
+            measurement_recorders.append(self.create_async_recorder(self.__storage))
+        return measurement_recorders, spool_drainer
+
+    def create_cloudwatch_recorders(self, aggregation_window: Optional[float]) \
+        -> Tuple[MeasurementRecorder, Optional['SpoolDrainer'], Optional[Callable[[], float]]]:
+        """Factory for the recorder that sends the measurements to CloudWatch,
+        through the spool if it is configured, and as statistics for each
+        window if `aggregation_window` is not None. When the spool is configured
+        this also starts the drainer that publishes the spooled measurements.
+        When the throttling is configured without the spool, this also returns
+        the backpressure of the recorder, to shed measurements before they
+        fill its buffer"""
+        spool_drainer: Optional['SpoolDrainer'] = None
+        backpressure: Optional[Callable[[], float]] = None
+        spool = self.create_spool()
+        cloudwatch_recorder = self.create_cloudwatch_recorder()
+        if spool is None:
+            measurement_recorder: MeasurementRecorder = cloudwatch_recorder
+            if 'throttling' in self.__config.get('cloudwatch', {}):
+                def cloudwatch_backpressure() -> float:
+                    return cloudwatch_recorder.backpressure
+                backpressure = cloudwatch_backpressure
+            if aggregation_window is not None:
+                measurement_recorder = AggregatingMeasurementRecorder(cloudwatch_recorder,
+                                                                      aggregation_window)
+        else:
+            from .spool import SpoolDrainer, SpoolMeasurementRecorder # pylint: disable=import-outside-toplevel,redefined-outer-name
+            spool_conf = self.__config['spool']
+            measurement_recorder = SpoolMeasurementRecorder(spool,
+                batch_size=int(spool_conf.get('batch_size', 10)))
+            publish: Callable[[Sequence[TempMeasurement]], None] = cloudwatch_recorder.publish
+            if aggregation_window is not None:
+                window = aggregation_window
+                def publish_statistics(measurements: Sequence[TempMeasurement]):
+                    cloudwatch_recorder.publish_statistics(aggregate(measurements, window))
+                publish = publish_statistics
+            spool_drainer = SpoolDrainer(spool, publish,
+                interval=float(spool_conf.get('drain_interval_in_seconds', 60)))
+            spool_drainer.start()
+        return measurement_recorder, spool_drainer, backpressure
+
+    def create_history(self) -> Optional['MeasurementHistory']:
+        """Factory for the MeasurementHistory served by the metrics server,
+        that is only used if it is configured"""
+        history_conf = self.__config.get('history')
+        if history_conf is None:
+            return None
+        from .history import MeasurementHistory # pylint: disable=import-outside-toplevel,redefined-outer-name
+        return MeasurementHistory(int(history_conf.get('capacity', 24 * 60 * 60)),
+            rollups=[(60, int(history_conf.get('minute_capacity', 7 * 24 * 60))),
+                     (60 * 60, int(history_conf.get('hour_capacity', 366 * 24)))])
+
+    def create_storage(self) -> Optional['MeasurementStorage']:
+        """Factory for the MeasurementStorage served by the metrics server,
+        that is only used if it is configured"""
+        storage_conf = self.__config.get('storage')
+        if storage_conf is None:
+            return None
+        directory = storage_conf.get('directory')
+        if directory is None:
+            if self.__agent_root is None:
+                raise ConfigError("Missing configuration storage.directory")
+            directory = os.path.join(self.__agent_root, 'log', 'storage')
+        from .storage import DEFAULT_TIERS, MeasurementStorage, Tier # pylint: disable=import-outside-toplevel,redefined-outer-name
+        day = 24 * 60 * 60
+        tiers = [Tier(tier.name, tier.window, tier.partition,
+                      int(float(storage_conf.get(f"{key}_retention_in_days",
+                                                 tier.retention / day)) * day))
+                 for tier, key in zip(DEFAULT_TIERS, ['raw', 'minute', 'hour'])]
+        return MeasurementStorage(directory, tiers,
+            max_size=int(storage_conf.get('max_size_in_bytes', 256 * 1024 * 1024)),
+            frame_size=int(storage_conf.get('frame_size', 60)),
+            precision=int(storage_conf.get('precision', 2)))
+
+    def create_profiler(self) -> Optional['Profiler']:
+        """Factory for the Profiler of the measurement actions, that is only
+        used if it is configured"""
+        profiling_conf = self.__config.get('profiling')
+        if profiling_conf is None:
+            return None
+        directory = profiling_conf.get('directory')
+        if directory is None:
+            if self.__agent_root is None:
+                raise ConfigError("Missing configuration profiling.directory")
+            directory = os.path.join(self.__agent_root, 'log', 'profiles')
+        from .profiling import Profiler # pylint: disable=import-outside-toplevel,redefined-outer-name
+        mode = Main.__get_choice(profiling_conf, 'profiling.mode', 'cprofile', Profiler.modes)
+        return Profiler(directory, mode,
+            every=int(profiling_conf.get('every_cycles', 0)),
+            max_files=int(profiling_conf.get('max_files', 10)),
+            frames=int(profiling_conf.get('frames', 1)))
 
-        deamon = ThreadDaemon(
-            float(measurement_conf['frequency_in_seconds']),
-            action
+    def create_spool(self) -> Optional['Spool']:
+        """Factory for the Spool, that is only used if it is configured"""
+        spool_conf = self.__config.get('spool')
+        if spool_conf is None:
+            return None
+        directory = spool_conf.get('directory')
+        if directory is None:
+            if self.__agent_root is None:
+                raise ConfigError("Missing configuration spool.directory")
+            directory = os.path.join(self.__agent_root, 'log', 'spool')
+        from .spool import Spool # pylint: disable=import-outside-toplevel,redefined-outer-name
+        fsync_policy = Main.__get_choice(spool_conf, 'spool.fsync_policy', 'batch',
+                                         Spool.fsync_policies)
+        return Spool(directory,
+            segment_size=int(spool_conf.get('segment_size_in_bytes', 1024 * 1024)),
+            max_size=int(spool_conf.get('max_size_in_bytes', 64 * 1024 * 1024)),
+            fsync_policy=fsync_policy)
+
+    def create_async_recorder(self, recorder: MeasurementRecorder,
+                              backpressure: Optional[Callable[[], float]] = None) \
+        -> AsyncMeasurementRecorder:
+        """Wrap a recorder so it runs on its own worker thread, shedding
+        measurements under its `backpressure` if it isn't None"""
+        pipeline_conf = self.__config.get('pipeline', {})
+        overflow_policy = Main.__get_choice(pipeline_conf, 'pipeline.overflow_policy',
+            'drop_oldest', AsyncMeasurementRecorder.overflow_policies)
+        return AsyncMeasurementRecorder(recorder,
+            queue_size=int(pipeline_conf.get('queue_size', 100)),
+            overflow_policy=overflow_policy,
+            backpressure=backpressure,
+            shed_threshold=float(pipeline_conf.get('shed_threshold', 0.5)))
+
+    @staticmethod
+    def __gateway_secret(gateway_conf: Dict[str, Any]) -> Optional[bytes]:
+        secret = gateway_conf.get('secret')
+        if secret is None:
+            return None
+        if not isinstance(secret, str) or len(secret) == 0:
+            raise ConfigError("Invalid gateway secret, it must be a non empty string")
+        return secret.encode()
+
+    @staticmethod
+    def __gateway_allowed_networks(gateway_conf: Dict[str, Any]) -> List[str]:
+        allowed_networks = list(gateway_conf.get('allowed_networks', []))
+        for network in allowed_networks:
+            try:
+                ipaddress.ip_network(network, strict=False)
+            except ValueError as value_error:
+                raise ConfigError(f"Invalid gateway_server.allowed_networks: {value_error}") \
+                    from value_error
+        return allowed_networks
+
+    def create_gateway_recorder(self) -> 'GatewayMeasurementRecorder':
+        """Factory for the GatewayMeasurementRecorder"""
+        from .gateway import GatewayMeasurementRecorder # pylint: disable=import-outside-toplevel,redefined-outer-name
+        gateway_conf = self.__config['gateway']
+        if 'address' not in gateway_conf:
+            raise ConfigError("Missing configuration gateway.address")
+        return GatewayMeasurementRecorder(gateway_conf['address'],
+            int(gateway_conf.get('port', 8100)),
+            batch_size=int(gateway_conf.get('batch_size', 10)),
+            max_batch_age=(float(gateway_conf['max_batch_age_in_seconds'])
+                           if 'max_batch_age_in_seconds' in gateway_conf else None),
+            secret=self.__gateway_secret(gateway_conf))
+
+    def create_remote_write_recorder(self) -> 'RemoteWriteMeasurementRecorder':
+        """Factory for the RemoteWriteMeasurementRecorder"""
+        from .remote_write import RemoteWriteMeasurementRecorder # pylint: disable=import-outside-toplevel,redefined-outer-name
+        remote_write_conf = self.__config['remote_write']
+        if 'url' not in remote_write_conf:
+            raise ConfigError("Missing configuration remote_write.url")
+        return RemoteWriteMeasurementRecorder(remote_write_conf['url'],
+            labels=remote_write_conf.get('labels'),
+            batch_size=int(remote_write_conf.get('batch_size', 10)),
+            max_batch_age=(float(remote_write_conf['max_batch_age_in_seconds'])
+                           if 'max_batch_age_in_seconds' in remote_write_conf else None),
+            max_buffered_samples=int(remote_write_conf.get('max_buffered_samples', 20000)),
+            retry_policy=RetryPolicy(max_attempts=int(remote_write_conf.get('max_attempts', 3))),
+            timeout=float(remote_write_conf.get('timeout_in_seconds', 10)))
+
+    def create_cloudwatch_recorder(self) -> CloudwatchMeasurementRecorder:
+        """Factory for the CloudwatchMeasurementRecorder"""
+        cloudwatch_conf = self.__config.get('cloudwatch', {})
+        return CloudwatchMeasurementRecorder(
+            Main.__create_cloudwatch_session(cloudwatch_conf),
+            storage_resolution=int(cloudwatch_conf.get('storage_resolution', 60)),
+            batch_size=int(cloudwatch_conf.get('batch_size', 1)),
+            max_batch_age=(float(cloudwatch_conf['max_batch_age_in_seconds'])
+                           if 'max_batch_age_in_seconds' in cloudwatch_conf else None),
+            rate_limiter=Main.__create_rate_limiter(cloudwatch_conf)
         )
-        return deamon
+
+    @staticmethod
+    def __create_rate_limiter(cloudwatch_conf: dict) -> Optional['AdaptiveRateLimiter']:
+        throttling_conf = cloudwatch_conf.get('throttling')
+        if throttling_conf is None:
+            return None
+        if 'max_calls_per_second' not in throttling_conf:
+            raise ConfigError("Missing configuration cloudwatch.throttling.max_calls_per_second")
+        from .throttling import AdaptiveRateLimiter # pylint: disable=import-outside-toplevel,redefined-outer-name
+        try:
+            return AdaptiveRateLimiter(float(throttling_conf['max_calls_per_second']),
+                burst=float(throttling_conf.get('burst', 1)),
+                min_rate=(float(throttling_conf['min_calls_per_second'])
+                          if 'min_calls_per_second' in throttling_conf else None),
+                decrease_factor=float(throttling_conf.get('decrease_factor', 0.5)))
+        except ValueError as value_error:
+            raise ConfigError(f"Invalid cloudwatch.throttling: {value_error}") from value_error
 
     def __start_metrics_server(self):
+        from .server import start_server # pylint: disable=import-outside-toplevel
         metrics_conf = self.__config.get("metrics", {'port': '8000'})
-        start_http_server(int(metrics_conf['port']))
+        # The storage keeps more history than the in-memory history
+        start_server(int(metrics_conf['port']), self.__storage or self.__history,
+                     profiler=self.__profiler)
@@ -0,0 +1,57 @@
+"""
+Aggregation of measurements into statistics over time windows, to
+measure often but only record a summary of each window
+"""
+
+import math
+from typing import Dict, List, Sequence
+
+from .types import MeasurementRecorder, StatisticsRecorder, TempMeasurement, TempStatistics
+
+def window_start(timestamp: int, window: float) -> int:
+    """Start of the window of `window` seconds that contains `timestamp`.
+    Windows are aligned to multiples of `window` seconds of the epoch time"""
+    return int(math.floor(timestamp / window) * window)
+
+def aggregate(measurements: Sequence[TempMeasurement], window: float) -> List[TempStatistics]:
+    """Statistics of some measurements per source and window"""
+    statistics: Dict[tuple, TempStatistics] = {}
+    for measurement in measurements:
+        start = window_start(measurement.timestamp, window)
+        key = (measurement.source, start)
+        if key not in statistics:
+            statistics[key] = TempStatistics(measurement.source, start)
+        statistics[key].add(measurement)
+    return list(statistics.values())
+
+
+class AggregatingMeasurementRecorder(MeasurementRecorder):
+    """A MeasurementRecorder that aggregates the measurements of each source
+    into statistics over time windows of `window` seconds, and records the
+    statistics of each window with a StatisticsRecorder once a measurement
+    for a later window arrives.
+
+    Only the statistics of the current window of each source are kept in memory.
+    Flushing records the statistics of the current windows, even if they
+    are not complete, and then flushes the statistics recorder
+    """
+    def __init__(self, recorder: StatisticsRecorder, window: float = 60):
+        self.__recorder = recorder
+        self.__window = window
+        self.__statistics: Dict[str, TempStatistics] = {}
+
+    def record(self, measurement: TempMeasurement):
+        start = window_start(measurement.timestamp, self.__window)
+        statistics = self.__statistics.get(measurement.source)
+        if statistics is None or statistics.timestamp != start:
+            if statistics is not None:
+                self.__recorder.record_statistics(statistics)
+            statistics = TempStatistics(measurement.source, start)
+            self.__statistics[measurement.source] = statistics
+        statistics.add(measurement)
+
+    def flush(self):
+        for statistics in self.__statistics.values():
+            self.__recorder.record_statistics(statistics)
+        self.__statistics = {}
+        self.__recorder.flush()
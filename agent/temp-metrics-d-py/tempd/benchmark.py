@@ -0,0 +1,394 @@
+"""
+Benchmarks of the hot path of the agent, to compare the capacity of different
+boards. These are not unit tests, so they are not collected by pytest: run
+them on the board with `python -m tempd.benchmark`, or `inv benchmark`.
+
+The benchmarks use synthetic sensors and simulated time, so they measure
+the overhead of the agent and not the time the sensors take to measure, and
+a local HTTP server that stands in for CloudWatch, so they don't send
+metrics to AWS
+"""
+
+import argparse
+import gc
+import gzip
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence
+from urllib.parse import parse_qs
+import uuid
+
+from .types import TempMeasurement, Timer
+from .agent import AsyncMeasurementRecorder, CloudwatchMeasurementRecorder
+from .agent import PoolDaemon, PrometheusMeasurementRecorder, TempMeter, TempMeterConfig
+from .agent import ThreadDaemon, resident_memory
+from .filtering import HampelFilter, RangeFilter, apply_filters
+from .history import MeasurementHistory
+from .sensors import synthetic
+from . import cloudwatch
+
+# Code that creates a CloudWatch client with each backend of CloudwatchMeasurementRecorder
+_CLIENT_CODE = {
+    'boto3': ("import boto3; boto3.session.Session(aws_access_key_id='benchmark', "
+              "aws_secret_access_key='benchmark', region_name='us-east-1').client('cloudwatch')"),
+    'slim': ("from tempd import cloudwatch; cloudwatch.Session(cloudwatch.Credentials("
+             "'benchmark', 'benchmark'), 'us-east-1').client('cloudwatch')")
+}
+
+
+class SimulatedTimer(Timer):
+    """A timer where each call to `time` advances a second, so the
+    measurements get a new timestamp without waiting"""
+    def __init__(self, start: float = 0.0):
+        self.__time = start
+
+    def sleep(self, sleep_time: float):
+        self.__time += sleep_time
+
+    def time(self) -> float:
+        self.__time += 1
+        return self.__time
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        self.__time += timeout
+        return event.is_set()
+
+
+def _cbor_text(text: str) -> bytes:
+    encoded = text.encode('utf-8')
+    if len(encoded) < 24:
+        return bytes([0x60 + len(encoded)]) + encoded
+    return bytes([0x78, len(encoded)]) + encoded
+
+def _cbor_map(values: Dict[str, str]) -> bytes:
+    return bytes([0xA0 + len(values)]) + b''.join(
+        _cbor_text(key) + _cbor_text(value) for key, value in values.items())
+
+
+class CloudwatchStub: # pylint: disable=too-many-instance-attributes
+    """A local HTTP server that stands in for the CloudWatch API, accepting
+    `PutMetricData` calls with any of the protocols of the API: query, JSON
+    or CBOR.
+
+    Each request waits `latency` seconds, and then fails with an internal
+    error with probability `error_rate`, or is throttled with probability
+    `throttling_rate`. Connections are kept alive between requests, and
+    request bodies can be compressed with gzip. The connections, requests,
+    failures and bytes received are counted
+    """
+    _namespace = 'http://monitoring.amazonaws.com/doc/2010-08-01/'
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, # pylint: disable=too-many-arguments
+                 throttling_rate: float = 0.0, *, seed: Optional[int] = None,
+                 address: str = '127.0.0.1', port: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttling_rate = throttling_rate
+        self.connections = 0
+        self.requests = 0
+        self.failures = 0
+        self.received_bytes = 0
+        self.metric_data = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        stub, lock = self, self.__lock
+
+        class Handler(BaseHTTPRequestHandler):
+            """Handler of the requests of the stub"""
+            protocol_version = 'HTTP/1.1'
+            # The headers and the body of the responses are written separately
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with lock:
+                    stub.connections += 1
+
+            def do_POST(self): # pylint: disable=invalid-name
+                """Serve a CloudWatch call"""
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, content_type, output = stub.respond(self.headers, body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(output)))
+                if 'smithy-protocol' in self.headers:
+                    self.send_header('smithy-protocol', 'rpc-v2-cbor')
+                self.end_headers()
+                self.wfile.write(output)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                pass
+
+        self.__address = address
+        self.__server = ThreadingHTTPServer((address, port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """URL of the stub, to use as the endpoint of the clients"""
+        return f"http://{self.__address}:{self.__server.server_port}"
+
+    def start(self):
+        """Start serving on a daemon thread"""
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True,
+                                         name='CloudwatchStub')
+        self.__thread.start()
+
+    def stop(self):
+        """Stop serving, and close the socket of the server"""
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self) -> 'CloudwatchStub':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, headers, body: bytes):
+        """The status, content type and body of the response to a request"""
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self.__lock:
+            self.requests += 1
+            self.received_bytes += len(body)
+            if headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            draw = self.__random.random()
+            if draw < self.error_rate:
+                error: Optional[str] = 'InternalServiceFault'
+                status = 500
+            elif draw < self.error_rate + self.throttling_rate:
+                error, status = 'Throttling', 400
+            else:
+                error, status = None, 200
+            if error is not None:
+                self.failures += 1
+            elif 'X-Amz-Target' not in headers and 'smithy-protocol' not in headers:
+                self.metric_data += sum(1 for key in parse_qs(body.decode('utf-8'))
+                                        if key.endswith('.MetricName'))
+        if 'smithy-protocol' in headers:
+            return (status, 'application/cbor',
+                    _cbor_map({'__type': error, 'message': error}) if error else _cbor_map({}))
+        if 'X-Amz-Target' in headers:
+            return (status, 'application/x-amz-json-1.0',
+                    json.dumps({'__type': error, 'message': error} if error else {})
+                    .encode('utf-8'))
+        request_id = str(uuid.uuid4())
+        if error is not None:
+            output = (f'<ErrorResponse xmlns="{self._namespace}"><Error><Type>'
+                      f'{"Sender" if status == 400 else "Receiver"}</Type><Code>{error}</Code>'
+                      f'<Message>{error}</Message></Error><RequestId>{request_id}</RequestId>'
+                      '</ErrorResponse>')
+        else:
+            output = (f'<PutMetricDataResponse xmlns="{self._namespace}"><ResponseMetadata>'
+                      f'<RequestId>{request_id}</RequestId></ResponseMetadata>'
+                      '</PutMetricDataResponse>')
+        return status, 'text/xml', output.encode('utf-8')
+
+
+class _StubSession: # pylint: disable=too-few-public-methods
+    """A session with clients of a backend, 'boto3' or 'slim', that use
+    a CloudwatchStub as endpoint"""
+    def __init__(self, stub: CloudwatchStub, backend: str = 'boto3'):
+        self.__backend = backend
+        self.__url = stub.url
+
+    def client(self, service_name: str):
+        """Create a client for the stub"""
+        if self.__backend == 'slim':
+            return cloudwatch.Session(cloudwatch.Credentials('benchmark', 'benchmark'),
+                                      'us-east-1', endpoint_url=self.__url).client(service_name)
+        import boto3 # pylint: disable=import-outside-toplevel
+        return boto3.session.Session(aws_access_key_id='benchmark',
+            aws_secret_access_key='benchmark', region_name='us-east-1') \
+            .client(service_name, endpoint_url=self.__url)
+
+
+def _percentiles(values: Sequence[float]) -> Dict[str, float]:
+    """Median, 99th percentile and maximum of some values"""
+    ordered = sorted(values)
+    def percentile(fraction: float) -> float:
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+    return {'p50': percentile(0.5), 'p99': percentile(0.99), 'max': ordered[-1]}
+
+def create_cycle(source: str = 'benchmark', seed: int = 0) -> Callable[[], None]:
+    """A measure, filter and record cycle like the one of the agent, with a
+    synthetic sensor and recording in memory"""
+    timer = SimulatedTimer()
+    sensor = synthetic.Sensor(seed=seed, clock=timer.time)
+    meter = TempMeter(source, TempMeterConfig(sensor=sensor, timer=timer))
+    filters = [RangeFilter(), HampelFilter()]
+    recorders = [PrometheusMeasurementRecorder(), MeasurementHistory()]
+    def cycle():
+        measurement = apply_filters(filters, meter.measure())
+        if measurement is None:
+            return
+        for recorder in recorders:
+            recorder.record(measurement)
+    return cycle
+
+def benchmark_cycle(cycles: int = 10000) -> dict:
+    """Time in seconds of each measure, filter and record cycle"""
+    cycle = create_cycle()
+    durations = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        cycle()
+        durations.append(time.perf_counter() - start)
+    return {'cycles': cycles, 'mean': sum(durations) / cycles, **_percentiles(durations)}
+
+def benchmark_cloudwatch(measurements: int = 2000, *, latency: float = 0.05, # pylint: disable=too-many-arguments
+                         error_rate: float = 0.0, throttling_rate: float = 0.0,
+                         batch_size: int = 20, seed: int = 0, backend: str = 'boto3') -> dict:
+    """Measurements per second recorded to CloudWatch through an
+    AsyncMeasurementRecorder, with a CloudwatchStub as endpoint, and
+    the client of `backend`"""
+    with CloudwatchStub(latency, error_rate, throttling_rate, seed=seed) as stub:
+        recorder = AsyncMeasurementRecorder(
+            CloudwatchMeasurementRecorder(_StubSession(stub, backend), batch_size=batch_size),
+            queue_size=measurements, overflow_policy='block', flush_timeout=3600)
+        sensor = synthetic.Sensor(seed=seed)
+        start = time.perf_counter()
+        for timestamp in range(measurements):
+            temperature, humidity = sensor.measure()
+            recorder.record(TempMeasurement('benchmark', timestamp, temperature, humidity))
+        recorder.flush()
+        elapsed = time.perf_counter() - start
+        return {'measurements': measurements, 'seconds': elapsed,
+                'measurements_per_second': measurements / elapsed,
+                'connections': stub.connections, 'requests': stub.requests,
+                'failures': stub.failures,
+                'bytes_per_measurement': stub.received_bytes / measurements}
+
+def benchmark_jitter(period: float = 0.01, cycles: int = 500) -> dict:
+    """Delay in seconds between the deadlines of a ThreadDaemon and the
+    start of its action, running an action that does nothing"""
+    starts: List[float] = []
+    daemon: Optional[ThreadDaemon] = None
+    def action():
+        starts.append(time.time())
+        if len(starts) == cycles and daemon is not None:
+            daemon.stop()
+    daemon = ThreadDaemon(period, action, align_to=period)
+    daemon.start(blocking=True)
+    lags = [start - math.floor(start / period) * period for start in starts]
+    return {'period': period, 'cycles': cycles, 'missed_deadlines': daemon.missed_deadlines,
+            **_percentiles(lags)}
+
+def benchmark_fleet(size: int = 1000, period: float = 1.0, duration: float = 10.0, *,
+                    max_workers: int = 2, seed: int = 0) -> dict:
+    """Measurements per second of a PoolDaemon that measures a fleet of `size`
+    synthetic sensors each `period` seconds for `duration` seconds, recording
+    to a MeasurementHistory, and the deadlines it misses"""
+    history = MeasurementHistory(int(duration / period) + 1, rollups=[(60, 60)])
+    def create_action(meter: TempMeter) -> Callable[[], None]:
+        def action():
+            history.record(meter.measure())
+        return action
+    daemon = PoolDaemon([(period, create_action(TempMeter(f"fleet-{index}",
+                                                          TempMeterConfig(sensor=sensor))))
+                         for index, sensor in enumerate(synthetic.create_fleet(size, seed=seed))],
+                        max_workers=max_workers)
+    daemon.start()
+    time.sleep(duration)
+    daemon.stop()
+    daemon.wait_for_completion(duration)
+    measurements = sum(len(history.columns(source, 0, 2 ** 62).timestamps)
+                       for source in history.sources())
+    return {'sensors': size, 'period': period, 'measurements': measurements,
+            'measurements_per_second': measurements / duration,
+            'expected_measurements_per_second': size / period,
+            'missed_deadlines': daemon.missed_deadlines}
+
+def benchmark_startup(runs: int = 5, backend: Optional[str] = None) -> dict:
+    """Seconds to start a process that imports the entry point of the agent,
+    and creates a CloudWatch client of `backend` if it is not None,
+    and its resident memory after that"""
+    client_code = f"; {_CLIENT_CODE[backend]}" if backend is not None else ''
+    code = ("import time; start = time.perf_counter(); import tempd.__main__"
+            f"{client_code}; from tempd.agent import resident_memory; "
+            "print(time.perf_counter() - start, resident_memory())")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process_seconds, import_seconds, memory = [], [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        process_seconds.append(time.perf_counter() - start)
+        imported, rss = output.split()
+        import_seconds.append(float(imported))
+        memory.append(int(rss))
+    return {'runs': runs, 'process_seconds': _percentiles(process_seconds)['p50'],
+            'import_seconds': _percentiles(import_seconds)['p50'],
+            'resident_memory': _percentiles(memory)['p50']}
+
+def benchmark_memory(cycles: int = 1000000, checkpoints: int = 10) -> dict:
+    """Growth in bytes of the resident set size of the process over a
+    number of measure, filter and record cycles"""
+    cycle = create_cycle()
+    gc.collect()
+    rss = [resident_memory()]
+    for checkpoint in range(checkpoints):
+        for _ in range(cycles // checkpoints):
+            cycle()
+        gc.collect()
+        rss.append(resident_memory())
+        logging.info('Memory checkpoint %d/%d: %d bytes', checkpoint + 1, checkpoints, rss[-1])
+    return {'cycles': cycles, 'initial_rss': rss[0], 'final_rss': rss[-1],
+            'growth': rss[-1] - rss[0], 'growth_after_first_checkpoint': rss[-1] - rss[1]}
+
+def main(args: Optional[Sequence[str]] = None):
+    """Run the benchmarks, printing a JSON object with the results"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--cycles', type=int, default=10000,
+                        help='measure, filter and record cycles timed')
+    parser.add_argument('--measurements', type=int, default=2000,
+                        help='measurements sent to the CloudWatch stub')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the CloudWatch stub takes to answer')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of CloudWatch stub calls that fail')
+    parser.add_argument('--throttling-rate', type=float, default=0.0,
+                        help='fraction of CloudWatch stub calls that are throttled')
+    parser.add_argument('--cloudwatch-backend', choices=sorted(_CLIENT_CODE), default='boto3',
+                        help='client used to send measurements to the CloudWatch stub')
+    parser.add_argument('--batch-size', type=int, default=20,
+                        help='measurements per put_metric_data call')
+    parser.add_argument('--period', type=float, default=0.01,
+                        help='period in seconds for the scheduler jitter benchmark')
+    parser.add_argument('--fleet-size', type=int, default=1000,
+                        help='synthetic sensors measured by a pool daemon')
+    parser.add_argument('--fleet-duration', type=float, default=10.0,
+                        help='seconds the fleet of synthetic sensors is measured')
+    parser.add_argument('--memory-cycles', type=int, default=1000000,
+                        help='cycles run to check the memory growth')
+    parser.add_argument('--log-level', default='ERROR',
+                        help='level of the logs, that are also written on each cycle')
+    options = parser.parse_args(args)
+    logging.basicConfig(level=options.log_level)
+    results = {
+        'startup': benchmark_startup(),
+        **{f"startup_{backend}": benchmark_startup(backend=backend) for backend in _CLIENT_CODE},
+        'cycle': benchmark_cycle(options.cycles),
+        'cloudwatch': benchmark_cloudwatch(options.measurements, latency=options.latency,
+            error_rate=options.error_rate, throttling_rate=options.throttling_rate,
+            batch_size=options.batch_size, backend=options.cloudwatch_backend),
+        'jitter': benchmark_jitter(options.period),
+        'fleet': benchmark_fleet(options.fleet_size, duration=options.fleet_duration),
+        'memory': benchmark_memory(options.memory_cycles),
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
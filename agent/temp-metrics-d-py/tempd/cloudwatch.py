@@ -0,0 +1,396 @@
+"""
+Slim CloudWatch client, an alternative to boto3 for the agent.
+
+The agent only calls `put_metric_data`, and importing boto3 takes most of
+the startup time and memory of the agent. This module implements that call
+with the query protocol of the API, signed with AWS Signature Version 4, on
+top of `http.client`, with the same interface as the boto3 clients so
+CloudwatchMeasurementRecorder works with either of them. Connections are
+kept alive between calls, and large request bodies are compressed with
+gzip, as the API accepts, to cut the latency and the data sent over slow
+and metered links. `create_boto3_session` configures the boto3 clients
+the same way.
+
+Credentials and region are read from the same environment variables as boto3:
+AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN, and AWS_REGION
+or AWS_DEFAULT_REGION. Other boto3 credential providers, like the
+`~/.aws` files or instance profiles, are not supported
+"""
+
+import gzip
+import hashlib
+import hmac
+import http.client
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+from prometheus_client import Counter, Histogram
+
+from .types import RetryPolicy, Timer, TimeTimer
+
+if TYPE_CHECKING:
+    import boto3
+
+_timer = TimeTimer()
+_retries: Counter = Counter("tempd_cloudwatch_retries",
+    "put_metric_data calls retried by the slim CloudWatch client")
+_connections: Counter = Counter("tempd_cloudwatch_connections",
+    "connections opened to CloudWatch by the slim CloudWatch client")
+_reused_connections: Counter = Counter("tempd_cloudwatch_reused_connections",
+    "requests sent by the slim CloudWatch client on a connection kept alive")
+_request_duration: Histogram = Histogram("tempd_cloudwatch_request_seconds",
+    "time of the requests of the slim CloudWatch client, including connecting")
+_payload_bytes: Counter = Counter("tempd_cloudwatch_payload_bytes",
+    "bytes of the bodies of the put_metric_data calls, before compression")
+_sent_bytes: Counter = Counter("tempd_cloudwatch_sent_bytes",
+    "bytes of the bodies of the requests sent to CloudWatch, after compression")
+
+_API_VERSION = '2010-08-01'
+_SERVICE = 'monitoring'
+_CONTENT_TYPE = 'application/x-www-form-urlencoded; charset=utf-8'
+_ERROR_CODE = re.compile(r'<Code>([^<]*)</Code>')
+_ERROR_MESSAGE = re.compile(r'<Message>([^<]*)</Message>')
+# Error codes retried besides the 5XX status codes, as boto3 does in standard mode
+_THROTTLING_CODES = frozenset(['Throttling', 'ThrottlingException', 'ThrottledException',
+                               'RequestThrottledException', 'TooManyRequestsException',
+                               'RequestLimitExceeded', 'BandwidthLimitExceeded',
+                               'SlowDown', 'PriorRequestNotComplete',
+                               'EC2ThrottledException'])
+_TRANSIENT_CODES = frozenset(['RequestTimeout', 'RequestTimeoutException',
+                              'InternalError', 'ServiceUnavailable'])
+
+
+class CloudwatchError(Exception):
+    """A call to CloudWatch failed with an error response. `code` is the
+    error code of the API, like "Throttling", and `status` the HTTP status"""
+    def __init__(self, code: str, message: str, status: int):
+        super().__init__(f"{code} ({status}): {message}")
+        self.code = code
+        self.message = message
+        self.status = status
+
+    @property
+    def throttling(self) -> bool:
+        """Whether the call was throttled"""
+        return self.code in _THROTTLING_CODES
+
+    @property
+    def retryable(self) -> bool:
+        """Whether the call might succeed if retried"""
+        return self.throttling or self.code in _TRANSIENT_CODES or self.status >= 500
+
+
+@dataclass(frozen=True)
+class Credentials:
+    """AWS credentials, with a session token for temporary credentials"""
+    access_key: str
+    secret_key: str
+    token: Optional[str] = None
+
+    @staticmethod
+    def from_environment() -> Optional['Credentials']:
+        """The credentials of the environment variables, or None
+        if they are missing"""
+        access_key = os.environ.get('AWS_ACCESS_KEY_ID', '')
+        secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        if len(access_key) == 0 or len(secret_key) == 0:
+            return None
+        return Credentials(access_key, secret_key,
+                           os.environ.get('AWS_SESSION_TOKEN') or None)
+
+
+@dataclass(frozen=True)
+class ConnectionPolicy:
+    """Connections to CloudWatch. Up to `pool_size` connections are kept alive
+    between calls, to skip the TCP and TLS handshakes, with TCP keepalive
+    probes if `tcp_keepalive` so a dropped connection is noticed. Requests
+    wait `connect_timeout` seconds to connect, and then `read_timeout` seconds
+    for each read. Request bodies of at least `min_compression_size` bytes are
+    compressed with gzip, or never if it is None"""
+    pool_size: int = 1
+    connect_timeout: float = 10.0
+    read_timeout: float = 30.0
+    tcp_keepalive: bool = True
+    min_compression_size: Optional[int] = 10240
+
+
+def _sign(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+def sign_request(credentials: Credentials, region: str, url: str, # pylint: disable=too-many-arguments,too-many-locals
+                 body: bytes, timestamp: float, *, headers: Optional[Dict[str, str]] = None,
+                 service: str = _SERVICE) -> Dict[str, str]:
+    """The headers to sign a form encoded POST request to `url` with AWS
+    Signature Version 4 at `timestamp`, including the Authorization header,
+    and `headers` with lower case names, that are also signed.
+    See https://docs.aws.amazon.com/general/latest/gr/sigv4_signing.html"""
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    if parts.port is not None and parts.port != {'http': 80, 'https': 443}.get(parts.scheme):
+        host = f"{host}:{parts.port}"
+    amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(timestamp))
+    headers = {**(headers or {}),
+               'content-type': _CONTENT_TYPE, 'host': host, 'x-amz-date': amz_date}
+    if credentials.token is not None:
+        headers['x-amz-security-token'] = credentials.token
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([
+        'POST', quote(parts.path or '/', safe='/~'), parts.query,
+        ''.join(f"{name}:{headers[name].strip()}\n" for name in sorted(headers)),
+        signed_headers, hashlib.sha256(body).hexdigest()])
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+    key = ('AWS4' + credentials.secret_key).encode('utf-8')
+    for scope_part in (amz_date[:8], region, service, 'aws4_request'):
+        key = _sign(key, scope_part)
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    headers['authorization'] = (f"AWS4-HMAC-SHA256 Credential={credentials.access_key}/{scope}, "
+                                f"SignedHeaders={signed_headers}, Signature={signature}")
+    return headers
+
+def _timestamp_iso8601(timestamp: float) -> str:
+    text = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp))
+    microseconds = int(round((timestamp % 1) * 1e6))
+    return f"{text}.{microseconds:06d}Z" if microseconds > 0 else f"{text}Z"
+
+def _flatten(prefix: str, value: object, params: Dict[str, str]):
+    if isinstance(value, dict):
+        for key, member in value.items():
+            _flatten(f"{prefix}.{key}", member, params)
+    elif isinstance(value, (list, tuple)):
+        for index, member in enumerate(value, 1):
+            _flatten(f"{prefix}.member.{index}", member, params)
+    elif prefix.endswith('.Timestamp') and isinstance(value, (int, float)):
+        params[prefix] = _timestamp_iso8601(value)
+    else:
+        params[prefix] = str(value)
+
+def encode_put_metric_data(namespace: str, metric_data: list) -> bytes:
+    """The body of a PutMetricData call with the query protocol, for the
+    same arguments as `put_metric_data` of boto3, with the timestamps as
+    seconds since the epoch"""
+    params = {'Action': 'PutMetricData', 'Version': _API_VERSION, 'Namespace': namespace}
+    for index, metric in enumerate(metric_data, 1):
+        _flatten(f"MetricData.member.{index}", metric, params)
+    return urlencode(params).encode('utf-8')
+
+
+class _ConnectionPool:
+    """Connections kept alive between requests to an endpoint, up to the
+    pool size of the policy"""
+    def __init__(self, url: str, policy: ConnectionPolicy):
+        parts = urlsplit(url)
+        self.__https = parts.scheme != 'http'
+        self.__host = parts.hostname or ''
+        self.__port = parts.port
+        self.__policy = policy
+        self.__idle: List[http.client.HTTPConnection] = []
+        self.__lock = threading.Lock()
+
+    def acquire(self) -> Tuple[http.client.HTTPConnection, bool]:
+        """An idle connection, or a new one, and whether it was idle"""
+        with self.__lock:
+            if len(self.__idle) > 0:
+                return self.__idle.pop(), True
+        policy = self.__policy
+        connection_class = http.client.HTTPSConnection if self.__https \
+            else http.client.HTTPConnection
+        connection = connection_class(self.__host, self.__port, timeout=policy.connect_timeout)
+        connection.connect()
+        sock = connection.sock
+        sock.settimeout(policy.read_timeout)
+        # Like urllib3, as requests are small and wait for their response
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if policy.tcp_keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Linux only, other platforms keep their default keepalive timing
+            for option, value in [('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)]:
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        _connections.inc()
+        return connection, False
+
+    def release(self, connection: http.client.HTTPConnection):
+        """Keep a connection alive for a later request, if the pool is not full"""
+        with self.__lock:
+            if len(self.__idle) < self.__policy.pool_size:
+                self.__idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """Close the idle connections"""
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for connection in idle:
+            connection.close()
+
+
+class CloudwatchClient: # pylint: disable=too-many-instance-attributes
+    """A CloudWatch client that only implements `put_metric_data`.
+
+    Connections to the endpoint are kept alive between calls as configured
+    by `connection_policy`, and request bodies are compressed with gzip
+    when they are large. Calls are retried according to `retry_policy`.
+    Failed calls raise CloudwatchError, or OSError for connection errors"""
+    logger = logging.getLogger('CloudwatchClient')
+
+    def __init__(self, credentials: Credentials, region: str, *, # pylint: disable=too-many-arguments
+                 endpoint_url: Optional[str] = None,
+                 retry_policy: RetryPolicy = RetryPolicy(),
+                 connection_policy: ConnectionPolicy = ConnectionPolicy(),
+                 timer: Timer = _timer):
+        self.__credentials = credentials
+        self.__region = region
+        suffix = '.cn' if region.startswith('cn-') else ''
+        self.__url = endpoint_url or f"https://{_SERVICE}.{region}.amazonaws.com{suffix}/"
+        self.__retry_policy = retry_policy
+        self.__min_compression_size = connection_policy.min_compression_size
+        self.__pool = _ConnectionPool(self.__url, connection_policy)
+        self.__timer = timer
+        self.__random = random.Random()
+
+    @property
+    def url(self) -> str:
+        """URL of the endpoint"""
+        return self.__url
+
+    def __post(self, body: bytes, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        while True:
+            connection, reused = self.__pool.acquire()
+            try:
+                connection.request('POST', urlsplit(self.__url).path or '/', body, headers)
+                response = connection.getresponse()
+                output = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused:
+                    # The endpoint closed the idle connection, so it didn't get the request
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            if reused:
+                _reused_connections.inc()
+            if response.will_close:
+                connection.close()
+            else:
+                self.__pool.release(connection)
+            return response.status, output
+
+    def __call(self, body: bytes, encoding: Optional[str]):
+        headers = {'content-encoding': encoding} if encoding is not None else {}
+        headers = sign_request(self.__credentials, self.__region, self.__url, body,
+                               self.__timer.time(), headers=headers)
+        with _request_duration.time():
+            status, output = self.__post(body, headers)
+        _sent_bytes.inc(len(body))
+        if status < 300:
+            return
+        text = output.decode('utf-8', errors='replace')
+        code = _ERROR_CODE.search(text)
+        message = _ERROR_MESSAGE.search(text)
+        raise CloudwatchError(code.group(1) if code else str(status),
+                              message.group(1) if message else text[:200], status)
+
+    def put_metric_data(self, **params: Any):
+        """Send metrics, with the same `Namespace` and `MetricData` arguments
+        as `put_metric_data` of boto3"""
+        body = encode_put_metric_data(params['Namespace'], params['MetricData'])
+        _payload_bytes.inc(len(body))
+        encoding: Optional[str] = None
+        if self.__min_compression_size is not None and len(body) >= self.__min_compression_size:
+            body, encoding = gzip.compress(body), 'gzip'
+        policy = self.__retry_policy
+        for attempt in range(1, policy.max_attempts + 1):
+            try:
+                self.__call(body, encoding)
+                return
+            except (CloudwatchError, OSError, http.client.HTTPException) as error:
+                retryable = not isinstance(error, CloudwatchError) or \
+                    (error.retryable and (policy.retry_throttling or not error.throttling))
+                if not retryable or attempt == policy.max_attempts:
+                    raise
+                delay = policy.delay(attempt - 1, self.__random.random())
+                self.__class__.logger.warning('Retrying put_metric_data in %.2f seconds: %s',
+                                              delay, error)
+                _retries.inc()
+                self.__timer.sleep(delay)
+
+    def close(self):
+        """Close the connections kept alive"""
+        self.__pool.close()
+
+
+class Session: # pylint: disable=too-few-public-methods
+    """Stands in for `boto3.session.Session`, to create CloudWatch clients.
+    By default the credentials and the region are read from the environment"""
+    def __init__(self, credentials: Optional[Credentials] = None, region: Optional[str] = None,
+                 **client_args):
+        credentials = credentials or Credentials.from_environment()
+        if credentials is None:
+            raise ValueError('Missing AWS credentials, set AWS_ACCESS_KEY_ID and '
+                             'AWS_SECRET_ACCESS_KEY')
+        region = region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+        if not region:
+            raise ValueError('Missing AWS region, set AWS_REGION or AWS_DEFAULT_REGION')
+        self.__credentials = credentials
+        self.__region = region
+        self.__client_args = client_args
+
+    def client(self, service_name: str) -> CloudwatchClient:
+        """Create a client, only 'cloudwatch' is supported"""
+        if service_name != 'cloudwatch':
+            raise ValueError(f"Unsupported service {service_name}")
+        return CloudwatchClient(self.__credentials, self.__region, **self.__client_args)
+
+
+def is_throttling(error: BaseException) -> bool:
+    """Whether an error of a call of either the slim or the boto3 clients
+    is a throttling error"""
+    if isinstance(error, CloudwatchError):
+        return error.throttling
+    # botocore.exceptions.ClientError
+    response = getattr(error, 'response', None)
+    return isinstance(response, dict) and \
+        response.get('Error', {}).get('Code') in _THROTTLING_CODES
+
+def _count_sent_bytes(request: Any, **_kwargs):
+    body = request.body
+    if isinstance(body, (bytes, bytearray, str)):
+        _sent_bytes.inc(len(body))
+
+def create_boto3_session(connection_policy: ConnectionPolicy = ConnectionPolicy(),
+                         max_attempts: Optional[int] = None) -> 'boto3.session.Session':
+    """A boto3 session with clients configured with a ConnectionPolicy,
+    like the clients of Session, that count the bytes they send. Calls are
+    retried with the standard retry mode of boto3 up to `max_attempts` calls
+    in total, or with its default retry strategy if it is None"""
+    import boto3 # pylint: disable=import-outside-toplevel,redefined-outer-name
+    import botocore.config # pylint: disable=import-outside-toplevel
+    import botocore.session # pylint: disable=import-outside-toplevel
+    botocore_session = botocore.session.get_session()
+    min_compression_size = connection_policy.min_compression_size
+    botocore_session.set_default_client_config(botocore.config.Config(
+        max_pool_connections=connection_policy.pool_size,
+        connect_timeout=connection_policy.connect_timeout,
+        read_timeout=connection_policy.read_timeout,
+        tcp_keepalive=connection_policy.tcp_keepalive,
+        disable_request_compression=min_compression_size is None,
+        request_min_compression_size_bytes=(min_compression_size
+                                            if min_compression_size is not None else 10240),
+        retries=({'mode': 'standard', 'total_max_attempts': max_attempts}
+                 if max_attempts is not None else None)))
+    botocore_session.register('before-send.cloudwatch.PutMetricData', _count_sent_bytes)
+    return boto3.session.Session(botocore_session=botocore_session)
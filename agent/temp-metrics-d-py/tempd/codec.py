@@ -0,0 +1,188 @@
+"""
+Compact binary encoding for series of measurements, to store and send
+them using a few bytes per measurement.
+
+Timestamps are encoded as the difference between consecutive deltas, that
+is 0 for measurements taken at a regular interval, and values are quantized
+to `precision` decimal digits and encoded as the difference with the previous
+value, so they are 0 while the values don't change. Each row has a header byte
+with a flag for each non zero difference, followed by the non zero differences
+as zigzag varints. Consecutive rows with no differences are encoded as a run
+in a single header byte.
+"""
+
+import math
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from .types import TempMeasurement
+
+# Frames start with this byte, followed by the precision, the source and
+# the body length, and then the body with the encoded rows
+_FRAME_MAGIC = 0xD7
+_ENCODING = 'utf-8'
+# The 3 lower bits of the header have the flags of the non zero differences, and
+# when all are 0 the 5 upper bits have the length of the run minus 1
+_FLAGS_MASK = 0x07
+_MAX_RUN = 32
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+def write_varint(out: bytearray, value: int):
+    """Append a non negative integer, using 7 bits per byte"""
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data: bytes, offset: int) -> Tuple[int, int]:
+    """Read a non negative integer returning it, and the offset after it.
+    Raises IndexError if the data ends before the integer"""
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class SeriesEncoder:
+    """Streaming encoder for the rows of a series of measurements.
+
+    Rows are returned as soon as they are known, but a run of rows without
+    differences is only returned once a row with differences arrives or
+    `flush` is called. Values are rounded to `precision` decimal digits"""
+    def __init__(self, precision: int = 2):
+        self.__scale = 10 ** precision
+        self.__previous = (0, 0, 0)
+        self.__previous_delta: Optional[int] = None
+        self.__run = 0
+
+    def __quantize(self, value: float) -> int:
+        if not math.isfinite(value):
+            raise ValueError(f"Cannot encode value {value}")
+        return int(round(value * self.__scale))
+
+    def encode(self, timestamp: int, temperature: float, humidity: float) -> bytes:
+        """Encode a row, returning the bytes that are ready"""
+        row = (timestamp, self.__quantize(temperature), self.__quantize(humidity))
+        if self.__previous_delta is None:
+            # The first row is encoded as the difference with 0
+            delta_of_delta = timestamp
+            self.__previous_delta = 0
+        else:
+            delta = timestamp - self.__previous[0]
+            delta_of_delta = delta - self.__previous_delta
+            self.__previous_delta = delta
+        differences = [delta_of_delta, row[1] - self.__previous[1], row[2] - self.__previous[2]]
+        self.__previous = row
+        if not any(differences):
+            self.__run += 1
+            return self.flush() if self.__run == _MAX_RUN else b''
+        out = bytearray(self.flush())
+        out.append(sum(1 << bit for bit, difference in enumerate(differences) if difference))
+        for difference in differences:
+            if difference:
+                write_varint(out, _zigzag(difference))
+        return bytes(out)
+
+    def flush(self) -> bytes:
+        """Return the pending run of rows without differences, if any"""
+        if self.__run == 0:
+            return b''
+        header = (self.__run - 1) << 3
+        self.__run = 0
+        return bytes([header])
+
+
+class SeriesDecoder: # pylint: disable=too-few-public-methods
+    """Streaming decoder for the rows encoded by a SeriesEncoder. Data can
+    be fed in chunks of any size, and an incomplete row at the end of a chunk
+    is decoded once the rest of the row arrives"""
+    def __init__(self, precision: int = 2):
+        self.__scale = 10 ** precision
+        self.__previous = (0, 0, 0)
+        self.__previous_delta: Optional[int] = None
+        self.__pending = b''
+
+    def __row(self, differences: Sequence[int]) -> Tuple[int, float, float]:
+        if self.__previous_delta is None:
+            delta = differences[0]
+            self.__previous_delta = 0
+        else:
+            delta = self.__previous_delta + differences[0]
+            self.__previous_delta = delta
+        timestamp, temperature, humidity = self.__previous
+        self.__previous = (timestamp + delta, temperature + differences[1],
+                           humidity + differences[2])
+        return (self.__previous[0], self.__previous[1] / self.__scale,
+                self.__previous[2] / self.__scale)
+
+    def decode(self, data: bytes) -> List[Tuple[int, float, float]]:
+        """Decode the rows completed by `data`, as tuples of the timestamp,
+        temperature and humidity"""
+        data = self.__pending + data
+        rows: List[Tuple[int, float, float]] = []
+        offset = 0
+        while offset < len(data):
+            header = data[offset]
+            flags = header & _FLAGS_MASK
+            if flags == 0:
+                rows.extend(self.__row((0, 0, 0)) for _ in range((header >> 3) + 1))
+                offset += 1
+                continue
+            differences = [0, 0, 0]
+            row_offset = offset + 1
+            try:
+                for bit in range(3):
+                    if flags & (1 << bit):
+                        value, row_offset = read_varint(data, row_offset)
+                        differences[bit] = _unzigzag(value)
+            except IndexError:
+                break
+            rows.append(self.__row(differences))
+            offset = row_offset
+        self.__pending = data[offset:]
+        return rows
+
+
+def encode_frame(source: str, measurements: Sequence[TempMeasurement],
+                 precision: int = 2) -> bytes:
+    """Encode measurements of a source as a self contained frame"""
+    encoder = SeriesEncoder(precision)
+    body = b''.join(encoder.encode(measurement.timestamp, measurement.temperature,
+                                   measurement.humidity)
+                    for measurement in measurements) + encoder.flush()
+    encoded_source = source.encode(_ENCODING)
+    out = bytearray([_FRAME_MAGIC, precision])
+    write_varint(out, len(encoded_source))
+    out += encoded_source
+    write_varint(out, len(body))
+    return bytes(out) + body
+
+def decode_frames(data: bytes) -> Iterator[TempMeasurement]:
+    """Decode a sequence of frames. A truncated frame at the end of the data,
+    e.g. due to a power loss while writing it, is ignored"""
+    offset = 0
+    while offset < len(data):
+        if data[offset] != _FRAME_MAGIC:
+            raise ValueError(f"Invalid frame at offset {offset}")
+        try:
+            precision = data[offset + 1]
+            source_length, source_offset = read_varint(data, offset + 2)
+            body_length, body_offset = read_varint(data, source_offset + source_length)
+        except IndexError:
+            return
+        if body_offset + body_length > len(data):
+            return
+        source = data[source_offset:source_offset + source_length].decode(_ENCODING)
+        decoder = SeriesDecoder(precision)
+        for timestamp, temperature, humidity in \
+            decoder.decode(data[body_offset:body_offset + body_length]):
+            yield TempMeasurement(source, timestamp, temperature, humidity)
+        offset = body_offset + body_length
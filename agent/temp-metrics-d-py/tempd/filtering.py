@@ -0,0 +1,232 @@
+"""
+Filters for measurements, used to discard out of range values and
+spikes before recording the measurements
+"""
+
+import bisect
+import logging
+from array import array
+from dataclasses import replace
+from typing import Dict, Optional, Sequence, Tuple
+
+from prometheus_client import Counter
+
+from .types import MeasurementFilter, MeasurementRecorder, TempMeasurement
+
+_outliers: Counter = Counter("tempd_outliers",
+    "measurement values detected as outliers", labelnames=['source', 'metric', 'action'])
+_suppressed: Counter = Counter("tempd_deadband_suppressed",
+    "measurements not recorded because their values didn't change enough",
+    labelnames=['source'])
+
+class RangeFilter(MeasurementFilter): # pylint: disable=too-few-public-methods
+    """A filter that discards measurements with values out of the range
+    the sensors are able to measure"""
+    logger = logging.getLogger('RangeFilter')
+
+    def __init__(self, temperature_range: Tuple[float, float] = (-40, 125),
+                 humidity_range: Tuple[float, float] = (0, 100)):
+        """The ranges are inclusive, and by default they are the SHT31
+        operating range"""
+        self.__temperature_range = temperature_range
+        self.__humidity_range = humidity_range
+
+    def apply(self, measurement: TempMeasurement) -> Optional[TempMeasurement]:
+        for metric, value, (min_value, max_value) in [
+            ('temperature', measurement.temperature, self.__temperature_range),
+            ('humidity', measurement.humidity, self.__humidity_range)]:
+            if not min_value <= value <= max_value:
+                self.__class__.logger.warning('Discarding out of range %s for %s',
+                    metric, measurement)
+                _outliers.labels(measurement.source, metric, 'drop').inc()
+                return None
+        return measurement
+
+
+class _Window:
+    """The latest values of a metric, both in arrival order in a ring buffer,
+    and sorted to compute the median"""
+    def __init__(self, size: int):
+        self.__ring = array('d', [0.0] * size)
+        self.__sorted = array('d')
+        self.__next = 0
+
+    @property
+    def full(self) -> bool:
+        """Whether the window has as many values as its size"""
+        return len(self.__sorted) == len(self.__ring)
+
+    def add(self, value: float):
+        """Add a value, evicting the oldest value if the window is full"""
+        if self.full:
+            del self.__sorted[bisect.bisect_left(self.__sorted, self.__ring[self.__next])]
+        self.__ring[self.__next] = value
+        self.__next = (self.__next + 1) % len(self.__ring)
+        bisect.insort(self.__sorted, value)
+
+    def median(self) -> float:
+        """Median of the values in the window"""
+        return _median(self.__sorted)
+
+    def median_absolute_deviation(self, median: float) -> float:
+        """Median of the absolute deviations from `median`. The deviations of
+        the values on each side of `median` are already sorted, so they are
+        merged walking outwards from `median` up to the middle deviation, in
+        linear time and without sorting nor copying the values"""
+        values = self.__sorted
+        count = len(values)
+        right = bisect.bisect_left(values, median)
+        left = right - 1
+        previous = deviation = 0.0
+        for _ in range(count // 2 + 1):
+            previous = deviation
+            if right >= count or \
+                (left >= 0 and median - values[left] <= values[right] - median):
+                deviation = median - values[left]
+                left -= 1
+            else:
+                deviation = values[right] - median
+                right += 1
+        if count % 2 == 1:
+            return deviation
+        return (previous + deviation) / 2
+
+def _median(sorted_values: array) -> float:
+    middle = len(sorted_values) // 2
+    if len(sorted_values) % 2 == 1:
+        return float(sorted_values[middle])
+    return float(sorted_values[middle - 1] + sorted_values[middle]) / 2
+
+
+class HampelFilter(MeasurementFilter): # pylint: disable=too-few-public-methods
+    """A filter that detects spikes with a Hampel filter, independently for
+    each source, for both temperature and humidity.
+
+    A value is an outlier when it deviates from the median of the latest
+    `window_size` values of the source by more than `threshold` times the
+    scaled median absolute deviation (MAD) of those values. As sensors
+    like the DHT11 often report the same value for a while, deviations
+    under `min_deviation` are never considered outliers, even if the MAD is 0.
+    Values are only checked once the window is full. The window holds the
+    values as read, so a lasting change of the values is accepted after
+    half a window.
+
+    The `action` for outliers can be:
+
+    - 'drop': discard the measurement
+    - 'replace': replace the outlier value with the median
+    - 'flag': keep the measurement, so it is only logged and counted
+
+    Outliers are counted in the `tempd_outliers` Prometheus counter.
+    Memory per measurement only depends on `window_size`, and time is
+    O(log window_size) to update the median, and O(window_size) without
+    allocations to compute the MAD
+    """
+    actions = ('drop', 'replace', 'flag')
+    # Scales the MAD to estimate the standard deviation of normally distributed values
+    __MAD_SCALE = 1.4826
+    logger = logging.getLogger('HampelFilter')
+
+    def __init__(self, window_size: int = 7, threshold: float = 3.0,
+                 min_deviation: float = 1.0, action: str = 'drop'):
+        if action not in self.__class__.actions:
+            raise ValueError(f"Unknown outlier action '{action}'")
+        self.__window_size = window_size
+        self.__threshold = threshold
+        self.__min_deviation = min_deviation
+        self.__action = action
+        self.__windows: Dict[str, Tuple[_Window, _Window]] = {}
+
+    def __is_outlier(self, window: _Window, value: float) -> Tuple[bool, float]:
+        if not window.full:
+            return False, value
+        median = window.median()
+        max_deviation = max(self.__threshold * HampelFilter.__MAD_SCALE *
+                            window.median_absolute_deviation(median),
+                            self.__min_deviation)
+        return abs(value - median) > max_deviation, median
+
+    def apply(self, measurement: TempMeasurement) -> Optional[TempMeasurement]:
+        if measurement.source not in self.__windows:
+            self.__windows[measurement.source] = (_Window(self.__window_size),
+                                                  _Window(self.__window_size))
+        temperature_window, humidity_window = self.__windows[measurement.source]
+        temperature_outlier, temperature_median = \
+            self.__is_outlier(temperature_window, measurement.temperature)
+        humidity_outlier, humidity_median = \
+            self.__is_outlier(humidity_window, measurement.humidity)
+        temperature_window.add(measurement.temperature)
+        humidity_window.add(measurement.humidity)
+        if not (temperature_outlier or humidity_outlier):
+            return measurement
+
+        for metric, outlier in [('temperature', temperature_outlier),
+                                ('humidity', humidity_outlier)]:
+            if outlier:
+                _outliers.labels(measurement.source, metric, self.__action).inc()
+        self.__class__.logger.warning('Outlier detected (%s) for %s', self.__action, measurement)
+        if self.__action == 'drop':
+            return None
+        if self.__action == 'replace':
+            if temperature_outlier:
+                measurement = replace(measurement, temperature=temperature_median)
+            if humidity_outlier:
+                measurement = replace(measurement, humidity=humidity_median)
+        return measurement
+
+
+class DeadbandFilter(MeasurementFilter): # pylint: disable=too-few-public-methods
+    """A filter that only keeps the measurements of a source when the
+    temperature or the humidity differ from the latest kept measurement by
+    more than their threshold, or when `heartbeat` seconds have passed since
+    the latest kept measurement, to avoid recording redundant measurements.
+
+    Discarded measurements are counted in the `tempd_deadband_suppressed`
+    Prometheus counter"""
+
+    def __init__(self, temperature_threshold: float = 0.0,
+                 humidity_threshold: float = 0.0, heartbeat: float = 300.0):
+        self.__temperature_threshold = temperature_threshold
+        self.__humidity_threshold = humidity_threshold
+        self.__heartbeat = heartbeat
+        self.__kept: Dict[str, TempMeasurement] = {}
+
+    def apply(self, measurement: TempMeasurement) -> Optional[TempMeasurement]:
+        kept = self.__kept.get(measurement.source)
+        if kept is not None \
+            and abs(measurement.temperature - kept.temperature) <= self.__temperature_threshold \
+            and abs(measurement.humidity - kept.humidity) <= self.__humidity_threshold \
+            and measurement.timestamp - kept.timestamp < self.__heartbeat:
+            _suppressed.labels(measurement.source).inc()
+            return None
+        self.__kept[measurement.source] = measurement
+        return measurement
+
+
+class FilteringMeasurementRecorder(MeasurementRecorder):
+    """A MeasurementRecorder that applies some filters before recording
+    with another recorder, to filter the measurements of a single recorder"""
+
+    def __init__(self, recorder: MeasurementRecorder, filters: Sequence[MeasurementFilter]):
+        self.__recorder = recorder
+        self.__filters = filters
+
+    def record(self, measurement: TempMeasurement):
+        filtered_measurement = apply_filters(self.__filters, measurement)
+        if filtered_measurement is not None:
+            self.__recorder.record(filtered_measurement)
+
+    def flush(self):
+        self.__recorder.flush()
+
+
+def apply_filters(filters: Sequence[MeasurementFilter],
+                  measurement: TempMeasurement) -> Optional[TempMeasurement]:
+    """Apply some filters in order, returning None as soon as
+    a filter discards the measurement"""
+    filtered_measurement: Optional[TempMeasurement] = measurement
+    for measurement_filter in filters:
+        if filtered_measurement is None:
+            return None
+        filtered_measurement = measurement_filter.apply(filtered_measurement)
+    return filtered_measurement
@@ -0,0 +1,290 @@
+"""
+Gateway mode, where agents push their measurements to a single process
+that records them upstream, so only the gateway needs AWS credentials and
+the measurements of many agents are sent to CloudWatch in large batches.
+
+Agents send UDP datagrams with the measurements encoded as frames of
+tempd.codec, so a batch of measurements takes a few bytes per measurement,
+and the gateway receives them on an asyncio event loop.
+
+Datagrams are not encrypted. With a shared secret each datagram starts with
+a truncated HMAC-SHA256 of its frames, and the gateway discards datagrams
+without a valid one, as well as datagrams from senders out of its allowed
+networks
+"""
+
+import asyncio
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import logging
+import socket
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from prometheus_client import Counter
+
+from .types import TempMeasurement, MeasurementFilter, MeasurementRecorder, Timer, TimeTimer
+from .codec import decode_frames, encode_frame
+from .filtering import apply_filters
+
+_timer = TimeTimer()
+_received: Counter = Counter("tempd_gateway_received_measurements",
+    "measurements received by the gateway")
+_duplicated: Counter = Counter("tempd_gateway_duplicated_measurements",
+    "measurements discarded by the gateway because they were already received, or are too late")
+_invalid: Counter = Counter("tempd_gateway_invalid_datagrams",
+    "datagrams discarded by the gateway because they can't be decoded")
+_rejected: Counter = Counter("tempd_gateway_rejected_datagrams",
+    "datagrams discarded by the gateway because their sender or signature is not valid")
+_sent: Counter = Counter("tempd_gateway_sent_datagrams",
+    "datagrams sent to the gateway")
+_send_failures: Counter = Counter("tempd_gateway_send_failures",
+    "datagrams that failed to be sent to the gateway")
+
+SIGNATURE_SIZE = 16
+
+
+def sign(secret: bytes, data: bytes) -> bytes:
+    """The signature of a datagram, a HMAC-SHA256 truncated to SIGNATURE_SIZE bytes"""
+    return hmac.new(secret, data, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+
+class _RecentTimestamps: # pylint: disable=too-few-public-methods
+    """The timestamps of a source received in the latest `window` seconds,
+    to detect duplicates also when they arrive out of order"""
+    def __init__(self, window: int):
+        self.__window = window
+        self.__timestamps: Set[int] = set()
+        self.__heap: List[int] = []
+        self.__newest: Optional[int] = None
+
+    def add(self, timestamp: int) -> bool:
+        """Add a timestamp, returning False if it was already received, or if
+        it is too old to know it"""
+        if timestamp in self.__timestamps or \
+            (self.__newest is not None and timestamp <= self.__newest - self.__window):
+            return False
+        self.__timestamps.add(timestamp)
+        heapq.heappush(self.__heap, timestamp)
+        if self.__newest is None or timestamp > self.__newest:
+            self.__newest = timestamp
+        while self.__heap[0] <= self.__newest - self.__window:
+            self.__timestamps.remove(heapq.heappop(self.__heap))
+        return True
+
+
+class _GatewayProtocol(asyncio.DatagramProtocol):
+    def __init__(self, gateway: 'Gateway'):
+        self.__gateway = gateway
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        self.__gateway.receive(data, addr)
+
+
+class Gateway: # pylint: disable=too-many-instance-attributes
+    """Receives the measurements pushed by GatewayMeasurementRecorder, and
+    records them with `recorders` after applying `filters`.
+
+    Measurements of a source with the same timestamp as a measurement received
+    in the latest `dedup_window` seconds, e.g. the same measurement resent by an
+    agent, are discarded, as well as measurements older than that window. The
+    recorders are flushed each `flush_interval` seconds on a worker thread, so
+    they should not block when recording, e.g. use AsyncMeasurementRecorder.
+
+    With a `secret`, datagrams without a valid signature are discarded, and
+    with `allowed_networks`, e.g. ['192.168.1.0/24'], datagrams sent from
+    other addresses are discarded too
+    """
+    logger = logging.getLogger('Gateway')
+
+    def __init__(self, recorders: Sequence[MeasurementRecorder], # pylint: disable=too-many-arguments
+                 filters: Sequence[MeasurementFilter] = (), *,
+                 dedup_window: int = 300, flush_interval: float = 60.0,
+                 receive_buffer_size: int = 4 * 1024 * 1024,
+                 secret: Optional[bytes] = None, allowed_networks: Sequence[str] = ()):
+        self.__recorders = recorders
+        self.__filters = filters
+        self.__dedup_window = dedup_window
+        self.__flush_interval = flush_interval
+        self.__receive_buffer_size = receive_buffer_size
+        self.__secret = secret
+        self.__allowed_networks: List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]] = \
+            [ipaddress.ip_network(network, strict=False) for network in allowed_networks]
+        self.__recent: Dict[str, _RecentTimestamps] = {}
+        self.__transport: Optional[asyncio.DatagramTransport] = None
+
+    def receive(self, data: bytes, addr: Optional[Tuple[str, int]] = None) -> int:
+        """Record the measurements of a datagram, returning the number of
+        measurements recorded"""
+        if len(self.__allowed_networks) > 0 and not self.__allowed(addr):
+            self.__class__.logger.warning('Datagram from a sender not allowed %s', addr)
+            _rejected.inc()
+            return 0
+        if self.__secret is not None:
+            signature, data = data[:SIGNATURE_SIZE], data[SIGNATURE_SIZE:]
+            if not hmac.compare_digest(signature, sign(self.__secret, data)):
+                self.__class__.logger.warning('Datagram with an invalid signature from %s', addr)
+                _rejected.inc()
+                return 0
+        try:
+            measurements = list(decode_frames(data))
+        except (ValueError, IndexError) as error:
+            self.__class__.logger.warning('Invalid datagram from %s: %s', addr, error)
+            _invalid.inc()
+            return 0
+        _received.inc(len(measurements))
+        recorded = 0
+        for measurement in measurements:
+            if measurement.source not in self.__recent:
+                self.__recent[measurement.source] = _RecentTimestamps(self.__dedup_window)
+            if not self.__recent[measurement.source].add(measurement.timestamp):
+                _duplicated.inc()
+                continue
+            filtered = apply_filters(self.__filters, measurement)
+            if filtered is None:
+                continue
+            for recorder in self.__recorders:
+                recorder.record(filtered)
+            recorded += 1
+        return recorded
+
+    def __allowed(self, addr: Optional[Tuple[str, int]]) -> bool:
+        if addr is None:
+            return False
+        try:
+            host = ipaddress.ip_address(addr[0])
+        except ValueError:
+            return False
+        return any(host in network for network in self.__allowed_networks)
+
+    def flush(self):
+        """Flush the recorders"""
+        for recorder in self.__recorders:
+            recorder.flush()
+
+    async def start(self, address: str = '127.0.0.1', port: int = 8100) -> Tuple[str, int]:
+        """Start receiving datagrams on the running event loop, returning
+        the address and port the gateway listens on"""
+        loop = asyncio.get_running_loop()
+        transport, _protocol = await loop.create_datagram_endpoint(
+            lambda: _GatewayProtocol(self), local_addr=(address, port))
+        self.__transport = transport
+        sock = transport.get_extra_info('socket')
+        # Room for bursts of datagrams while the event loop is busy recording
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.__receive_buffer_size)
+        host, port = sock.getsockname()[:2]
+        self.__class__.logger.info('Gateway listening on %s:%d', host, port)
+        if self.__secret is None and len(self.__allowed_networks) == 0 and \
+            not ipaddress.ip_address(host).is_loopback:
+            self.__class__.logger.warning('Gateway accepting measurements from any sender, '
+                                          'configure a secret or allowed networks')
+        return str(host), int(port)
+
+    def close(self):
+        """Stop receiving datagrams"""
+        if self.__transport is not None:
+            self.__transport.close()
+            self.__transport = None
+
+    async def serve(self, address: str = '127.0.0.1', port: int = 8100):
+        """Receive datagrams, flushing the recorders each `flush_interval`
+        seconds, until cancelled. The recorders are also flushed when cancelled"""
+        await self.start(address, port)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(self.__flush_interval)
+                await loop.run_in_executor(None, self.flush)
+        finally:
+            self.close()
+            await loop.run_in_executor(None, self.flush)
+
+
+class GatewayMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-many-instance-attributes
+    """A MeasurementRecorder that pushes the measurements to a Gateway.
+
+    Measurements are buffered in memory and sent when either `batch_size`
+    measurements are buffered, the oldest buffered measurement is older than
+    `max_batch_age` seconds, or on flush. The measurements of each source are
+    sent as a frame rounded to `precision` decimal digits, in datagrams of at most
+    `max_datagram_size` bytes, by default so they fit in the MTU of the network.
+    UDP doesn't retry lost datagrams, and failures to send are only logged and
+    counted, so measurements might be lost while the gateway is not reachable.
+    With a `secret` shared with the gateway, each datagram is signed
+    """
+    logger = logging.getLogger('GatewayMeasurementRecorder')
+
+    def __init__(self, address: str, port: int = 8100, *, # pylint: disable=too-many-arguments
+                 batch_size: int = 10, max_batch_age: Optional[float] = None,
+                 precision: int = 2, max_datagram_size: int = 1400,
+                 timer: Timer = _timer, secret: Optional[bytes] = None):
+        family, kind, proto, _name, sockaddr = \
+            socket.getaddrinfo(address, port, type=socket.SOCK_DGRAM)[0]
+        self.__socket = socket.socket(family, kind, proto)
+        self.__address = sockaddr
+        self.__batch_size = batch_size
+        self.__max_batch_age = max_batch_age
+        self.__precision = precision
+        self.__secret = secret
+        # Room for the signature in the datagrams
+        self.__max_datagram_size = max_datagram_size - (SIGNATURE_SIZE if secret is not None else 0)
+        self.__timer = timer
+        self.__buffer: List[TempMeasurement] = []
+        self.__oldest_buffered_time = 0.0
+
+    def __frames(self, source: str, measurements: Sequence[TempMeasurement]) -> List[bytes]:
+        """Frames of at most the maximum datagram size, if possible"""
+        frame = encode_frame(source, measurements, self.__precision)
+        if len(frame) <= self.__max_datagram_size or len(measurements) == 1:
+            return [frame]
+        half = len(measurements) // 2
+        return self.__frames(source, measurements[:half]) + \
+            self.__frames(source, measurements[half:])
+
+    def __datagrams(self) -> List[bytes]:
+        by_source: Dict[str, List[TempMeasurement]] = {}
+        for measurement in self.__buffer:
+            by_source.setdefault(measurement.source, []).append(measurement)
+        datagrams: List[bytes] = []
+        datagram = b''
+        for source, measurements in by_source.items():
+            for frame in self.__frames(source, measurements):
+                if len(datagram) > 0 and len(datagram) + len(frame) > self.__max_datagram_size:
+                    datagrams.append(datagram)
+                    datagram = b''
+                datagram += frame
+        if len(datagram) > 0:
+            datagrams.append(datagram)
+        return datagrams
+
+    def record(self, measurement: TempMeasurement):
+        if len(self.__buffer) == 0:
+            self.__oldest_buffered_time = self.__timer.time()
+        self.__buffer.append(measurement)
+        if len(self.__buffer) >= self.__batch_size or \
+            (self.__max_batch_age is not None and
+             self.__timer.time() - self.__oldest_buffered_time >= self.__max_batch_age):
+            self.flush()
+
+    def flush(self):
+        """Send the buffered measurements"""
+        if len(self.__buffer) == 0:
+            return
+        datagrams = self.__datagrams()
+        self.__buffer = []
+        for datagram in datagrams:
+            if self.__secret is not None:
+                datagram = sign(self.__secret, datagram) + datagram
+            try:
+                self.__socket.sendto(datagram, self.__address)
+                _sent.inc()
+            except OSError as os_error:
+                self.__class__.logger.error('Failed to send %d bytes to the gateway %s: %s',
+                    len(datagram), self.__address, os_error)
+                _send_failures.inc()
+
+    def close(self):
+        """Flush, and close the socket"""
+        self.flush()
+        self.__socket.close()
@@ -0,0 +1,221 @@
+"""
+In-memory history of the latest measurements of each source, stored
+by column in fixed size ring buffers
+"""
+
+import threading
+from array import array
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from .types import TempMeasurement, TempStatistics, StatisticSet
+from .types import MeasurementQuery, MeasurementRecorder
+from .aggregation import aggregate, window_start
+
+
+class Columns(NamedTuple):
+    """Views of the timestamps, temperatures and humidities of some
+    consecutive measurements"""
+    timestamps: memoryview
+    temperatures: memoryview
+    humidities: memoryview
+
+
+class MeasurementRing:
+    """A ring buffer with the latest `capacity` rows of a series, where
+    each row has a timestamp and some values.
+
+    The timestamps and each of the values are stored on preallocated typed
+    arrays, so e.g. a measurement takes 24 bytes, and appending is O(1).
+    `value_typecodes` are the `array` type codes of the values. Rows are
+    expected in timestamp order: a row older than the latest one is
+    discarded. Rows on a time range are found with a binary search, and
+    returned as views of the arrays without copying them. These views are
+    overwritten by later appends once the ring wraps around, so they should
+    be consumed right away
+    """
+    def __init__(self, capacity: int, value_typecodes: str = 'dd'):
+        if capacity <= 0:
+            raise ValueError(f"Invalid ring capacity {capacity}")
+        self.__columns: List[array] = [
+            array(typecode, bytes(array(typecode).itemsize * capacity))
+            for typecode in 'q' + value_typecodes]
+        # Physical index of the oldest row
+        self.__start = 0
+        self.__size = 0
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of rows kept"""
+        return len(self.__columns[0])
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __index(self, position: int) -> int:
+        """Physical index of the row on a position, starting
+        at the oldest row"""
+        return (self.__start + position) % self.capacity
+
+    def last(self) -> Optional[tuple]:
+        """The latest row, as a tuple of the timestamp and the values"""
+        if self.__size == 0:
+            return None
+        index = self.__index(self.__size - 1)
+        return tuple(column[index] for column in self.__columns)
+
+    def append(self, timestamp: int, *values: float) -> bool:
+        """Add a row, evicting the oldest one if the ring is full.
+        Returns whether the row was added"""
+        if self.__size > 0 and timestamp < self.__columns[0][self.__index(self.__size - 1)]:
+            return False
+        if self.__size < self.capacity:
+            index = self.__index(self.__size)
+            self.__size += 1
+        else:
+            index = self.__start
+            self.__start = self.__index(1)
+        for column, value in zip(self.__columns, (timestamp,) + values):
+            column[index] = value
+        return True
+
+    def update_last(self, *values: float):
+        """Replace the values of the latest row"""
+        index = self.__index(self.__size - 1)
+        for column, value in zip(self.__columns[1:], values):
+            column[index] = value
+
+    def __bisect(self, timestamp: int) -> int:
+        """Position of the first row with a timestamp not before `timestamp`"""
+        timestamps = self.__columns[0]
+        low, high = 0, self.__size
+        while low < high:
+            middle = (low + high) // 2
+            if timestamps[self.__index(middle)] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def slices(self, start: int, end: int) -> List[Tuple[memoryview, ...]]:
+        """Views of the columns of the rows with timestamp in [start, end),
+        from oldest to newest. As the rows might wrap around the end of
+        the arrays, they are returned as up to two chunks"""
+        first, last = self.__bisect(start), self.__bisect(end)
+        if first >= last:
+            return []
+        first_index, last_index = self.__index(first), self.__index(last - 1) + 1
+        if first_index < last_index:
+            ranges = [(first_index, last_index)]
+        else:
+            ranges = [(first_index, self.capacity), (0, last_index)]
+        return [tuple(memoryview(column)[low:high] for column in self.__columns)
+                for low, high in ranges]
+
+
+# Values of a rollup row: measurement count, and then the minimum, maximum
+# and sum of the temperatures and of the humidities
+_ROLLUP_TYPECODES = 'qdddddd'
+
+def _rollup_row(statistics: TempStatistics) -> Tuple[float, ...]:
+    return (statistics.temperature.count,
+            statistics.temperature.minimum, statistics.temperature.maximum,
+            statistics.temperature.sum,
+            statistics.humidity.minimum, statistics.humidity.maximum,
+            statistics.humidity.sum)
+
+def _rollup_statistics(source: str, row: Sequence) -> TempStatistics:
+    timestamp, count, t_min, t_max, t_sum, h_min, h_max, h_sum = row
+    return TempStatistics(source, int(timestamp),
+                          StatisticSet(t_min, t_max, t_sum, int(count)),
+                          StatisticSet(h_min, h_max, h_sum, int(count)))
+
+
+class MeasurementHistory(MeasurementRecorder, MeasurementQuery):
+    """A MeasurementRecorder that keeps the latest `capacity` measurements
+    of each source in a MeasurementRing, to look at more than the latest
+    measurement.
+
+    The history also keeps rollups with the statistics of the measurements
+    over time windows, updated incrementally on each measurement, so long
+    time ranges are queried without going through the measurements. `rollups`
+    are pairs of a window in seconds and the number of windows kept for each
+    source, by default a week of minutes and a year of hours. Each window takes
+    64 bytes. It is safe to record and query from different threads
+    """
+
+    def __init__(self, capacity: int = 24 * 60 * 60,
+                 rollups: Sequence[Tuple[int, int]] = ((60, 7 * 24 * 60),
+                                                       (60 * 60, 366 * 24))):
+        self.__capacity = capacity
+        self.__rollup_capacities = dict(rollups)
+        self.__rings: Dict[str, MeasurementRing] = {}
+        self.__rollups: Dict[int, Dict[str, MeasurementRing]] = \
+            {window: {} for window in self.__rollup_capacities}
+        self.__lock = threading.Lock()
+
+    def sources(self) -> List[str]:
+        with self.__lock:
+            return sorted(self.__rings)
+
+    def record(self, measurement: TempMeasurement):
+        with self.__lock:
+            if measurement.source not in self.__rings:
+                self.__rings[measurement.source] = MeasurementRing(self.__capacity)
+            if not self.__rings[measurement.source].append(
+                    measurement.timestamp, measurement.temperature, measurement.humidity):
+                return
+            for window, rings in self.__rollups.items():
+                if measurement.source not in rings:
+                    rings[measurement.source] = MeasurementRing(
+                        self.__rollup_capacities[window], _ROLLUP_TYPECODES)
+                self.__update_rollup(rings[measurement.source], window, measurement)
+
+    @staticmethod
+    def __update_rollup(ring: MeasurementRing, window: int, measurement: TempMeasurement):
+        start = window_start(measurement.timestamp, window)
+        last = ring.last()
+        if last is not None and last[0] == start:
+            statistics = _rollup_statistics(measurement.source, last)
+            statistics.add(measurement)
+            ring.update_last(*_rollup_row(statistics))
+        else:
+            statistics = TempStatistics(measurement.source, start)
+            statistics.add(measurement)
+            ring.append(start, *_rollup_row(statistics))
+
+    def columns(self, source: str, start: int, end: int) -> Columns:
+        """Copies of the columns of the measurements of a source with
+        timestamp in [start, end)"""
+        copies: List[array] = [array('q'), array('d'), array('d')]
+        with self.__lock:
+            ring = self.__rings.get(source)
+            for chunk in ring.slices(start, end) if ring is not None else []:
+                for copy, view in zip(copies, chunk):
+                    copy.frombytes(view.cast('B'))
+        return Columns(*(memoryview(copy) for copy in copies))
+
+    def measurements(self, source: str, start: int, end: int) -> Iterator[TempMeasurement]:
+        timestamps, temperatures, humidities = self.columns(source, start, end)
+        for timestamp, temperature, humidity in zip(timestamps, temperatures, humidities):
+            yield TempMeasurement(source, timestamp, temperature, humidity)
+
+    def statistics(self, source: str, start: int, end: int,
+                   step: int) -> List[TempStatistics]:
+        """Statistics per window of `step` seconds. These are computed from
+        the coarsest rollup with a window that divides `step`, or from the
+        measurements if there is no such rollup"""
+        windows = [window for window in self.__rollups if step % window == 0]
+        if len(windows) == 0:
+            return aggregate(list(self.measurements(source, start, end)), step)
+        window = max(windows)
+        statistics: Dict[int, TempStatistics] = {}
+        with self.__lock:
+            ring = self.__rollups[window].get(source)
+            for chunk in ring.slices(start, end) if ring is not None else []:
+                for row in zip(*chunk):
+                    rollup = _rollup_statistics(source, row)
+                    step_start = window_start(rollup.timestamp, step)
+                    if step_start not in statistics:
+                        statistics[step_start] = TempStatistics(source, step_start)
+                    statistics[step_start].merge(rollup)
+        return list(statistics.values())
@@ -0,0 +1,121 @@
+"""
+Profiling of the actions of the agent, to find out where the time and
+the memory go on an agent running on the field
+"""
+
+import cProfile
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from typing import Callable
+from urllib.parse import quote
+
+
+class Profiler: # pylint: disable=too-many-instance-attributes
+    """Profiles some runs of actions wrapped with `wrap`, writing a file
+    per profiled run to `directory`.
+
+    With mode 'cprofile' the file has the cProfile stats of the run, that
+    can be loaded with `pstats.Stats`, and with mode 'tracemalloc' it has a
+    tracemalloc snapshot of the memory allocated since the profiler was
+    created, with `frames` frames per allocation, that can be loaded with
+    `tracemalloc.Snapshot.load`. Tracing the allocations slows down the
+    whole process, so that mode should only be enabled to look for leaks.
+
+    A run is profiled each `every` runs, if `every` is positive, and after
+    `request` is called, e.g. from a signal handler. Only one run is profiled
+    at a time, and only the latest `max_files` files are kept. Actions that
+    are not wrapped are not affected by the profiler. `stop` should be called
+    on shutdown, so a run being profiled is written out
+    """
+    logger = logging.getLogger('Profiler')
+    modes = ('cprofile', 'tracemalloc')
+
+    def __init__(self, directory: str, mode: str = 'cprofile', *, # pylint: disable=too-many-arguments
+                 every: int = 0, max_files: int = 10, frames: int = 1):
+        if mode not in self.__class__.modes:
+            raise ValueError(f"Unknown profiling mode {mode}")
+        self.__directory = directory
+        self.__mode = mode
+        self.__every = every
+        self.__max_files = max_files
+        self.__lock = threading.Condition()
+        self.__runs = 0
+        self.__requested = False
+        self.__profiling = False
+        self.__stopped = False
+        os.makedirs(directory, exist_ok=True)
+        if mode == 'tracemalloc':
+            tracemalloc.start(frames)
+
+    def request(self):
+        """Profile the next run. This only sets a flag, so it is safe
+        to call it from a signal handler"""
+        self.__requested = True
+
+    def stop(self, timeout: float = 10.0):
+        """Wait up to `timeout` seconds for the run being profiled, if any, to
+        finish and be written out, and then stop tracing the memory
+        allocations, if tracing them. Later runs are not profiled"""
+        with self.__lock:
+            self.__every = 0
+            self.__requested = False
+            if not self.__lock.wait_for(lambda: not self.__profiling, timeout):
+                self.__class__.logger.warning('Timeout waiting for the profiled run')
+            self.__stopped = True
+        if self.__mode == 'tracemalloc' and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def wrap(self, action: Callable[[], None], name: str) -> Callable[[], None]:
+        """Wrap an action so its runs are profiled. `name` is used as the prefix
+        of the files of the profiles"""
+        def profiled_action():
+            with self.__lock:
+                self.__runs += 1
+                run = self.__runs
+                sampled = self.__every > 0 and run % self.__every == 0
+                profile = (sampled or self.__requested) and not self.__profiling \
+                    and not self.__stopped
+                if profile:
+                    self.__requested = False
+                    self.__profiling = True
+            if not profile:
+                action()
+                return
+            try:
+                self.__profile(action, name, run)
+            finally:
+                with self.__lock:
+                    self.__profiling = False
+                    self.__lock.notify_all()
+        return profiled_action
+
+    def __profile(self, action: Callable[[], None], name: str, run: int):
+        path = os.path.join(self.__directory, '-'.join([
+            quote(name, safe=''), time.strftime('%Y%m%dT%H%M%S', time.gmtime()), str(run)]))
+        try:
+            if self.__mode == 'cprofile':
+                path += '.pstats'
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(action)
+                finally:
+                    profile.dump_stats(path)
+            else:
+                path += '.snapshot'
+                try:
+                    action()
+                finally:
+                    tracemalloc.take_snapshot().dump(path)
+        finally:
+            self.__class__.logger.info('Wrote profile %s', path)
+            self.__remove_old_files()
+
+    def __remove_old_files(self):
+        paths = [entry.path for entry in os.scandir(self.__directory)
+                 if entry.name.endswith(('.pstats', '.snapshot'))]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(len(paths) - self.__max_files, 0)]:
+            os.remove(path)
@@ -0,0 +1,342 @@
+"""
+Prometheus remote write sink, that pushes the measurements to Prometheus
+with their timestamps, instead of waiting to be scraped, so agents behind
+NAT or on flaky links don't leave gaps.
+
+The protocol is a `WriteRequest` protobuf message compressed with the block
+format of snappy, posted over HTTP, see
+https://prometheus.io/docs/concepts/remote_write_spec/. The few protobuf
+messages of the protocol are encoded by hand, and snappy is implemented in
+pure Python, using the python-snappy package instead if it is installed
+"""
+
+import http.client
+import logging
+import random
+import socket
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter
+
+from .types import RetryPolicy, TempMeasurement, MeasurementRecorder, Timer, TimeTimer
+
+try:
+    import snappy as _snappy # python-snappy, optional
+except ImportError:
+    _snappy = None
+
+_timer = TimeTimer()
+_sent_samples: Counter = Counter("tempd_remote_write_sent_samples",
+    "samples pushed with Prometheus remote write")
+_dropped_samples: Counter = Counter("tempd_remote_write_dropped_samples",
+    "samples discarded because the buffer was full, or rejected by the receiver")
+_retries: Counter = Counter("tempd_remote_write_retries",
+    "Prometheus remote write requests retried")
+_sent_bytes: Counter = Counter("tempd_remote_write_sent_bytes",
+    "bytes of the bodies of the Prometheus remote write requests, after compression")
+_connections: Counter = Counter("tempd_remote_write_connections",
+    "connections opened to the Prometheus remote write receiver")
+
+_Labels = Tuple[Tuple[str, str], ...]
+_Sample = Tuple[float, int]
+_DOUBLE = struct.Struct('<d')
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _length_delimited(field_number: int, payload: bytes) -> bytes:
+    return _varint(field_number << 3 | 2) + _varint(len(payload)) + payload
+
+def encode_write_request(series: Dict[_Labels, List[_Sample]]) -> bytes:
+    """Encode a `WriteRequest` protobuf message with a time series per set of
+    labels, with its (value, timestamp in milliseconds) samples. Labels must
+    be sorted by name, and samples by timestamp, as the protocol requires"""
+    request = bytearray()
+    for labels, samples in series.items():
+        time_series = bytearray()
+        for name, label_value in labels:
+            time_series += _length_delimited(1, _length_delimited(1, name.encode('utf-8')) +
+                                             _length_delimited(2, label_value.encode('utf-8')))
+        for value, timestamp in samples:
+            # A double value is field 1 with wire type 1, and an int64 timestamp
+            # is field 2 with wire type 0, as two's complement if negative
+            time_series += _length_delimited(2, b'\x09' + _DOUBLE.pack(value) +
+                                             b'\x10' + _varint(timestamp & (2 ** 64 - 1)))
+        request += _length_delimited(1, bytes(time_series))
+    return bytes(request)
+
+
+def _snappy_literal(data: bytes) -> bytes:
+    length = len(data) - 1
+    if length < 60:
+        return bytes([length << 2]) + data
+    size = (length.bit_length() + 7) // 8
+    return bytes([(59 + size) << 2]) + length.to_bytes(size, 'little') + data
+
+def snappy_compress(data: bytes) -> bytes:
+    """Compress with the block format of snappy, see
+    https://github.com/google/snappy/blob/main/format_description.txt"""
+    if _snappy is not None:
+        compressed: bytes = _snappy.compress(data)
+        return compressed
+    output = bytearray(_varint(len(data)))
+    table: Dict[bytes, int] = {}
+    literal_start, position, misses = 0, 0, 0
+    while position + 4 <= len(data):
+        key = data[position:position + 4]
+        candidate = table.get(key)
+        table[key] = position
+        if candidate is None or position - candidate > 0xFFFF:
+            # Like snappy, skip faster through data that doesn't compress
+            misses += 1
+            position += 1 + (misses >> 5)
+            continue
+        misses = 0
+        length = 4
+        while position + length < len(data) and \
+            data[candidate + length] == data[position + length]:
+            length += 1
+        if literal_start < position:
+            output += _snappy_literal(data[literal_start:position])
+        offset = position - candidate
+        position += length
+        literal_start = position
+        while length > 0:
+            # Copies with a 2 bytes offset, of up to 64 bytes
+            chunk = min(length, 64)
+            output += bytes([(chunk - 1) << 2 | 2]) + offset.to_bytes(2, 'little')
+            length -= chunk
+    if literal_start < len(data):
+        output += _snappy_literal(data[literal_start:])
+    return bytes(output)
+
+def snappy_decompress(data: bytes) -> bytes:
+    """Decompress the block format of snappy"""
+    if _snappy is not None:
+        decompressed: bytes = _snappy.decompress(data)
+        return decompressed
+    length, shift, position = 0, 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    output = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 3
+        if kind == 0:
+            literal_length = tag >> 2
+            if literal_length >= 60:
+                size = literal_length - 59
+                literal_length = int.from_bytes(data[position:position + size], 'little')
+                position += size
+            literal_length += 1
+            output += data[position:position + literal_length]
+            position += literal_length
+            continue
+        if kind == 1:
+            copy_length = ((tag >> 2) & 7) + 4
+            offset = (tag >> 5) << 8 | data[position]
+            position += 1
+        else:
+            copy_length = (tag >> 2) + 1
+            size = 2 if kind == 2 else 4
+            offset = int.from_bytes(data[position:position + size], 'little')
+            position += size
+        if not 0 < offset <= len(output):
+            raise ValueError(f"Invalid snappy copy offset {offset}")
+        for _ in range(copy_length):
+            output.append(output[-offset])
+    if len(output) != length:
+        raise ValueError(f"Invalid snappy length {len(output)}, expected {length}")
+    return bytes(output)
+
+
+class RemoteWriteError(Exception):
+    """A remote write request failed with an HTTP error status"""
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+    @property
+    def retryable(self) -> bool:
+        """Whether the request might succeed if retried, as only server
+        errors and throttling should be retried"""
+        return self.status >= 500 or self.status == 429
+
+
+class RemoteWriteMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-many-instance-attributes
+    """A MeasurementRecorder that pushes the measurements to Prometheus with
+    remote write, as samples of the `tempd_temperature` and `tempd_humidity`
+    series of PrometheusMeasurementRecorder, labeled with the source and
+    `labels`, at the timestamp of the measurement. By default the labels are
+    the job `tempd_remote_write` and the hostname as instance, so the pushed
+    series don't collide with the series scraped from the same agent, that
+    have the job of the scrape config.
+
+    Samples are buffered in memory and pushed when either `batch_size`
+    measurements are buffered or the oldest buffered measurement is older than
+    `max_batch_age` seconds, with up to `max_samples_per_request` samples per
+    request. Failed requests are retried according to `retry_policy`, and
+    then the samples are kept in the buffer for the next flush, up to
+    `max_buffered_samples`, discarding the oldest samples beyond that. Samples
+    rejected by the receiver with a 4XX status other than 429 are discarded,
+    as retrying them would fail again. The connection to the receiver is kept
+    alive between requests, unless the receiver closes it
+    """
+    temperature_metric_name = 'tempd_temperature'
+    humidity_metric_name = 'tempd_humidity'
+    default_job = 'tempd_remote_write'
+    logger = logging.getLogger('RemoteWriteMeasurementRecorder')
+
+    def __init__(self, url: str, *, # pylint: disable=too-many-arguments
+                 labels: Optional[Dict[str, str]] = None,
+                 batch_size: int = 10, max_batch_age: Optional[float] = None,
+                 max_samples_per_request: int = 2000, max_buffered_samples: int = 20000,
+                 retry_policy: RetryPolicy = RetryPolicy(), timeout: float = 10.0,
+                 timer: Timer = _timer):
+        self.__url = url
+        parts = urlsplit(url)
+        self.__https = parts.scheme != 'http'
+        self.__host = parts.hostname or ''
+        self.__port = parts.port
+        self.__path = parts.path or '/'
+        self.__connection: Optional[http.client.HTTPConnection] = None
+        self.__labels = labels if labels is not None else \
+            {'job': self.__class__.default_job, 'instance': socket.gethostname()}
+        self.__batch_size = batch_size
+        self.__max_batch_age = max_batch_age
+        self.__max_samples_per_request = max_samples_per_request
+        self.__max_buffered_samples = max_buffered_samples
+        self.__retry_policy = retry_policy
+        self.__timeout = timeout
+        self.__timer = timer
+        self.__random = random.Random()
+        self.__buffer: List[Tuple[_Labels, _Sample]] = []
+        self.__buffered_measurements = 0
+        self.__oldest_buffered_time = 0.0
+
+    def __series_labels(self, metric_name: str, source: str) -> _Labels:
+        return tuple(sorted({**self.__labels, '__name__': metric_name,
+                             'source': source}.items()))
+
+    def record(self, measurement: TempMeasurement):
+        if len(self.__buffer) == 0:
+            self.__oldest_buffered_time = self.__timer.time()
+        timestamp = int(measurement.timestamp * 1000)
+        self.__buffer.append((self.__series_labels(self.__class__.temperature_metric_name,
+                                                   measurement.source),
+                              (measurement.temperature, timestamp)))
+        self.__buffer.append((self.__series_labels(self.__class__.humidity_metric_name,
+                                                   measurement.source),
+                              (measurement.humidity, timestamp)))
+        self.__buffered_measurements += 1
+        overflow = len(self.__buffer) - self.__max_buffered_samples
+        if overflow > 0:
+            self.__class__.logger.warning('Discarding %d buffered samples', overflow)
+            _dropped_samples.inc(overflow)
+            del self.__buffer[:overflow]
+        if self.__buffered_measurements >= self.__batch_size or \
+            (self.__max_batch_age is not None and
+             self.__timer.time() - self.__oldest_buffered_time >= self.__max_batch_age):
+            self.flush()
+
+    def __connect(self) -> Tuple[http.client.HTTPConnection, bool]:
+        if self.__connection is not None:
+            return self.__connection, True
+        connection_class = http.client.HTTPSConnection if self.__https \
+            else http.client.HTTPConnection
+        self.__connection = connection_class(self.__host, self.__port, timeout=self.__timeout)
+        _connections.inc()
+        return self.__connection, False
+
+    def __post(self, body: bytes):
+        while True:
+            connection, reused = self.__connect()
+            try:
+                connection.request('POST', self.__path, body, {
+                    'Content-Encoding': 'snappy',
+                    'Content-Type': 'application/x-protobuf',
+                    'User-Agent': 'tempd',
+                    'X-Prometheus-Remote-Write-Version': '0.1.0'
+                })
+                response = connection.getresponse()
+                output = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if reused:
+                    # The receiver closed the idle connection, so it didn't get the request
+                    continue
+                raise
+            except BaseException:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            break
+        _sent_bytes.inc(len(body))
+        if response.status >= 300:
+            raise RemoteWriteError(response.status,
+                                   output.decode('utf-8', errors='replace')[:200])
+
+    def __send(self, body: bytes):
+        policy = self.__retry_policy
+        for attempt in range(1, policy.max_attempts + 1):
+            try:
+                self.__post(body)
+                return
+            except (RemoteWriteError, OSError, http.client.HTTPException) as error:
+                retryable = not isinstance(error, RemoteWriteError) or \
+                    (error.retryable and (policy.retry_throttling or error.status != 429))
+                if not retryable or attempt == policy.max_attempts:
+                    raise
+                delay = policy.delay(attempt - 1, self.__random.random())
+                self.__class__.logger.warning('Retrying remote write in %.2f seconds: %s',
+                                              delay, error)
+                _retries.inc()
+                self.__timer.sleep(delay)
+
+    def __push(self, samples: Sequence[Tuple[_Labels, _Sample]]):
+        series: Dict[_Labels, List[_Sample]] = {}
+        for labels, sample in samples:
+            series.setdefault(labels, []).append(sample)
+        for series_samples in series.values():
+            series_samples.sort(key=lambda sample: sample[1])
+        try:
+            self.__send(snappy_compress(encode_write_request(series)))
+        except RemoteWriteError as error:
+            if error.retryable:
+                raise
+            self.__class__.logger.error('Discarding %d samples rejected by %s: %s',
+                                        len(samples), self.__url, error)
+            _dropped_samples.inc(len(samples))
+            return
+        _sent_samples.inc(len(samples))
+        self.__class__.logger.info('%d samples pushed with remote write', len(samples))
+
+    def flush(self):
+        """Push all the buffered samples, using as few requests as possible"""
+        max_samples = self.__max_samples_per_request
+        while len(self.__buffer) > 0:
+            samples = self.__buffer[:max_samples]
+            self.__push(samples)
+            del self.__buffer[:len(samples)]
+        self.__buffered_measurements = 0
+
+    def close(self):
+        """Close the connection kept alive"""
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
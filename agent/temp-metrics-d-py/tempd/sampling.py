@@ -0,0 +1,71 @@
+"""
+Adaptive sampling, to measure more often while the measurements change,
+and less often while they are flat
+"""
+
+import logging
+import statistics
+from collections import deque
+from typing import Deque
+
+from .types import TempMeasurement
+
+
+class AdaptiveSampling: # pylint: disable=too-many-instance-attributes
+    """Decides the period between the measurements of a source from the
+    variability of its latest `window_size` measurements.
+
+    The variability is the standard deviation of the temperatures and of the
+    humidities in the window, relative to `temperature_threshold` and
+    `humidity_threshold`. When any of them is over its threshold the period is
+    divided by `factor`, and when both are under half their threshold on a full
+    window the period is multiplied by `factor`. The window is cleared after
+    a longer period is chosen, so the period only grows again after a full
+    window of flat measurements at the new period, while it keeps shrinking
+    on each measurement while the measurements change. The period is always
+    between `min_period` and `max_period` seconds
+    """
+    logger = logging.getLogger('AdaptiveSampling')
+
+    def __init__(self, period: float, min_period: float, max_period: float, *, # pylint: disable=too-many-arguments
+                 window_size: int = 10, temperature_threshold: float = 0.5,
+                 humidity_threshold: float = 2.0, factor: float = 2.0):
+        if not 0 < min_period <= max_period:
+            raise ValueError(f"Invalid period range [{min_period}, {max_period}]")
+        self.__min_period = min_period
+        self.__max_period = max_period
+        self.__period = self.__clamp(period)
+        self.__temperature_threshold = temperature_threshold
+        self.__humidity_threshold = humidity_threshold
+        self.__factor = factor
+        self.__temperatures: Deque[float] = deque(maxlen=window_size)
+        self.__humidities: Deque[float] = deque(maxlen=window_size)
+
+    @property
+    def period(self) -> float:
+        """Current period between measurements in seconds"""
+        return self.__period
+
+    def __clamp(self, period: float) -> float:
+        return min(max(period, self.__min_period), self.__max_period)
+
+    def update(self, measurement: TempMeasurement) -> float:
+        """Add a measurement, returning the period until the next measurement"""
+        self.__temperatures.append(measurement.temperature)
+        self.__humidities.append(measurement.humidity)
+        if len(self.__temperatures) < 2:
+            return self.__period
+        variability = max(statistics.pstdev(self.__temperatures) / self.__temperature_threshold,
+                          statistics.pstdev(self.__humidities) / self.__humidity_threshold)
+        period = self.__period
+        if variability > 1:
+            period = self.__clamp(period / self.__factor)
+        elif variability < 0.5 and len(self.__temperatures) == self.__temperatures.maxlen:
+            period = self.__clamp(period * self.__factor)
+            self.__temperatures.clear()
+            self.__humidities.clear()
+        if period != self.__period:
+            self.__class__.logger.info('Changing the period of %s from %s to %s seconds',
+                measurement.source, self.__period, period)
+            self.__period = period
+        return period
@@ -23,6 +23,8 @@ class Sensor(TempSensor): # pylint: disable=too-few-public-methods
         - Temperature read precision of +/- 2 degree, fraction temperature is always 0
 
         https://wiki.seeedstudio.com/Grove-TemperatureAndHumidity_Sensor/"""
+    min_period = 5.0
+
     def __init__(self, sensor_port: int, sensor_type: int):
         """
         Args:
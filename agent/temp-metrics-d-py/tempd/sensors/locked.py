@@ -0,0 +1,25 @@
+"""Locked sensor
+Wrapper for sensors that share a bus with other sensors, so only one
+of them uses the bus at a time.
+"""
+
+import threading
+from .types import TempMeasurement, TempSensor
+
+class Sensor(TempSensor): # pylint: disable=too-few-public-methods
+    """A sensor that holds a lock while measuring with another sensor"""
+    def __init__(self, sensor: TempSensor, lock: threading.Lock):
+        """
+        Args:
+            sensor: the sensor used to measure
+            lock: lock shared by all the sensors of the same bus
+        """
+        self.__sensor = sensor
+        self.__lock = lock
+        self.min_period = sensor.min_period
+        self.max_period = sensor.max_period
+
+    def measure(self) -> TempMeasurement:
+        """Get a measurement from the wrapped sensor, holding the lock"""
+        with self.__lock:
+            return self.__sensor.measure()
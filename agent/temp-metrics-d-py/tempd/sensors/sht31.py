@@ -8,7 +8,9 @@ References:
 """
 import os
 import time
-from retrying import retry
+from typing import Any, List, Optional, Sequence, Tuple, cast
+from retrying import Retrying
+from prometheus_client import Counter, Histogram
 from .types import TempMeasurement, TempSensor
 from . import fake
 
@@ -21,52 +23,219 @@ def is_rpi():
         return line.startswith('Raspberry Pi')
     return False
 
-class Sensor(TempSensor): # pylint: disable=too-few-public-methods
+def crc8(data: Sequence[int]) -> int:
+    """CRC-8 checksum used by the SHT31 for each 2 bytes word, with
+    polynomial 0x31 and initialization 0xFF"""
+    crc = 0xFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+class ChecksumError(Exception):
+    """The data read from the sensor doesn't match its checksum"""
+
+class Sensor(TempSensor): # pylint: disable=too-few-public-methods,too-many-instance-attributes
     """A temperature meter based on the DHT11 sensor. This sensor has
     2 decimal precision for temperature, but it's not very stable:
 
     - Sometimes it fails to measure with "OSError: [Errno 121] Remote I/O error",
     this is an error documented in several internet forums. Mitigated by
-    retrying the measure after a small wait
+    retrying the measure with an exponential backoff, for at most
+    `retry_budget` seconds. Failed reads are counted in the
+    `tempd_sht31_read_errors` Prometheus counter, and the failed reads of
+    each measurement are observed in the `tempd_sht31_read_retries` histogram
     - There are occasional spikes in the measurements, specially for the humidity.
+    Some are caused by corrupted reads, that are detected by checking the CRC
+    of the data, and retried like other read errors.
+
+    By default each measurement is taken with a single shot measurement
+    command. In deferred mode a measurement command is sent after each read,
+    and its result is read on the next call to `measure`, so measuring
+    doesn't wait for the sensor. Note this means each measurement is
+    taken one period before it's returned.
+
+    In periodic mode the sensor measures on its own with `periodic_mps`
+    measurements per second, or at 4 measurements per second with
+    accelerated response time (ART) if `art` is true, and each call to
+    `measure` just fetches the latest measurement. The first fetch waits for
+    a full period after starting the periodic mode, as the sensor NACKs
+    fetches while it has no data. Failed fetches are retried without
+    restarting the periodic mode, that is only restarted after
+    `MAX_FETCH_FAILURES` fetches in a row fail, e.g. if the sensor was reset.
+    `repeatability` ('high', 'medium' or 'low') trades precision for
+    measurement time.
+
+    See the datasheet at https://sensirion.com/media/documents/213E6A3B/63A5A569/Datasheet_SHT3x_DIS.pdf # pylint: disable=line-too-long
 
     Adapted from https://github.com/ControlEverythingCommunity/SHT31/blob/master/Python/SHT31.py
     and https://wiki.seeedstudio.com/Grove-TempAndHumi_Sensor-SHT31/#software_1
     """
     __is_rpi = is_rpi()
-    __SENSOR_ADDRESS = 0x44 # SHT31 address
-    __SEND_MEASUREMENT_CMD = 0x2C # Send measurement command
-    __SEND_MEASUREMENT_CMD_ARGS = [0x06] # High repeatability measurement
+    DEFAULT_ADDRESS = 0x44 # SHT31 address, 0x45 when the ADDR pin is high
+    __SEND_MEASUREMENT_CMD = 0x2C # Send measurement command, with clock stretching
+    __SEND_MEASUREMENT_CMD_ARGS = {'high': [0x06], 'medium': [0x0D], 'low': [0x10]}
+    # Periodic measurement commands, by measurements per second and repeatability
+    __PERIODIC_MEASUREMENT_CMDS = {
+        0.5: (0x20, {'high': [0x32], 'medium': [0x24], 'low': [0x2F]}),
+        1: (0x21, {'high': [0x30], 'medium': [0x26], 'low': [0x2D]}),
+        2: (0x22, {'high': [0x36], 'medium': [0x20], 'low': [0x2B]}),
+        4: (0x23, {'high': [0x34], 'medium': [0x22], 'low': [0x29]}),
+        10: (0x27, {'high': [0x37], 'medium': [0x21], 'low': [0x2A]}),
+    }
+    PERIODIC_MPS = tuple(__PERIODIC_MEASUREMENT_CMDS)
+    MAX_FETCH_FAILURES = 3
+    REPEATABILITIES = tuple(__SEND_MEASUREMENT_CMD_ARGS)
+    __ART_CMD, __ART_CMD_ARGS = 0x2B, [0x32]
+    __FETCH_DATA_CMD, __FETCH_DATA_CMD_ARGS = 0xE0, [0x00]
+    __BREAK_CMD, __BREAK_CMD_ARGS = 0x30, [0x93]
     # Time recommended in https://wiki.seeedstudio.com/Grove-TempAndHumi_Sensor-SHT31/#software_1
     __CMD_EXEC_TIME = 0.032
     __READ_MEASUREMENT_CMD = 0x00
     __MEASUREMENT_MSG_BYTE_SIZE = 6
+    __RETRY_INITIAL_WAIT_MS = 10
+    __RETRY_MAX_WAIT_MS = 500
+    read_errors: Counter = Counter('tempd_sht31_read_errors',
+        'failed attempts to read a measurement from a SHT31 sensor',
+        labelnames=['bus', 'address'])
+    read_retries: Histogram = Histogram('tempd_sht31_read_retries',
+        'failed attempts to read each measurement from a SHT31 sensor',
+        labelnames=['bus', 'address'], buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
 
-    def __init__(self):
-        if Sensor.__is_rpi:
+    def __init__(self, bus: int = 1, address: int = DEFAULT_ADDRESS, # pylint: disable=too-many-arguments
+                 *, deferred: bool = False, retry_budget: float = 2.0,
+                 smbus: Optional[Any] = None, repeatability: str = 'high',
+                 periodic_mps: Optional[float] = None, art: bool = False):
+        """
+        Args:
+            bus: number of the I2C bus the sensor is connected to
+            address: I2C address of the sensor
+            deferred: whether to use deferred mode
+            retry_budget: maximum time in seconds spent retrying a
+                failed measurement
+            smbus: SMBus object to use instead of opening `bus`, for testing
+            repeatability: repeatability of the measurements
+            periodic_mps: measurements per second for periodic mode, one of
+                `PERIODIC_MPS`, or None to use single shot measurements
+            art: whether to use periodic mode with accelerated response time
+        """
+        if repeatability not in Sensor.REPEATABILITIES:
+            raise ValueError(f"Unknown repeatability '{repeatability}'")
+        if periodic_mps is not None and periodic_mps not in Sensor.__PERIODIC_MEASUREMENT_CMDS:
+            raise ValueError(f"Unsupported measurements per second '{periodic_mps}'")
+        self.__address = address
+        self.__deferred = deferred
+        self.__pending_measurement = False
+        self.__measurement_cmd_args = Sensor.__SEND_MEASUREMENT_CMD_ARGS[repeatability]
+        self.__periodic_cmd: Optional[Tuple[int, List[int]]] = None
+        if art:
+            self.__periodic_cmd = (Sensor.__ART_CMD, Sensor.__ART_CMD_ARGS)
+        elif periodic_mps is not None:
+            periodic_cmd, periodic_cmd_args = Sensor.__PERIODIC_MEASUREMENT_CMDS[periodic_mps]
+            self.__periodic_cmd = (periodic_cmd, periodic_cmd_args[repeatability])
+        self.__periodic_started = False
+        self.__fetch_failures = 0
+        # Fetching faster than the periodic mode measures returns no data, and
+        # measuring single shots more than once per second heats the sensor
+        if art:
+            self.min_period = 0.25
+        elif periodic_mps is not None:
+            self.min_period = 1 / periodic_mps
+        else:
+            self.min_period = 1.0
+        self.__read_errors = Sensor.read_errors.labels(str(bus), hex(address))
+        self.__read_retries = Sensor.read_retries.labels(str(bus), hex(address))
+        self.__measure_read_errors = 0
+        self.__retrying = Retrying(
+            wait_exponential_multiplier=Sensor.__RETRY_INITIAL_WAIT_MS,
+            wait_exponential_max=Sensor.__RETRY_MAX_WAIT_MS,
+            stop_max_delay=retry_budget * 1000, wrap_exception=True,
+            retry_on_exception=self.__is_read_error)
+        self.__bus: Any = smbus
+        if self.__bus is None and Sensor.__is_rpi:
             from smbus import SMBus # pylint: disable=no-name-in-module,import-outside-toplevel
             # I2C bus
-            self.__bus = SMBus(1)
-        else:
+            self.__bus = SMBus(bus)
+        if self.__bus is None:
             print("WARNING: Running on a platform different than RPI, fake measures will be returned for SHT31 sensor") # pylint: disable=line-too-long
             self.__sensor: TempSensor = fake.Sensor()
 
-    @retry(wait_fixed=10, stop_max_attempt_number=2000, wrap_exception=True,
-           retry_on_exception=lambda ex: isinstance(ex, OSError))
+    def __is_read_error(self, exception: Exception) -> bool:
+        if isinstance(exception, (OSError, ChecksumError)):
+            self.__read_errors.inc()
+            self.__measure_read_errors += 1
+            return True
+        return False
+
+    def __send_measurement_cmd(self):
+        self.__bus.write_i2c_block_data(self.__address,
+            Sensor.__SEND_MEASUREMENT_CMD, self.__measurement_cmd_args)
+
+    def __read_measurement(self) -> TempMeasurement:
+        # Temp MSB, Temp LSB, Temp CRC, Humididty MSB, Humidity LSB, Humidity CRC
+        data = self.__bus.read_i2c_block_data(self.__address,
+            Sensor.__READ_MEASUREMENT_CMD, Sensor.__MEASUREMENT_MSG_BYTE_SIZE)
+        if crc8(data[0:2]) != data[2] or crc8(data[3:5]) != data[5]:
+            raise ChecksumError(f"Invalid checksum for SHT31 data {data}")
+        # Convert the data
+        temp = data[0] * 256 + data[1]
+        celsius_temp = -45 + (175 * temp / 65535.0)
+        humidity = 100 * (data[3] * 256 + data[4]) / 65535.0
+        return (celsius_temp, humidity)
+
+    def __measure_single_shot(self) -> TempMeasurement:
+        if not self.__pending_measurement:
+            self.__send_measurement_cmd()
+            time.sleep(Sensor.__CMD_EXEC_TIME)
+        # if reading fails then the next attempt sends a new command
+        self.__pending_measurement = False
+        measurement = self.__read_measurement()
+        if self.__deferred:
+            self.__send_measurement_cmd()
+            self.__pending_measurement = True
+        return measurement
+
+    def __measure_periodic(self) -> TempMeasurement:
+        assert self.__periodic_cmd is not None
+        if not self.__periodic_started:
+            # stop any previous periodic measurement before starting it again
+            self.__bus.write_i2c_block_data(self.__address,
+                Sensor.__BREAK_CMD, Sensor.__BREAK_CMD_ARGS)
+            periodic_cmd, periodic_cmd_args = self.__periodic_cmd
+            self.__bus.write_i2c_block_data(self.__address, periodic_cmd, periodic_cmd_args)
+            self.__periodic_started = True
+            self.__fetch_failures = 0
+            # the first measurement is only ready after a full period
+            time.sleep(self.min_period)
+        try:
+            self.__bus.write_i2c_block_data(self.__address,
+                Sensor.__FETCH_DATA_CMD, Sensor.__FETCH_DATA_CMD_ARGS)
+            measurement = self.__read_measurement()
+        except OSError:
+            # the sensor NACKs a fetch while there is no new data, but if
+            # fetches keep failing it might have been reset, so restart the
+            # periodic measurement on the next attempt
+            self.__fetch_failures += 1
+            if self.__fetch_failures >= Sensor.MAX_FETCH_FAILURES:
+                self.__periodic_started = False
+            raise
+        self.__fetch_failures = 0
+        return measurement
+
+    def __measure(self) -> TempMeasurement:
+        if self.__periodic_cmd is not None:
+            return self.__measure_periodic()
+        return self.__measure_single_shot()
+
     def measure(self) -> TempMeasurement:
         """Get a temperature (in Celsius) and humidity measurement
         from the SHT31 sensor through the I2C bus"""
-        if Sensor.__is_rpi:
-            self.__bus.write_i2c_block_data(Sensor.__SENSOR_ADDRESS,
-                Sensor.__SEND_MEASUREMENT_CMD, Sensor.__SEND_MEASUREMENT_CMD_ARGS)
-            time.sleep(Sensor.__CMD_EXEC_TIME)
-            # Temp MSB, Temp LSB, Temp CRC, Humididty MSB, Humidity LSB, Humidity CRC
-            data = self.__bus.read_i2c_block_data(Sensor.__SENSOR_ADDRESS,
-                Sensor.__READ_MEASUREMENT_CMD, Sensor.__MEASUREMENT_MSG_BYTE_SIZE)
-            # Convert the data
-            temp = data[0] * 256 + data[1]
-            celsius_temp = -45 + (175 * temp / 65535.0)
-            humidity = 100 * (data[3] * 256 + data[4]) / 65535.0
-            return (celsius_temp, humidity)
+        if self.__bus is not None:
+            self.__measure_read_errors = 0
+            try:
+                return cast(TempMeasurement, self.__retrying.call(self.__measure))
+            finally:
+                self.__read_retries.observe(self.__measure_read_errors)
         # Stub reading for SHT31 sensor
         return self.__sensor.measure()
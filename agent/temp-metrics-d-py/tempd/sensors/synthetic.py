@@ -0,0 +1,115 @@
+"""Synthetic sensor
+Sensor with plausible measurements and failures, to load and soak test
+the agent without the target platform.
+
+The temperature and the humidity follow a daily cycle with gaussian noise,
+with the temperature peaking when the humidity bottoms out, and the sensor
+can inject the failure modes of the real sensors: spikes, NaN readings like
+the DHT11, "OSError: [Errno 121] Remote I/O error" like the SHT31, and slow
+reads. The random numbers come from a seeded SplitMix64 generator that only
+keeps an integer of state, so thousands of virtual sensors are cheap
+"""
+
+import math
+import time
+from dataclasses import dataclass
+from typing import Callable, List
+
+from .types import TempMeasurement, TempSensor
+
+_DAY = 24 * 60 * 60
+_MASK = (1 << 64) - 1
+# errno.EREMOTEIO on Linux, raised by the I2C driver when the SHT31 doesn't answer
+_REMOTE_IO_ERROR = 121
+
+
+class _SplitMix64:
+    """Random number generator with 64 bits of state"""
+    def __init__(self, seed: int):
+        self.__state = seed & _MASK
+
+    def random(self) -> float:
+        """Uniform random number in (0, 1)"""
+        self.__state = (self.__state + 0x9E3779B97F4A7C15) & _MASK
+        value = self.__state
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK
+        value ^= value >> 31
+        return ((value >> 11) + 0.5) / (1 << 53)
+
+    def gauss(self) -> float:
+        """Standard normal random number, with the Box-Muller transform"""
+        return math.sqrt(-2 * math.log(self.random())) * math.cos(2 * math.pi * self.random())
+
+
+@dataclass
+class SyntheticConfig: # pylint: disable=too-many-instance-attributes
+    """The configuration of a synthetic sensor.
+
+    The amplitudes are half the daily swing of each value, that peaks at
+    `peak_hour` UTC, and the noises are standard deviations. Each reading is
+    a spike of `spike_size` on one of the values with probability `spike_rate`,
+    NaN with probability `nan_rate`, and fails with an OSError with probability
+    `error_rate`. Reads take a lognormal time with median `latency` seconds and
+    shape `latency_sigma`"""
+    mean_temperature: float = 21.0
+    temperature_amplitude: float = 3.0
+    temperature_noise: float = 0.1
+    mean_humidity: float = 50.0
+    humidity_amplitude: float = 10.0
+    humidity_noise: float = 0.5
+    peak_hour: float = 15.0
+    spike_rate: float = 0.0
+    spike_size: float = 10.0
+    nan_rate: float = 0.0
+    error_rate: float = 0.0
+    latency: float = 0.0
+    latency_sigma: float = 0.0
+    min_period: float = 0.0
+
+
+class Sensor(TempSensor): # pylint: disable=too-few-public-methods
+    """A synthetic sensor, with measurements generated as configured by
+    a SyntheticConfig. The same seed produces the same sequence of readings
+    for the same times. `clock` and `sleep` are the functions used to get
+    the time of the daily cycle, and to wait for the latency"""
+    def __init__(self, config: SyntheticConfig = SyntheticConfig(), seed: int = 0, *,
+                 clock: Callable[[], float] = time.time,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.__config = config
+        self.__random = _SplitMix64(seed)
+        self.__clock = clock
+        self.__sleep = sleep
+        self.min_period = config.min_period
+
+    def measure(self) -> TempMeasurement:
+        """Get a synthetic measurement, that might be NaN or raise OSError
+        as configured"""
+        config = self.__config
+        if config.latency > 0:
+            self.__sleep(config.latency * math.exp(config.latency_sigma * self.__random.gauss()))
+        draw = self.__random.random()
+        if draw < config.error_rate:
+            raise OSError(_REMOTE_IO_ERROR, 'Remote I/O error')
+        if draw < config.error_rate + config.nan_rate:
+            return (math.nan, math.nan)
+        daily = math.cos(2 * math.pi * (self.__clock() / _DAY - config.peak_hour / 24))
+        temperature = config.mean_temperature + config.temperature_amplitude * daily \
+            + config.temperature_noise * self.__random.gauss()
+        humidity = config.mean_humidity - config.humidity_amplitude * daily \
+            + config.humidity_noise * self.__random.gauss()
+        if self.__random.random() < config.spike_rate:
+            spike = config.spike_size if self.__random.random() < 0.5 else -config.spike_size
+            if self.__random.random() < 0.5:
+                temperature += spike
+            else:
+                humidity += spike
+        return (round(temperature, 2), round(min(max(humidity, 0.0), 100.0), 2))
+
+
+def create_fleet(size: int, config: SyntheticConfig = SyntheticConfig(), seed: int = 0, *,
+                 clock: Callable[[], float] = time.time,
+                 sleep: Callable[[float], None] = time.sleep) -> List[Sensor]:
+    """Create `size` synthetic sensors with the same configuration, and
+    consecutive seeds starting with `seed`"""
+    return [Sensor(config, seed + index, clock=clock, sleep=sleep) for index in range(size)]
@@ -1,11 +1,16 @@
 """
 Type declarations for the sensors module
 """
+import math
 from typing import Tuple
 from typing_extensions import Protocol
 
 TempMeasurement = Tuple[float, float]
 class TempSensor(Protocol): # pylint: disable=too-few-public-methods
     """A sensor able to read temperature and humidty"""
+    # Limits in seconds of the period between measurements supported by the sensor
+    min_period: float = 0.0
+    max_period: float = math.inf
+
     def measure(self) -> TempMeasurement:
         """Get a new measurement from the sensor"""
@@ -0,0 +1,127 @@
+"""
+HTTP server for the Prometheus metrics, that also serves time range
+queries of the measurements kept by the agent, and triggers profiling
+"""
+
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer
+from typing import TYPE_CHECKING, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from prometheus_client.exposition import MetricsHandler
+
+from .types import MeasurementQuery, StatisticSet
+
+if TYPE_CHECKING:
+    from .profiling import Profiler
+
+
+def _summary(statistic_set: StatisticSet) -> dict:
+    return {'min': statistic_set.minimum, 'avg': statistic_set.average,
+            'max': statistic_set.maximum}
+
+
+class QueryHandler(MetricsHandler):
+    """Handler for the metrics server. The paths are:
+
+    - '/sources': JSON list with the sources in the history
+    - '/query': JSON list with the measurements of the `source` parameter
+      with timestamp in [`start`, `end`), as unix epoch times, by default the
+      last hour. If the `step` parameter is present, the measurements are
+      downsampled to the minimum, average and maximum of each window of
+      `step` seconds
+    - any other path: the Prometheus metrics
+
+    A POST to '/profile' profiles the next run of the actions of the agent
+    """
+    query: Optional[MeasurementQuery] = None
+    profiler: Optional['Profiler'] = None
+    # Limit for the measurements of a query without step
+    max_measurements = 100000
+    default_range_in_seconds = 60 * 60
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in ('/sources', '/query'):
+            super().do_GET()
+            return
+        if self.query is None:
+            self.__send_json(404, {'error': 'The measurement history is not enabled'})
+            return
+        if url.path == '/sources':
+            self.__send_json(200, self.query.sources())
+            return
+        try:
+            self.__send_json(200, self.__range_query(parse_qs(url.query)))
+        except ValueError as value_error:
+            self.__send_json(400, {'error': str(value_error)})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Serve the requests to profile"""
+        if urlparse(self.path).path != '/profile':
+            self.__send_json(404, {'error': 'Not found'})
+            return
+        if self.profiler is None:
+            self.__send_json(404, {'error': 'Profiling is not enabled'})
+            return
+        self.profiler.request()
+        self.__send_json(202, {'status': 'The next run will be profiled'})
+
+    def __range_query(self, params: Dict[str, List[str]]) -> list:
+        def get_param(name: str, default: Optional[int] = None) -> Optional[int]:
+            if name not in params:
+                return default
+            try:
+                return int(params[name][0])
+            except ValueError:
+                raise ValueError(f"Invalid integer for parameter {name}") from None
+
+        assert self.query is not None
+        if 'source' not in params:
+            raise ValueError('Missing parameter source')
+        source = params['source'][0]
+        end = get_param('end', int(time.time()))
+        assert end is not None
+        start = get_param('start', end - self.__class__.default_range_in_seconds)
+        assert start is not None
+        step = get_param('step')
+        if step is not None:
+            if step <= 0:
+                raise ValueError('The step must be positive')
+            return [{'timestamp': statistics.timestamp,
+                     'count': statistics.temperature.count,
+                     'temperature': _summary(statistics.temperature),
+                     'humidity': _summary(statistics.humidity)}
+                    for statistics in self.query.statistics(source, start, end, step)]
+        points: List[dict] = []
+        for measurement in self.query.measurements(source, start, end):
+            if len(points) >= self.__class__.max_measurements:
+                raise ValueError('Too many measurements, use a step or a shorter time range')
+            points.append({'timestamp': measurement.timestamp,
+                           'temperature': measurement.temperature,
+                           'humidity': measurement.humidity})
+        return points
+
+    def __send_json(self, status: int, body: object):
+        output = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+
+def start_server(port: int, query: Optional[MeasurementQuery] = None,
+                 address: str = '0.0.0.0',
+                 profiler: Optional['Profiler'] = None) -> ThreadingHTTPServer:
+    """Start the metrics server on a daemon thread, serving the queries
+    with `query` and the profiling requests with `profiler` if they are
+    not None. Use port 0 to pick a free port"""
+    handler = type('QueryHandler', (QueryHandler,), {'query': query, 'profiler': profiler})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name='MetricsServer')
+    thread.start()
+    return server
@@ -0,0 +1,278 @@
+"""
+Durable on-disk spool for measurements, used to avoid losing measurements
+while the metrics service is not reachable
+"""
+
+import os
+import struct
+import logging
+import threading
+from typing import Callable, Iterator, List, Optional, Sequence
+
+from .types import TempMeasurement, MeasurementRecorder
+
+# Each record is the source name length, the source name encoded in UTF-8,
+# and then the timestamp, temperature and humidity
+_SOURCE_LENGTH = struct.Struct('<B')
+_MEASUREMENT_VALUES = struct.Struct('<qdd')
+_ENCODING = 'utf-8'
+
+def encode_measurement(measurement: TempMeasurement) -> bytes:
+    """Encode a measurement as a spool record. Source names are truncated to
+    255 bytes, without splitting a character"""
+    source = measurement.source.encode(_ENCODING)
+    if len(source) > 255:
+        source = source[:255].decode(_ENCODING, errors='ignore').encode(_ENCODING)
+    return _SOURCE_LENGTH.pack(len(source)) + source + \
+        _MEASUREMENT_VALUES.pack(measurement.timestamp,
+                                 measurement.temperature, measurement.humidity)
+
+def decode_measurements(data: bytes) -> Iterator[TempMeasurement]:
+    """Decode a sequence of spool records. A truncated record at the end
+    of the data, e.g. due to a power loss while writing it, is ignored"""
+    offset = 0
+    while offset + _SOURCE_LENGTH.size <= len(data):
+        (source_length,) = _SOURCE_LENGTH.unpack_from(data, offset)
+        values_offset = offset + _SOURCE_LENGTH.size + source_length
+        if values_offset + _MEASUREMENT_VALUES.size > len(data):
+            return
+        source = data[offset + _SOURCE_LENGTH.size:values_offset].decode(_ENCODING)
+        timestamp, temperature, humidity = \
+            _MEASUREMENT_VALUES.unpack_from(data, values_offset)
+        yield TempMeasurement(source, timestamp, temperature, humidity)
+        offset = values_offset + _MEASUREMENT_VALUES.size
+
+
+class Spool: # pylint: disable=too-many-instance-attributes
+    """A spool of measurements stored as a sequence of append-only segment
+    files on a directory.
+
+    Measurements are appended to the active segment, that is sealed when it
+    reaches `segment_size` bytes, or when `rotate` is called. Sealed
+    segments are never modified, they are read and then removed as a whole.
+    When the total size of the spool exceeds `max_size` bytes the oldest
+    sealed segments are removed. Sealed segments that can't be decoded are
+    quarantined, renaming them with the `quarantine_suffix`, so they are
+    kept for inspection but no longer read.
+
+    The `fsync_policy` decides when the data is forced to disk:
+
+    - 'batch': after each call to `append`
+    - 'segment': when a segment is sealed
+    - 'never': leave it to the OS
+    """
+    fsync_policies = ('batch', 'segment', 'never')
+    segment_prefix = 'segment-'
+    segment_suffix = '.spool'
+    quarantine_suffix = '.corrupt'
+    logger = logging.getLogger('Spool')
+
+    def __init__(self, directory: str,
+                 segment_size: int = 1024 * 1024,
+                 max_size: int = 64 * 1024 * 1024,
+                 fsync_policy: str = 'batch'):
+        if fsync_policy not in self.__class__.fsync_policies:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}'")
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__max_size = max_size
+        self.__fsync_policy = fsync_policy
+        self.__lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Segments from previous runs are considered sealed, and
+        # a new segment is started on the first append
+        sequence_numbers = [self.__sequence_number(filename)
+                            for filename in self.__segment_filenames()]
+        self.__next_sequence_number = max(sequence_numbers, default=-1) + 1
+        self.__active_segment: Optional[str] = None
+        self.__active_file = None
+        self.__active_size = 0
+
+    @property
+    def directory(self) -> str:
+        """Directory where the segments are stored"""
+        return self.__directory
+
+    def __segment_filenames(self) -> List[str]:
+        prefix, suffix = self.__class__.segment_prefix, self.__class__.segment_suffix
+        return sorted(filename for filename in os.listdir(self.__directory)
+                      if filename.startswith(prefix) and filename.endswith(suffix))
+
+    def __sequence_number(self, filename: str) -> int:
+        return int(filename[len(self.__class__.segment_prefix):
+                            -len(self.__class__.segment_suffix)])
+
+    def __open_segment(self):
+        filename = f"{self.__class__.segment_prefix}{self.__next_sequence_number:012d}" \
+                   f"{self.__class__.segment_suffix}"
+        self.__next_sequence_number += 1
+        self.__active_segment = filename
+        self.__active_file = open(os.path.join(self.__directory, filename), 'ab') # pylint: disable=consider-using-with
+        self.__active_size = 0
+
+    def __seal_segment(self):
+        if self.__active_file is None:
+            return
+        if self.__fsync_policy == 'segment':
+            os.fsync(self.__active_file.fileno())
+        self.__active_file.close()
+        self.__active_file = None
+        self.__active_segment = None
+        self.__enforce_max_size()
+
+    def __enforce_max_size(self):
+        segment_paths = [os.path.join(self.__directory, filename)
+                         for filename in self.__segment_filenames()]
+        total_size = sum(os.path.getsize(path) for path in segment_paths)
+        for path in segment_paths:
+            if total_size <= self.__max_size:
+                return
+            self.__class__.logger.warning('Spool is full, discarding segment %s', path)
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+
+    def append(self, measurements: Sequence[TempMeasurement]):
+        """Append some measurements to the spool with a single write"""
+        if len(measurements) == 0:
+            return
+        data = b''.join(encode_measurement(measurement) for measurement in measurements)
+        with self.__lock:
+            if self.__active_file is None:
+                self.__open_segment()
+            assert self.__active_file is not None
+            self.__active_file.write(data)
+            self.__active_file.flush()
+            if self.__fsync_policy == 'batch':
+                os.fsync(self.__active_file.fileno())
+            self.__active_size += len(data)
+            if self.__active_size >= self.__segment_size:
+                self.__seal_segment()
+
+    def rotate(self):
+        """Seal the active segment, if any"""
+        with self.__lock:
+            self.__seal_segment()
+
+    def sealed_segments(self) -> List[str]:
+        """Paths of the sealed segments, from oldest to newest"""
+        with self.__lock:
+            return [os.path.join(self.__directory, filename)
+                    for filename in self.__segment_filenames()
+                    if filename != self.__active_segment]
+
+    @staticmethod
+    def read_segment(path: str) -> List[TempMeasurement]:
+        """Read all the measurements of a sealed segment"""
+        with open(path, 'rb') as in_f:
+            return list(decode_measurements(in_f.read()))
+
+    def remove_segment(self, path: str):
+        """Remove a sealed segment"""
+        with self.__lock:
+            os.remove(path)
+
+    def quarantine_segment(self, path: str) -> str:
+        """Rename a sealed segment that can't be read, so it is no longer
+        a segment of the spool. Returns its new path"""
+        quarantine_path = path + self.__class__.quarantine_suffix
+        with self.__lock:
+            os.replace(path, quarantine_path)
+        return quarantine_path
+
+    def close(self):
+        """Seal the active segment. The spool can be still used after
+        closing it"""
+        self.rotate()
+
+
+class SpoolMeasurementRecorder(MeasurementRecorder): # pylint: disable=too-few-public-methods
+    """A MeasurementRecorder that stores the measurements in a spool.
+    To keep writes cheap, measurements are buffered in memory and appended
+    to the spool in batches of `batch_size` measurements"""
+
+    def __init__(self, spool: Spool, batch_size: int = 10):
+        self.__spool = spool
+        self.__batch_size = batch_size
+        self.__buffer: List[TempMeasurement] = []
+
+    def record(self, measurement: TempMeasurement):
+        self.__buffer.append(measurement)
+        if len(self.__buffer) >= self.__batch_size:
+            self.flush()
+
+    def flush(self):
+        self.__spool.append(self.__buffer)
+        self.__buffer = []
+
+
+class SpoolDrainer:
+    """Periodically sends the measurements of a spool with a publish
+    function, on its own thread, removing each segment once all its
+    measurements have been published.
+
+    Publishing is retried on the next drain, so the measurements of a
+    segment that fails halfway are published again. Segments that can't be
+    decoded are quarantined and skipped, instead of blocking the drain of the
+    segments after them. The wait between
+    drains doubles after each failure, up to `max_interval` seconds,
+    and it is restored to `interval` after a successful drain
+    """
+    logger = logging.getLogger('SpoolDrainer')
+
+    def __init__(self, spool: Spool,
+                 publish: Callable[[Sequence[TempMeasurement]], None],
+                 interval: float = 60.0,
+                 max_interval: float = 3600.0):
+        self.__spool = spool
+        self.__publish = publish
+        self.__interval = interval
+        self.__max_interval = max_interval
+        self.__stopped = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def drain(self) -> bool:
+        """Seal the active segment and publish all the sealed segments,
+        from oldest to newest, stopping on the first failure.
+        Returns whether all the segments were published"""
+        self.__spool.rotate()
+        for path in self.__spool.sealed_segments():
+            try:
+                measurements = self.__spool.read_segment(path)
+            except (ValueError, struct.error) as error:
+                quarantine_path = self.__spool.quarantine_segment(path)
+                self.__class__.logger.error('Quarantined unreadable spool segment %s as %s: %s',
+                    path, quarantine_path, error)
+                continue
+            except OSError as error:
+                self.__class__.logger.error('Exception reading spool segment %s: %s',
+                    path, error)
+                return False
+            try:
+                self.__publish(measurements)
+            except Exception as exception: # pylint: disable=broad-except
+                self.__class__.logger.error('Exception draining spool segment %s: %s',
+                    path, exception)
+                return False
+            self.__spool.remove_segment(path)
+            self.__class__.logger.info('Drained %d measurements from spool segment %s',
+                len(measurements), path)
+        return True
+
+    def start(self):
+        """Launch the drainer thread"""
+        def thread_function():
+            wait_time = self.__interval
+            while not self.__stopped.wait(wait_time):
+                if self.drain():
+                    wait_time = self.__interval
+                else:
+                    wait_time = min(2 * wait_time, self.__max_interval)
+        self.__thread = threading.Thread(target=thread_function, daemon=True,
+                                         name='SpoolDrainer')
+        self.__thread.start()
+
+    def stop(self):
+        """Stop the drainer thread, without draining the spool"""
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
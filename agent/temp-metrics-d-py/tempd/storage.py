@@ -0,0 +1,322 @@
+"""
+Embedded storage engine for the history of the measurements, that keeps
+the measurements for a short time, and statistics of the measurements
+on coarser time windows for longer
+"""
+
+import os
+import struct
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import IO, Dict, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+from urllib.parse import quote, unquote
+
+from .types import TempMeasurement, TempStatistics, StatisticSet
+from .types import MeasurementQuery, MeasurementRecorder
+from .aggregation import aggregate, window_start
+from .codec import decode_frames, encode_frame
+
+_DAY = 24 * 60 * 60
+# Window start, measurement count, and then the minimum, maximum and sum
+# of the temperatures and of the humidities
+_ROLLUP_ROW = struct.Struct('<qqdddddd')
+
+
+class Tier(NamedTuple):
+    """A resolution of the storage.
+
+    `window` is the window in seconds of the statistics of the tier, or None
+    for the measurements. The data of each source is stored on a file per
+    partition of `partition` seconds, that is removed once all its data is
+    older than `retention` seconds"""
+    name: str
+    window: Optional[int]
+    partition: int
+    retention: int
+
+DEFAULT_TIERS = (Tier('raw', None, _DAY, 7 * _DAY),
+                 Tier('1m', 60, 7 * _DAY, 90 * _DAY),
+                 Tier('1h', 60 * 60, 30 * _DAY, 10 * 365 * _DAY))
+
+def _encode_statistics(statistics: TempStatistics) -> bytes:
+    return _ROLLUP_ROW.pack(statistics.timestamp, statistics.temperature.count,
+        statistics.temperature.minimum, statistics.temperature.maximum,
+        statistics.temperature.sum,
+        statistics.humidity.minimum, statistics.humidity.maximum, statistics.humidity.sum)
+
+def _decode_statistics(source: str, row: tuple) -> TempStatistics:
+    timestamp, count, t_min, t_max, t_sum, h_min, h_max, h_sum = row
+    return TempStatistics(source, timestamp, StatisticSet(t_min, t_max, t_sum, count),
+                          StatisticSet(h_min, h_max, h_sum, count))
+
+def _read_rows(path: str, row: struct.Struct) -> Iterator[tuple]:
+    """Read the rows of a segment file, ignoring a truncated row at the end"""
+    with open(path, 'rb') as in_f:
+        data = in_f.read()
+    return row.iter_unpack(data[:len(data) - len(data) % row.size])
+
+def _merge_by_window(statistics: Sequence[TempStatistics], step: int) -> List[TempStatistics]:
+    merged: Dict[int, TempStatistics] = {}
+    for window_statistics in statistics:
+        start = window_start(window_statistics.timestamp, step)
+        if start not in merged:
+            merged[start] = TempStatistics(window_statistics.source, start)
+        merged[start].merge(window_statistics)
+    return [merged[start] for start in sorted(merged)]
+
+
+@dataclass
+class _Segment:
+    """The segment of a tier and source where data is appended, with
+    the measurements not written yet for the first tier"""
+    source: str
+    path: str
+    partition_start: int
+    file: IO[bytes]
+    pending: List[TempMeasurement] = field(default_factory=list)
+
+
+class MeasurementStorage(MeasurementRecorder, MeasurementQuery): # pylint: disable=too-many-instance-attributes
+    """A MeasurementRecorder that stores the measurements in a directory,
+    with a subdirectory per tier and source.
+
+    The measurements are stored on the first tier, and the other tiers store
+    statistics of the measurements on their window, that are computed
+    incrementally as measurements arrive: the statistics of a window are
+    appended to the tier once a measurement for a later window arrives.
+    Flushing appends the statistics of the current windows and restarts them,
+    so a window might be stored in several rows, that are merged when reading,
+    and when a partition is compacted once a later partition is started.
+    Files are only appended to, emptied, or replaced as a whole.
+
+    Measurements are written as frames of `frame_size` measurements encoded
+    with `tempd.codec`, that usually take a few bytes per measurement, with
+    values rounded to `precision` decimal digits. Each window takes 64 bytes.
+    Measurements not written yet are lost if the agent crashes. When the total
+    size of the files exceeds `max_size` bytes the oldest partitions are
+    removed, starting with the finest tier, and if that is not enough the
+    current partitions are emptied too. The size is checked when a partition
+    starts, and each time `max_size` / 16 bytes are written. Retention is
+    relative to the latest measurement, so old data is kept while no
+    measurements arrive.
+    Measurements older than the current partition of their source are
+    discarded. It is safe to record and query from different threads
+    """
+    suffix = '.seg'
+    logger = logging.getLogger('MeasurementStorage')
+
+    def __init__(self, directory: str, tiers: Sequence[Tier] = DEFAULT_TIERS,
+                 max_size: int = 256 * 1024 * 1024, *,
+                 frame_size: int = 60, precision: int = 2):
+        if len(tiers) == 0 or tiers[0].window is not None:
+            raise ValueError('The first tier must store the measurements')
+        self.__directory = directory
+        self.__tiers = tiers
+        self.__max_size = max_size
+        self.__frame_size = frame_size
+        self.__precision = precision
+        self.__segments: Dict[Tuple[Tier, str], _Segment] = {}
+        self.__windows: Dict[Tuple[Tier, str], TempStatistics] = {}
+        self.__latest_timestamp: Optional[int] = None
+        self.__unchecked_size = 0
+        self.__lock = threading.Lock()
+        for tier in tiers:
+            os.makedirs(os.path.join(directory, tier.name), exist_ok=True)
+
+    @property
+    def directory(self) -> str:
+        """Directory where the data is stored"""
+        return self.__directory
+
+    def __source_directory(self, tier: Tier, source: str) -> str:
+        return os.path.join(self.__directory, tier.name, quote(source, safe=''))
+
+    def __partitions(self, tier: Tier, source: str) -> List[Tuple[int, str]]:
+        """Start and path of the partitions of a source, from oldest to newest"""
+        directory = self.__source_directory(tier, source)
+        if not os.path.isdir(directory):
+            return []
+        suffix = self.__class__.suffix
+        return sorted((int(filename[:-len(suffix)]), os.path.join(directory, filename))
+                      for filename in os.listdir(directory) if filename.endswith(suffix))
+
+    def sources(self) -> List[str]:
+        sources: Set[str] = set()
+        with self.__lock:
+            for tier in self.__tiers:
+                sources.update(unquote(name) for name in
+                               os.listdir(os.path.join(self.__directory, tier.name)))
+        return sorted(sources)
+
+    def record(self, measurement: TempMeasurement):
+        with self.__lock:
+            if self.__latest_timestamp is None or \
+                measurement.timestamp > self.__latest_timestamp:
+                self.__latest_timestamp = measurement.timestamp
+            segment = self.__segment(self.__tiers[0], measurement.source, measurement.timestamp)
+            if segment is None:
+                return
+            segment.pending.append(measurement)
+            if len(segment.pending) >= self.__frame_size:
+                self.__write_frame(segment)
+            for tier in self.__tiers[1:]:
+                assert tier.window is not None
+                start = window_start(measurement.timestamp, tier.window)
+                key = (tier, measurement.source)
+                statistics = self.__windows.get(key)
+                if statistics is None or statistics.timestamp < start:
+                    if statistics is not None:
+                        self.__append_statistics(tier, statistics)
+                    statistics = TempStatistics(measurement.source, start)
+                    self.__windows[key] = statistics
+                if statistics.timestamp == start:
+                    statistics.add(measurement)
+
+    def __append_statistics(self, tier: Tier, statistics: TempStatistics):
+        if statistics.temperature.count > 0:
+            segment = self.__segment(tier, statistics.source, statistics.timestamp)
+            if segment is not None:
+                self.__append(segment, _encode_statistics(statistics))
+
+    def __write_frame(self, segment: _Segment):
+        if len(segment.pending) > 0:
+            data = encode_frame(segment.source, segment.pending, self.__precision)
+            segment.pending = []
+            self.__append(segment, data)
+
+    def __append(self, segment: _Segment, data: bytes):
+        segment.file.write(data)
+        self.__unchecked_size += len(data)
+        if self.__unchecked_size >= max(self.__max_size // 16, 1):
+            self.__enforce_limits()
+
+    def __segment(self, tier: Tier, source: str, timestamp: int) -> Optional[_Segment]:
+        """The segment for the partition of `timestamp`, or None if that
+        partition is older than the current partition"""
+        partition_start = window_start(timestamp, tier.partition)
+        key = (tier, source)
+        segment = self.__segments.get(key)
+        if segment is not None and partition_start < segment.partition_start:
+            self.__class__.logger.warning('Discarding data for %s older than partition %s',
+                source, segment.path)
+            return None
+        if segment is None or partition_start > segment.partition_start:
+            if segment is not None:
+                self.__seal(tier, segment)
+            directory = self.__source_directory(tier, source)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{partition_start:012d}{self.__class__.suffix}")
+            segment = _Segment(source, path, partition_start, open(path, 'ab')) # pylint: disable=consider-using-with
+            self.__segments[key] = segment
+            self.__enforce_limits()
+        return segment
+
+    def __seal(self, tier: Tier, segment: _Segment):
+        self.__write_frame(segment)
+        segment.file.close()
+        if tier.window is not None:
+            self.compact(segment.path)
+
+    @staticmethod
+    def compact(path: str):
+        """Replace a partition of statistics with a partition with a single
+        row per window"""
+        statistics = [_decode_statistics('', row) for row in _read_rows(path, _ROLLUP_ROW)]
+        compacted = _merge_by_window(statistics, 1)
+        if len(compacted) == len(statistics):
+            return
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as out_f:
+            out_f.write(b''.join(_encode_statistics(window) for window in compacted))
+        os.replace(temp_path, path)
+
+    def __enforce_limits(self):
+        self.__unchecked_size = 0
+        for segment in self.__segments.values():
+            segment.file.flush()
+        active_paths = {segment.path for segment in self.__segments.values()}
+        partitions: List[Tuple[int, int, str]] = []
+        for tier_index, tier in enumerate(self.__tiers):
+            tier_directory = os.path.join(self.__directory, tier.name)
+            for name in os.listdir(tier_directory):
+                for partition_start, path in self.__partitions(tier, unquote(name)):
+                    if path in active_paths:
+                        continue
+                    assert self.__latest_timestamp is not None
+                    if partition_start + tier.partition <= \
+                        self.__latest_timestamp - tier.retention:
+                        self.__class__.logger.info('Removing expired partition %s', path)
+                        os.remove(path)
+                    else:
+                        partitions.append((tier_index, partition_start, path))
+        total_size = sum(os.path.getsize(path) for path in active_paths) + \
+            sum(os.path.getsize(path) for _, _, path in partitions)
+        for _, _, path in sorted(partitions):
+            if total_size <= self.__max_size:
+                return
+            self.__class__.logger.warning('Storage is full, removing partition %s', path)
+            total_size -= os.path.getsize(path)
+            os.remove(path)
+        tier_indexes = {tier: index for index, tier in enumerate(self.__tiers)}
+        for (tier, _), segment in sorted(self.__segments.items(),
+                                         key=lambda item: tier_indexes[item[0][0]]):
+            if total_size <= self.__max_size:
+                return
+            self.__class__.logger.warning('Storage is full, emptying partition %s',
+                                          segment.path)
+            total_size -= os.path.getsize(segment.path)
+            segment.file.truncate(0)
+
+    def flush(self):
+        with self.__lock:
+            for (tier, source), statistics in list(self.__windows.items()):
+                self.__append_statistics(tier, statistics)
+                self.__windows[(tier, source)] = TempStatistics(source, statistics.timestamp)
+            for segment in self.__segments.values():
+                self.__write_frame(segment)
+                segment.file.flush()
+
+    def __read(self, tier: Tier, source: str, start: int, end: int) -> List[tuple]:
+        """Rows of the partitions that overlap [start, end)"""
+        segment = self.__segments.get((tier, source))
+        rows: List[tuple] = []
+        if segment is not None:
+            segment.file.flush()
+            rows.extend((measurement.timestamp, measurement.temperature, measurement.humidity)
+                        for measurement in segment.pending)
+        for partition_start, path in self.__partitions(tier, source):
+            if partition_start < end and start < partition_start + tier.partition:
+                if tier.window is None:
+                    with open(path, 'rb') as in_f:
+                        rows.extend((measurement.timestamp, measurement.temperature,
+                                     measurement.humidity)
+                                    for measurement in decode_frames(in_f.read()))
+                else:
+                    rows.extend(_read_rows(path, _ROLLUP_ROW))
+        return [row for row in rows if start <= row[0] < end]
+
+    def measurements(self, source: str, start: int, end: int) -> Iterator[TempMeasurement]:
+        with self.__lock:
+            rows = self.__read(self.__tiers[0], source, start, end)
+        for timestamp, temperature, humidity in sorted(rows, key=lambda row: row[0]):
+            yield TempMeasurement(source, timestamp, temperature, humidity)
+
+    def statistics(self, source: str, start: int, end: int,
+                   step: int) -> List[TempStatistics]:
+        """Statistics per window of `step` seconds. These are computed from
+        the coarsest tier with a window that divides `step`, or from the
+        measurements if there is no such tier"""
+        tiers = [tier for tier in self.__tiers[1:]
+                 if tier.window is not None and step % tier.window == 0]
+        if len(tiers) == 0:
+            return aggregate(list(self.measurements(source, start, end)), step)
+        tier = max(tiers, key=lambda tier: tier.window or 0)
+        with self.__lock:
+            statistics = [_decode_statistics(source, row)
+                          for row in self.__read(tier, source, start, end)]
+            current = self.__windows.get((tier, source))
+            if current is not None and start <= current.timestamp < end:
+                statistics.append(current)
+        return _merge_by_window([window for window in statistics
+                                 if window.temperature.count > 0], step)
@@ -6,14 +6,23 @@ Test for the module tempd.agent
 # for fixtures
 # pylint: disable=redefined-outer-name
 import math
+import os
 from unittest.mock import patch
 from unittest.mock import Mock
 import signal
+import threading
+import time
+import tracemalloc
 
 import pytest
+from prometheus_client import REGISTRY
 
-from tempd.agent import CloudwatchMeasurementRecorder, TempMeter
+from tempd.agent import AsyncMeasurementRecorder, CloudwatchMeasurementRecorder, TempMeter
 from tempd.agent import TempMeterConfig, TempMeasurement, ThreadDaemon
+from tempd.agent import ConfigError, Main, PoolDaemon
+from tempd.cloudwatch import CloudwatchError
+from tempd.throttling import AdaptiveRateLimiter
+from tempd.types import StatisticSet, TempStatistics
 
 
 @pytest.fixture
@@ -83,17 +92,61 @@ def test_daemon_runs_starts_with_action(action, daemon_frequency, daemon):
 
 def test_daemon_runs_action_at_expected_frequency(action, daemon_frequency,
     timer, daemon_mock_timer):
-    """Check that the daemon runs the action with the specified frequency
-     (at least for the first cycle)"""
+    """Check that the daemon waits until the next deadline to run the action
+    again, and that deadlines are not delayed by the action run time"""
     daemon = daemon_mock_timer
-    timer.time.side_effect = [0, daemon_frequency+1]
-    action.side_effect = daemon.stop
+    timer.time.side_effect = [0, 0, 1, 5, daemon_frequency, daemon_frequency + 1]
+    action.side_effect = lambda: daemon.stop() if action.call_count == 2 else None
+
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=2*daemon_frequency)
+    assert not daemon.running
+    assert action.call_count == 2
+    _event, wait_time = timer.wait.call_args[0]
+    assert wait_time == daemon_frequency - 5
+    assert daemon.missed_deadlines == 0
+
+def test_daemon_skips_missed_deadlines(action, daemon_frequency,
+    timer, daemon_mock_timer):
+    """Check that the daemon skips the deadlines missed while running
+    the action, and runs the action right away for the latest deadline"""
+    daemon = daemon_mock_timer
+    timer.time.side_effect = [0, 0, 3.5 * daemon_frequency, 3.5 * daemon_frequency,
+                              4 * daemon_frequency]
+    action.side_effect = lambda: daemon.stop() if action.call_count == 2 else None
 
     daemon.start(blocking=False)
 
     daemon.wait_for_completion(timeout=2*daemon_frequency)
     assert not daemon.running
+    assert action.call_count == 2
+    timer.wait.assert_not_called()
+    assert daemon.missed_deadlines == 2
+
+def test_daemon_aligns_deadlines(action, timer):
+    """Check that the first deadline is aligned when requested"""
+    daemon = ThreadDaemon(60, action, timer, align_to=60)
+    timer.time.side_effect = [125, 125, 180, 180]
+    action.side_effect = daemon.stop
+
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=1)
+    assert not daemon.running
     action.assert_called_once()
+    _event, wait_time = timer.wait.call_args[0]
+    assert wait_time == 55
+
+def test_daemon_stop_interrupts_wait(action):
+    """Check that stopping the daemon doesn't wait for the next deadline"""
+    daemon = ThreadDaemon(3600, action)
+
+    daemon.start(blocking=False)
+    daemon.stop()
+
+    daemon.wait_for_completion(timeout=1)
+    assert not daemon.running
 
 def test_daemon_keeps_working_on_action_exception(action, daemon):
     """Check the daemon keeps running even when the action raises
@@ -109,6 +162,58 @@ def test_daemon_keeps_working_on_action_exception(action, daemon):
     daemon.wait_for_completion(1)
     assert daemon.running
 
+def test_daemon_runs_on_stop_after_stopping(action, daemon_frequency):
+    """Check the daemon runs the stop action once it has been stopped"""
+    on_stop = Mock()
+    daemon = ThreadDaemon(daemon_frequency, action, on_stop=on_stop)
+    action.side_effect = daemon.stop
+
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=2*daemon_frequency)
+    assert not daemon.running
+    on_stop.assert_called_once()
+
+def test_pool_daemon_runs_actions_concurrently(daemon_frequency):
+    """Check that the pool daemon runs each action on the pool"""
+    barrier = threading.Barrier(3, timeout=1)
+    actions = [Mock(side_effect=barrier.wait), Mock(side_effect=barrier.wait)]
+    daemon = PoolDaemon([(daemon_frequency, action) for action in actions])
+
+    daemon.start(blocking=False)
+    barrier.wait()
+    daemon.stop()
+
+    daemon.wait_for_completion(timeout=1)
+    assert not daemon.running
+    for action in actions:
+        action.assert_called_once()
+
+def test_pool_daemon_skips_running_actions(timer):
+    """Check that an action doesn't run again while it is running"""
+    running = threading.Event()
+    release = threading.Event()
+    slow_action = Mock(side_effect=lambda: running.set() or release.wait(1))
+    daemon = PoolDaemon([(10, slow_action)], timer=timer)
+    times = iter([0, 0, 0, 10, 10])
+    def time():
+        current_time = next(times, None)
+        if current_time is None:
+            daemon.stop()
+            release.set()
+            return 15
+        if current_time == 10:
+            running.wait(1)
+        return current_time
+    timer.time.side_effect = time
+
+    daemon.start(blocking=False)
+    daemon.wait_for_completion(timeout=1)
+
+    assert not daemon.running
+    slow_action.assert_called_once()
+    assert daemon.missed_deadlines == 1
+
 
 @pytest.fixture
 def sensor():
@@ -139,8 +244,16 @@ def test_meter_measure(meter_source, timer, sensor, temp_meter_config, temp_mete
     expected_humidity = 200.1
     sensor.measure.side_effect = [(math.nan, math.nan), (expected_temp, expected_humidity)]
 
+    labels = {'source': meter_source}
+    initial_reads = REGISTRY.get_sample_value('tempd_sensor_read_seconds_count', labels) or 0
+    initial_retries = REGISTRY.get_sample_value('tempd_sensor_nan_retries_sum', labels) or 0
+
     measurement = temp_meter.measure()
 
+    assert REGISTRY.get_sample_value('tempd_sensor_read_seconds_count', labels) == \
+        initial_reads + 1
+    assert REGISTRY.get_sample_value('tempd_sensor_nan_retries_sum', labels) == \
+        initial_retries + 1
     assert measurement.source == meter_source
     assert measurement.timestamp == expected_epoch_secs
     assert measurement.temperature == expected_temp
@@ -203,3 +316,506 @@ def test_cloudwatch_recorder_record(cloudwatch, cw_namespace,
             expected_metric('humidity', measurement.humidity)
         ]
     )
+
+def test_cloudwatch_recorder_batches_measurements(cloudwatch, boto_session, cw_namespace):
+    """Check measurements are buffered until the batch is full, and then sent
+    with as few calls as possible"""
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session, cw_namespace,
+        batch_size=600)
+    measurements = [TempMeasurement('foo_source', i, 20.1, 40.2) for i in range(600)]
+
+    for measurement in measurements[:-1]:
+        cloudwatch_recorder.record(measurement)
+    cloudwatch.put_metric_data.assert_not_called()
+    cloudwatch_recorder.record(measurements[-1])
+
+    assert cloudwatch.put_metric_data.call_count == 2
+    sent_metric_data = [metric_data
+                        for _args, kwargs in cloudwatch.put_metric_data.call_args_list
+                        for metric_data in kwargs['MetricData']]
+    assert len(sent_metric_data) == 2 * len(measurements)
+    assert [metric_data['Timestamp'] for metric_data in sent_metric_data[::2]] == \
+        list(range(600))
+
+def test_cloudwatch_recorder_flushes_old_batches(cloudwatch, boto_session, timer):
+    """Check the buffer is flushed when the oldest measurement is too old"""
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session,
+        batch_size=100, max_batch_age=60, timer=timer)
+    timer.time.side_effect = [0, 30, 30, 61]
+
+    cloudwatch_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    cloudwatch_recorder.record(TempMeasurement('foo_source', 30, 20.1, 40.2))
+    cloudwatch.put_metric_data.assert_not_called()
+    cloudwatch_recorder.record(TempMeasurement('foo_source', 61, 20.1, 40.2))
+
+    cloudwatch.put_metric_data.assert_called_once()
+    assert len(cloudwatch.put_metric_data.call_args[1]['MetricData']) == 6
+
+def test_cloudwatch_recorder_keeps_buffer_on_failure(cloudwatch, boto_session):
+    """Check buffered metrics are retried on the next flush when
+    put_metric_data fails"""
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session, batch_size=2)
+    cloudwatch.put_metric_data.side_effect = [RuntimeError("Forcing a runtime error"), None]
+
+    cloudwatch_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    with pytest.raises(RuntimeError):
+        cloudwatch_recorder.record(TempMeasurement('foo_source', 1, 20.1, 40.2))
+    cloudwatch_recorder.flush()
+
+    assert cloudwatch.put_metric_data.call_count == 2
+    assert len(cloudwatch.put_metric_data.call_args[1]['MetricData']) == 4
+
+def test_cloudwatch_recorder_record_statistics(cloudwatch, storage_resolution,
+    cloudwatch_recorder):
+    """Check statistics are sent to cloudwatch as statistic sets"""
+    statistics = TempStatistics('foo_source', 60, StatisticSet(20, 22, 42, 2),
+                                StatisticSet(48, 50, 98, 2))
+
+    cloudwatch_recorder.record_statistics(statistics)
+
+    temp_metric, humidity_metric = cloudwatch.put_metric_data.call_args[1]['MetricData']
+    assert temp_metric == {
+        'MetricName': 'temperature',
+        'Dimensions': [{'Name': 'source', 'Value': 'foo_source'}],
+        'Timestamp': 60,
+        'StatisticValues': {'SampleCount': 2.0, 'Sum': 42, 'Minimum': 20, 'Maximum': 22},
+        'StorageResolution': storage_resolution
+    }
+    assert humidity_metric['StatisticValues'] == \
+        {'SampleCount': 2.0, 'Sum': 98, 'Minimum': 48, 'Maximum': 50}
+
+def test_cloudwatch_recorder_batches_while_throttled(cloudwatch, boto_session, timer):
+    """Check that after a throttling error the measurements are buffered
+    until the rate limiter allows another call"""
+    timer.time.return_value = 0
+    rate_limiter = AdaptiveRateLimiter(1, timer=timer)
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session, batch_size=1,
+        rate_limiter=rate_limiter, timer=timer)
+    cloudwatch.put_metric_data.side_effect = [CloudwatchError('Throttling', 'Rate exceeded', 400),
+                                              None]
+
+    with pytest.raises(CloudwatchError):
+        cloudwatch_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    for timestamp in range(1, 3):
+        cloudwatch_recorder.record(TempMeasurement('foo_source', timestamp, 20.1, 40.2))
+    assert cloudwatch.put_metric_data.call_count == 1
+    assert rate_limiter.rate == 0.5
+    assert cloudwatch_recorder.backpressure > 0
+    timer.time.return_value = 2
+    cloudwatch_recorder.record(TempMeasurement('foo_source', 3, 20.1, 40.2))
+
+    assert cloudwatch.put_metric_data.call_count == 2
+    assert len(cloudwatch.put_metric_data.call_args[1]['MetricData']) == 8
+    assert rate_limiter.rate == pytest.approx(0.6)
+    assert cloudwatch_recorder.backpressure == 0
+
+def test_cloudwatch_recorder_compacts_full_buffer(cloudwatch, boto_session, monkeypatch):
+    """Check the buffered metrics are merged into statistic sets instead of
+    discarding them when the buffer is full"""
+    monkeypatch.setattr(CloudwatchMeasurementRecorder, 'max_buffered_metric_data', 20)
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session, batch_size=1000)
+
+    for timestamp in range(0, 300, 10):
+        cloudwatch_recorder.record(TempMeasurement('foo_source', timestamp, timestamp, 40.0))
+    cloudwatch_recorder.flush()
+
+    metric_data = cloudwatch.put_metric_data.call_args[1]['MetricData']
+    temperatures = [metric for metric in metric_data if metric['MetricName'] == 'temperature']
+    assert [metric['Timestamp'] for metric in temperatures] == [0, 60, 120, 180, 240,
+                                                                270, 280, 290]
+    assert temperatures[1]['StatisticValues'] == \
+        {'SampleCount': 6.0, 'Sum': 510, 'Minimum': 60, 'Maximum': 110}
+    assert sum(metric['StatisticValues']['SampleCount'] for metric in temperatures[:5]) == 27
+
+def test_cloudwatch_recorder_compacts_once_per_full_buffer(cloudwatch, boto_session,
+                                                           monkeypatch):
+    """Check a buffer that can't be compacted discards down to half its size,
+    instead of being compacted again on each measurement"""
+    monkeypatch.setattr(CloudwatchMeasurementRecorder, 'max_buffered_metric_data', 20)
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session, batch_size=1000)
+    initial_compactions = REGISTRY.get_sample_value('tempd_cloudwatch_compactions_total') or 0
+
+    for source in range(15):
+        cloudwatch_recorder.record(TempMeasurement(f"source_{source}", 0, 20.0, 40.0))
+    assert cloudwatch_recorder.backpressure == 18 / 20
+    cloudwatch_recorder.flush()
+
+    assert REGISTRY.get_sample_value('tempd_cloudwatch_compactions_total') - \
+        initial_compactions == len(CloudwatchMeasurementRecorder.compaction_windows)
+    metric_data = cloudwatch.put_metric_data.call_args[1]['MetricData']
+    assert [metric['Dimensions'][0]['Value'] for metric in metric_data[::2]] == \
+        [f"source_{source}" for source in range(6, 15)]
+
+def test_async_recorder_sheds_while_throttled(cloudwatch, boto_session, timer, monkeypatch):
+    """Check measurements of each source are shed while the cloudwatch
+    recorder is throttled and its buffer fills up, and not once it catches up"""
+    monkeypatch.setattr(CloudwatchMeasurementRecorder, 'max_buffered_metric_data', 200)
+    timer.time.return_value = 0
+    rate_limiter = AdaptiveRateLimiter(1, timer=timer)
+    cloudwatch_recorder = CloudwatchMeasurementRecorder(boto_session, batch_size=1,
+        rate_limiter=rate_limiter, timer=timer)
+    async_recorder = AsyncMeasurementRecorder(cloudwatch_recorder, queue_size=1000,
+        backpressure=lambda: cloudwatch_recorder.backpressure)
+    labels = {'recorder': 'CloudwatchMeasurementRecorder'}
+    initial_shed = REGISTRY.get_sample_value('tempd_recorder_shed_measurements_total',
+                                             labels) or 0
+    cloudwatch.put_metric_data.side_effect = CloudwatchError('Throttling', 'Rate exceeded', 400)
+
+    for timestamp in range(40):
+        for source in ['foo_source', 'bar_source']:
+            async_recorder.record(TempMeasurement(source, timestamp, 20.1, 40.2))
+        time.sleep(0.001)
+    cloudwatch.put_metric_data.side_effect = None
+    timer.time.return_value = 100
+    async_recorder.flush()
+
+    shed = REGISTRY.get_sample_value('tempd_recorder_shed_measurements_total', labels) - \
+        initial_shed
+    assert shed > 0
+    (metric_data,) = [call[1]['MetricData']
+                      for call in cloudwatch.put_metric_data.call_args_list[1:]]
+    assert len(metric_data) == 2 * (80 - shed)
+    assert {metric['Dimensions'][0]['Value'] for metric in metric_data[-8:]} == \
+        {'foo_source', 'bar_source'}
+    assert cloudwatch_recorder.backpressure == 0
+    timer.time.return_value = 200
+    async_recorder.record(TempMeasurement('foo_source', 100, 20.1, 40.2))
+    async_recorder.flush()
+    assert REGISTRY.get_sample_value('tempd_recorder_shed_measurements_total', labels) - \
+        initial_shed == shed
+    assert cloudwatch.put_metric_data.call_args[1]['MetricData'][0]['Timestamp'] == 100
+
+def test_main_creates_rate_limiter():
+    """Check the rate limiter configuration is validated"""
+    recorder = Main({'cloudwatch': {'throttling': {'max_calls_per_second': 2}}}) \
+        .create_cloudwatch_recorder()
+    assert recorder.backpressure == 0
+    _, _, backpressure = Main({'cloudwatch': {'throttling': {'max_calls_per_second': 2}}}) \
+        .create_cloudwatch_recorders(None)
+    assert backpressure is not None and backpressure() == 0
+    assert Main({}).create_cloudwatch_recorders(None)[2] is None
+    for throttling_conf in [{}, {'max_calls_per_second': 2, 'min_calls_per_second': 3}]:
+        with pytest.raises(ConfigError):
+            Main({'cloudwatch': {'throttling': throttling_conf}}).create_cloudwatch_recorder()
+
+
+@pytest.fixture
+def recorder():
+    """Mock for a measurement recorder"""
+    return Mock()
+
+def test_async_recorder_records_on_worker(recorder):
+    """Check the wrapped recorder is used from the worker thread, and that
+    flushing waits for the queued measurements"""
+    recording_threads = []
+    recorder.record.side_effect = lambda _: recording_threads.append(threading.current_thread())
+    async_recorder = AsyncMeasurementRecorder(recorder)
+    measurements = [TempMeasurement('foo_source', i, 20.1, 40.2) for i in range(3)]
+
+    for measurement in measurements:
+        async_recorder.record(measurement)
+    async_recorder.flush()
+
+    assert [args[0] for args, _kwargs in recorder.record.call_args_list] == measurements
+    assert threading.current_thread() not in recording_threads
+    recorder.flush.assert_called_once()
+
+def test_async_recorder_survives_recorder_exceptions(recorder):
+    """Check the worker keeps recording after the recorder fails, counting
+    the failures and timing the records"""
+    recorder.record.side_effect = [RuntimeError("Forcing a runtime error"), None]
+    async_recorder = AsyncMeasurementRecorder(recorder)
+    labels = {'recorder': 'Mock'}
+    initial_failures = REGISTRY.get_sample_value('tempd_recorder_failures_total', labels) or 0
+    initial_records = REGISTRY.get_sample_value('tempd_recorder_record_seconds_count',
+                                                labels) or 0
+
+    async_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    async_recorder.record(TempMeasurement('foo_source', 1, 20.1, 40.2))
+    async_recorder.flush()
+
+    assert recorder.record.call_count == 2
+    assert REGISTRY.get_sample_value('tempd_recorder_failures_total', labels) == \
+        initial_failures + 1
+    assert REGISTRY.get_sample_value('tempd_recorder_record_seconds_count', labels) == \
+        initial_records + 2
+
+@pytest.mark.parametrize("overflow_policy,expected_timestamps", [
+    ('drop_oldest', [0, 2]),
+    ('drop_newest', [0, 1]),
+])
+def test_async_recorder_overflow_policy(recorder, overflow_policy, expected_timestamps):
+    """Check the overflow policy is applied when the queue is full"""
+    recording = threading.Event()
+    release = threading.Event()
+    def slow_record(_measurement):
+        recording.set()
+        release.wait(5)
+    recorder.record.side_effect = slow_record
+    async_recorder = AsyncMeasurementRecorder(recorder, queue_size=1,
+        overflow_policy=overflow_policy)
+
+    async_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    recording.wait(5)
+    async_recorder.record(TempMeasurement('foo_source', 1, 20.1, 40.2))
+    async_recorder.record(TempMeasurement('foo_source', 2, 20.1, 40.2))
+    release.set()
+    async_recorder.flush()
+
+    assert [args[0].timestamp for args, _kwargs in recorder.record.call_args_list] == \
+        expected_timestamps
+
+def test_async_recorder_flush_times_out(recorder):
+    """Check flushing a stuck recorder with a full queue gives up after the
+    timeout, counting the dropped flush"""
+    recording = threading.Event()
+    release = threading.Event()
+    def stuck_record(_measurement):
+        recording.set()
+        release.wait(5)
+    recorder.record.side_effect = stuck_record
+    async_recorder = AsyncMeasurementRecorder(recorder, queue_size=1, flush_timeout=0.2)
+    labels = {'recorder': 'Mock'}
+    initial_dropped = REGISTRY.get_sample_value('tempd_recorder_dropped_flushes_total',
+                                                labels) or 0
+
+    async_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    recording.wait(5)
+    async_recorder.record(TempMeasurement('foo_source', 1, 20.1, 40.2))
+    start = time.monotonic()
+    async_recorder.flush()
+    elapsed = time.monotonic() - start
+    release.set()
+
+    assert 0.2 <= elapsed < 1
+    assert REGISTRY.get_sample_value('tempd_recorder_dropped_flushes_total', labels) == \
+        initial_dropped + 1
+    recorder.flush.assert_not_called()
+
+def test_async_recorder_keeps_pending_flushes(recorder):
+    """Check measurements recorded after a flush on a full queue don't
+    discard the flush, that only returns after flushing the recorder"""
+    recording = threading.Event()
+    release = threading.Event()
+    def slow_record(_measurement):
+        recording.set()
+        release.wait(5)
+    recorder.record.side_effect = slow_record
+    async_recorder = AsyncMeasurementRecorder(recorder, queue_size=2)
+    labels = {'recorder': 'Mock'}
+
+    async_recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+    recording.wait(5)
+    async_recorder.record(TempMeasurement('foo_source', 1, 20.1, 40.2))
+    flush = threading.Thread(target=async_recorder.flush)
+    flush.start()
+    deadline = time.monotonic() + 5
+    while REGISTRY.get_sample_value('tempd_recorder_queue_depth', labels) < 2 and \
+        time.monotonic() < deadline:
+        time.sleep(0.01)
+    for timestamp in range(2, 5):
+        async_recorder.record(TempMeasurement('foo_source', timestamp, 20.1, 40.2))
+    flush.join(0.2)
+    assert flush.is_alive()
+    recorder.flush.assert_not_called()
+    release.set()
+    flush.join(5)
+
+    assert not flush.is_alive()
+    recorder.flush.assert_called_once()
+    assert [args[0].timestamp for args, _kwargs in recorder.record.call_args_list] == [0, 4]
+
+
+def test_main_creates_pool_daemon_for_sensors():
+    """Check a pool daemon is used when several sensors are configured"""
+    config = {
+        'measurement': {
+            'frequency_in_seconds': '5.0',
+            'sensors': [
+                {'source_name': 'foo_source', 'sensor_type': 'dht11', 'port': 7},
+                {'source_name': 'bar_source', 'sensor_type': 'sht31', 'i2c_address': '0x45',
+                 'frequency_in_seconds': 10, 'periodic_mps': 2}
+            ]
+        }
+    }
+
+    daemon = Main(config).create_deamon()
+
+    assert isinstance(daemon, PoolDaemon)
+
+def test_main_rejects_unknown_sensor_settings():
+    """Check invalid sensor settings are reported as configuration errors"""
+    sensor_conf = {'source_name': 'foo_source', 'sensor_type': 'sht31', 'periodic_mps': 3}
+
+    with pytest.raises(ConfigError):
+        Main.create_sensor(sensor_conf)
+
+def test_main_creates_storage(tmp_path):
+    """Check the storage is stored under the agent root by default, and
+    requires a directory otherwise"""
+    config = {'storage': {'raw_retention_in_days': 0.5}}
+
+    storage = Main(config, str(tmp_path)).create_storage()
+
+    assert storage is not None
+    assert storage.directory == str(tmp_path / 'log' / 'storage')
+    assert Main({}).create_storage() is None
+    with pytest.raises(ConfigError):
+        Main(config)
+
+def test_daemon_period_changes_next_deadline(action, daemon_frequency,
+    timer, daemon_mock_timer):
+    """Check a period changed by the action is used for the next deadline"""
+    daemon = daemon_mock_timer
+    timer.time.side_effect = [0, 0, 1, 1]
+    def change_period():
+        daemon.period = daemon_frequency / 2
+    action.side_effect = change_period
+    timer.wait.side_effect = lambda _event, _timeout: daemon.stop()
+
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=2*daemon_frequency)
+    assert not daemon.running
+    _event, wait_time = timer.wait.call_args[0]
+    assert wait_time == daemon_frequency / 2 - 1
+
+def test_main_adapts_sampling_period():
+    """Check adaptive sampling is configured within the sensor limits, and
+    the daemon period follows the period of the meter"""
+    config = {
+        'measurement': {
+            'source_name': 'foo_source',
+            'frequency_in_seconds': '2',
+            'adaptive_sampling': {'min_period_in_seconds': 1}
+        }
+    }
+    main = Main(config)
+    ((_frequency, meter),) = main.create_temp_meters()
+    # The DHT11 sensor can't measure more often than each 5 seconds
+    assert meter.period == 5
+
+    recorder = Mock()
+    with patch.object(Main, 'create_temp_meters', return_value=[(20.0, meter)]), \
+        patch.object(Main, 'create_measurement_recorders', return_value=([recorder], None)):
+        daemon = main.create_deamon()
+    assert isinstance(daemon, ThreadDaemon)
+    recorder.record.side_effect = lambda _measurement: daemon.stop()
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=5)
+    assert not daemon.running
+    assert daemon.period == 5
+
+def test_main_adapts_sampling_period_without_sensor_limit():
+    """Check adaptive sampling of a sensor without a minimum period uses the
+    configured period as minimum, and invalid periods are reported"""
+    config = {
+        'measurement': {
+            'source_name': 'foo_source',
+            'sensor_type': 'synthetic',
+            'frequency_in_seconds': '2',
+            'adaptive_sampling': {}
+        }
+    }
+    ((_frequency, meter),) = Main(config).create_temp_meters()
+    assert meter.period == 2
+
+    config['measurement']['adaptive_sampling'] = {'min_period_in_seconds': 0}
+    with pytest.raises(ConfigError):
+        Main(config).create_temp_meters()
+
+def test_main_profiles_cycles(tmp_path):
+    """Check the measurement cycles are profiled under the agent root
+    when profiling is configured"""
+    config = {
+        'measurement': {'source_name': 'foo_source', 'frequency_in_seconds': '2'},
+        'profiling': {'every_cycles': 1}
+    }
+    meter = Mock()
+    meter.source_name = 'foo_source'
+    meter.period = None
+    meter.measure.return_value = TempMeasurement('foo_source', 0, 20.1, 40.2)
+    recorder = Mock()
+    main = Main(config, str(tmp_path))
+    with patch.object(Main, 'create_temp_meters', return_value=[(2.0, meter)]), \
+        patch.object(Main, 'create_measurement_recorders', return_value=([recorder], None)):
+        daemon = main.create_deamon()
+    recorder.record.side_effect = lambda _measurement: daemon.stop()
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=5)
+    assert not daemon.running
+    (profile,) = os.listdir(tmp_path / 'log' / 'profiles')
+    assert profile.startswith('foo_source-') and profile.endswith('-1.pstats')
+    assert Main({}).create_profiler() is None
+    with pytest.raises(ConfigError):
+        Main({'profiling': {'mode': 'perf'}}, str(tmp_path))
+
+def test_main_stops_profiler_with_daemon(tmp_path):
+    """Check the profiler stops tracing the allocations when the daemon stops"""
+    config = {
+        'measurement': {'source_name': 'foo_source', 'frequency_in_seconds': '2'},
+        'profiling': {'mode': 'tracemalloc', 'every_cycles': 1}
+    }
+    meter = Mock()
+    meter.source_name = 'foo_source'
+    meter.period = None
+    meter.measure.return_value = TempMeasurement('foo_source', 0, 20.1, 40.2)
+    recorder = Mock()
+    main = Main(config, str(tmp_path))
+    assert tracemalloc.is_tracing()
+    with patch.object(Main, 'create_temp_meters', return_value=[(2.0, meter)]), \
+        patch.object(Main, 'create_measurement_recorders', return_value=([recorder], None)):
+        daemon = main.create_deamon()
+    recorder.record.side_effect = lambda _measurement: daemon.stop()
+    daemon.start(blocking=False)
+
+    daemon.wait_for_completion(timeout=5)
+    assert not daemon.running
+    assert not tracemalloc.is_tracing()
+    (profile,) = os.listdir(tmp_path / 'log' / 'profiles')
+    assert profile.endswith('-1.snapshot')
+
+def test_main_expands_synthetic_fleets():
+    """Check a synthetic sensor with a fleet size is measured as that number
+    of sensors"""
+    config = {
+        'measurement': {
+            'frequency_in_seconds': '5.0',
+            'sensors': [
+                {'source_name': 'foo_source', 'sensor_type': 'synthetic', 'fleet_size': 3,
+                 'seed': 10, 'nan_rate': 0.5},
+                {'source_name': 'bar_source', 'sensor_type': 'synthetic', 'frequency_in_seconds': 1}
+            ]
+        }
+    }
+
+    meters = Main(config).create_temp_meters()
+
+    assert [(frequency, meter.source_name) for frequency, meter in meters] == \
+        [(5.0, 'foo_source-0'), (5.0, 'foo_source-1'), (5.0, 'foo_source-2'), (1.0, 'bar_source')]
+    measurement = meters[1][1].measure()
+    assert (measurement.source, math.isnan(measurement.temperature)) == ('foo_source-1', False)
+
+def test_main_creates_gateway_recorder(tmp_path):
+    """Check the measurements are pushed to the gateway when it is configured,
+    that can't be used with the spool"""
+    main = Main({'gateway': {'address': '127.0.0.1', 'batch_size': 5}})
+    with patch.object(Main, 'create_cloudwatch_recorder') as create_cloudwatch_recorder:
+        main.create_measurement_recorders()
+    assert main.create_gateway_recorder() is not None
+    create_cloudwatch_recorder.assert_not_called()
+
+    with pytest.raises(ConfigError):
+        Main({'gateway': {'address': '127.0.0.1'}, 'spool': {}},
+             str(tmp_path)).create_measurement_recorders()
+    with pytest.raises(ConfigError):
+        Main({'gateway': {}}).create_gateway_recorder()
+    with pytest.raises(ConfigError):
+        Main({'gateway': {'address': '127.0.0.1', 'secret': ''}}).create_gateway_recorder()
+
+def test_main_rejects_invalid_gateway_allowed_networks():
+    """Check the allowed networks of the gateway are validated"""
+    with pytest.raises(ConfigError):
+        Main({'gateway_server': {'allowed_networks': ['192.168.1.0/33']}}).run_gateway()
@@ -0,0 +1,44 @@
+"""
+Test for the module tempd.aggregation
+"""
+
+from unittest.mock import Mock
+
+from tempd.types import StatisticSet, TempMeasurement, TempStatistics
+from tempd.aggregation import AggregatingMeasurementRecorder, aggregate
+
+
+def test_aggregate_per_source_and_window():
+    """Check measurements are summarized per source and window"""
+    measurements = [
+        TempMeasurement('foo_source', 0, 20, 50),
+        TempMeasurement('bar_source', 10, 25, 40),
+        TempMeasurement('foo_source', 59, 22, 48),
+        TempMeasurement('foo_source', 60, 23, 47),
+    ]
+
+    statistics = aggregate(measurements, 60)
+
+    assert statistics == [
+        TempStatistics('foo_source', 0, StatisticSet(20, 22, 42, 2), StatisticSet(48, 50, 98, 2)),
+        TempStatistics('bar_source', 0, StatisticSet(25, 25, 25, 1), StatisticSet(40, 40, 40, 1)),
+        TempStatistics('foo_source', 60, StatisticSet(23, 23, 23, 1), StatisticSet(47, 47, 47, 1)),
+    ]
+
+def test_aggregating_recorder_records_complete_windows():
+    """Check statistics are recorded when a window is complete, and
+    on flush for the current windows"""
+    recorder = Mock()
+    aggregating_recorder = AggregatingMeasurementRecorder(recorder, 60)
+
+    for timestamp in range(0, 120, 2):
+        aggregating_recorder.record(TempMeasurement('foo_source', timestamp, 20, 50))
+    recorder.record_statistics.assert_called_once()
+    statistics = recorder.record_statistics.call_args[0][0]
+    assert (statistics.timestamp, statistics.temperature.count) == (0, 30)
+
+    aggregating_recorder.flush()
+
+    statistics = recorder.record_statistics.call_args[0][0]
+    assert (statistics.timestamp, statistics.temperature.count) == (60, 30)
+    recorder.flush.assert_called_once()
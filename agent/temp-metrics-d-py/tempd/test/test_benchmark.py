@@ -0,0 +1,41 @@
+"""
+Test for the module tempd.benchmark
+"""
+
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from tempd.benchmark import CloudwatchStub, benchmark_cloudwatch, benchmark_cycle
+
+
+def put_metric_data(url: str) -> int:
+    """Call PutMetricData with the query protocol, returning the status"""
+    body = urllib.parse.urlencode({
+        'Action': 'PutMetricData', 'Version': '2010-08-01', 'Namespace': 'foo',
+        'MetricData.member.1.MetricName': 'temperature',
+        'MetricData.member.1.Value': '20.1'}).encode('utf-8')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=body)) as response:
+            assert b'<PutMetricDataResponse' in response.read()
+            return int(response.status)
+    except urllib.error.HTTPError as http_error:
+        assert b'<Code>Throttling</Code>' in http_error.read()
+        return int(http_error.code)
+
+def test_cloudwatch_stub_failures():
+    """Check the stub fails the configured fraction of the calls"""
+    with CloudwatchStub(throttling_rate=0.5, seed=1) as stub:
+        statuses = [put_metric_data(stub.url) for _ in range(40)]
+
+    assert stub.requests == 40
+    assert stub.failures == statuses.count(400)
+    assert 10 < stub.failures < 30
+    assert stub.metric_data == statuses.count(200)
+
+def test_benchmarks_run():
+    """Check the benchmarks report their results"""
+    assert benchmark_cycle(50)['cycles'] == 50
+    results = benchmark_cloudwatch(20, latency=0, batch_size=5)
+    assert (results['requests'], results['failures']) == (4, 0)
+    assert results['measurements_per_second'] > 0
@@ -0,0 +1,280 @@
+"""
+Test for the module tempd.cloudwatch
+"""
+
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import socket
+import threading
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs
+
+import botocore.auth
+import botocore.credentials
+import botocore.exceptions
+import botocore.serialize
+import botocore.session
+from botocore.awsrequest import AWSRequest
+from prometheus_client import REGISTRY
+import pytest
+
+from tempd.agent import CloudwatchMeasurementRecorder, ConfigError, Main
+from tempd.benchmark import CloudwatchStub
+from tempd.cloudwatch import CloudwatchError, ConnectionPolicy, Credentials, Session
+from tempd.cloudwatch import create_boto3_session, encode_put_metric_data, is_throttling
+from tempd.cloudwatch import sign_request
+from tempd.types import RetryPolicy, TempMeasurement
+
+_TIMESTAMP = 1625097600.0
+
+
+def fake_timer():
+    """Timer at a fixed time, that doesn't sleep"""
+    timer = Mock()
+    timer.time.return_value = _TIMESTAMP
+    return timer
+
+def sample(name: str) -> float:
+    """Value of a counter of the module"""
+    return REGISTRY.get_sample_value(f"tempd_cloudwatch_{name}_total") or 0
+
+def metric_data():
+    """Metrics like the ones of CloudwatchMeasurementRecorder"""
+    return [
+        {'MetricName': 'temperature', 'Dimensions': [{'Name': 'source', 'Value': 'foo bar'}],
+         'Timestamp': 1625097600, 'Value': 20.1, 'StorageResolution': 60},
+        {'MetricName': 'humidity', 'Dimensions': [{'Name': 'source', 'Value': 'foo bar'}],
+         'Timestamp': 1625097660.5, 'StorageResolution': 1,
+         'StatisticValues': {'SampleCount': 3.0, 'Sum': 150.5, 'Minimum': 40.0,
+                             'Maximum': 60.5}},
+    ]
+
+@pytest.mark.parametrize("token", [None, 'session-token'])
+def test_sign_request_like_botocore(token):
+    """Check the signature is the same as the one of botocore"""
+    credentials = Credentials('AKIDEXAMPLE', 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', token)
+    url = 'https://monitoring.eu-west-1.amazonaws.com/'
+    body = encode_put_metric_data('temp_agent', metric_data())
+    headers = sign_request(credentials, 'eu-west-1', url, body, _TIMESTAMP)
+
+    request = AWSRequest(method='POST', url=url, data=body,
+                         headers={'Content-Type': headers['content-type']})
+    now = datetime.datetime.fromtimestamp(_TIMESTAMP, datetime.timezone.utc) \
+        .replace(tzinfo=None)
+    with patch('botocore.auth.get_current_datetime', return_value=now):
+        botocore.auth.SigV4Auth(botocore.credentials.Credentials(
+            credentials.access_key, credentials.secret_key, token),
+            'monitoring', 'eu-west-1').add_auth(request)
+
+    assert headers['authorization'] == request.headers['Authorization']
+    assert headers['x-amz-date'] == request.headers['X-Amz-Date']
+
+def test_encode_put_metric_data_like_botocore():
+    """Check the body of the call has the same parameters as the one of botocore"""
+    params = {'Namespace': 'temp_agent', 'MetricData': metric_data()}
+    operation = botocore.session.get_session().get_service_model('cloudwatch') \
+        .operation_model('PutMetricData')
+    expected = dict(botocore.serialize.QuerySerializer()
+                    .serialize_to_request(params, operation)['body'])
+
+    assert parse_qs(encode_put_metric_data('temp_agent', metric_data()).decode('utf-8')) == \
+        {key: [str(value)] for key, value in expected.items()}
+
+def test_client_records_metrics():
+    """Check the measurements of a recorder using the slim client reach the stub"""
+    with CloudwatchStub() as stub:
+        session = Session(Credentials('foo', 'bar'), 'us-east-1', endpoint_url=stub.url)
+        recorder = CloudwatchMeasurementRecorder(session, batch_size=5)
+        for timestamp in range(10):
+            recorder.record(TempMeasurement('foo', _TIMESTAMP + timestamp, 20.5, 40.0))
+
+    assert (stub.requests, stub.failures, stub.metric_data) == (2, 0, 20)
+
+@pytest.mark.parametrize("error_rate,throttling_rate,code", [(1, 0, 'InternalServiceFault'),
+                                                            (0, 1, 'Throttling')])
+def test_client_retries_failures(error_rate, throttling_rate, code):
+    """Check failed calls are retried with backoff up to the maximum attempts"""
+    timer = fake_timer()
+    with CloudwatchStub(error_rate=error_rate, throttling_rate=throttling_rate) as stub:
+        client = Session(Credentials('foo', 'bar'), 'us-east-1', endpoint_url=stub.url,
+                         retry_policy=RetryPolicy(max_attempts=4), timer=timer) \
+            .client('cloudwatch')
+        with pytest.raises(CloudwatchError) as error:
+            client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+
+    assert error.value.code == code
+    assert error.value.throttling == (throttling_rate == 1)
+    assert stub.requests == 4
+    delays = [args[0] for args, _kwargs in timer.sleep.call_args_list]
+    assert len(delays) == 3
+    assert all(0 <= delay <= 2 ** retry for retry, delay in enumerate(delays))
+
+def test_client_leaves_throttling_to_the_caller():
+    """Check throttling errors are not retried when disabled, unlike other errors,
+    and are detected for both backends"""
+    timer = fake_timer()
+    with CloudwatchStub(throttling_rate=1) as stub:
+        client = Session(Credentials('foo', 'bar'), 'us-east-1', endpoint_url=stub.url,
+                         retry_policy=RetryPolicy(retry_throttling=False), timer=timer) \
+            .client('cloudwatch')
+        with pytest.raises(CloudwatchError) as error:
+            client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+
+    assert stub.requests == 1
+    assert is_throttling(error.value)
+    assert is_throttling(botocore.exceptions.ClientError(
+        {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'PutMetricData'))
+    assert not is_throttling(CloudwatchError('InternalServiceFault', '', 500))
+    assert not is_throttling(RuntimeError())
+
+def test_client_retries_connection_errors():
+    """Check connection errors are retried, and raised after the last attempt"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        url = f"http://127.0.0.1:{probe.getsockname()[1]}"
+    timer = fake_timer()
+    client = Session(Credentials('foo', 'bar'), 'us-east-1', endpoint_url=url,
+                     timer=timer).client('cloudwatch')
+
+    with pytest.raises(ConnectionRefusedError):
+        client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+    assert timer.sleep.call_count == 2
+
+def test_session_reads_environment():
+    """Check the credentials and the region come from the environment"""
+    environment = {'AWS_ACCESS_KEY_ID': 'foo', 'AWS_SECRET_ACCESS_KEY': 'bar',
+                   'AWS_SESSION_TOKEN': '', 'AWS_DEFAULT_REGION': 'cn-north-1'}
+    with patch.dict(os.environ, environment):
+        os.environ.pop('AWS_REGION', None)
+        assert Credentials.from_environment() == Credentials('foo', 'bar')
+        assert Session().client('cloudwatch').url == \
+            'https://monitoring.cn-north-1.amazonaws.com.cn/'
+        with patch('tempd.cloudwatch.Session') as session:
+            Main({'cloudwatch': {'backend': 'slim', 'max_attempts': 5}}) \
+                .create_cloudwatch_recorder()
+        assert session.call_args[1]['retry_policy'] == RetryPolicy(max_attempts=5)
+        os.environ['AWS_SECRET_ACCESS_KEY'] = ''
+        with pytest.raises(ValueError):
+            Session()
+
+def test_main_reports_missing_region_for_slim_backend():
+    """Check a missing region is a configuration error with the slim backend,
+    while missing credentials use the fake client like with boto3"""
+    environment = {'AWS_ACCESS_KEY_ID': 'foo', 'AWS_SECRET_ACCESS_KEY': 'bar'}
+    with patch.dict(os.environ, environment):
+        os.environ.pop('AWS_REGION', None)
+        os.environ.pop('AWS_DEFAULT_REGION', None)
+        with pytest.raises(ConfigError, match='AWS_REGION or AWS_DEFAULT_REGION'):
+            Main({'cloudwatch': {'backend': 'slim'}}).create_cloudwatch_recorder()
+        os.environ['AWS_ACCESS_KEY_ID'] = ''
+        recorder = Main({'cloudwatch': {'backend': 'slim'}}).create_cloudwatch_recorder()
+        recorder.record(TempMeasurement('foo_source', 0, 20.1, 40.2))
+
+def test_client_keeps_connections_alive():
+    """Check consecutive calls reuse the same connection, and large bodies
+    are compressed"""
+    reused, sent_bytes = sample('reused_connections'), sample('sent_bytes')
+    with CloudwatchStub() as stub:
+        client = Session(Credentials('foo', 'bar'), 'us-east-1', endpoint_url=stub.url,
+                         connection_policy=ConnectionPolicy(min_compression_size=1000)) \
+            .client('cloudwatch')
+        for _ in range(4):
+            client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+        client.put_metric_data(Namespace='temp_agent', MetricData=metric_data() * 20)
+        client.close()
+
+    assert (stub.connections, stub.requests, stub.metric_data) == (1, 5, 48)
+    assert sample('reused_connections') - reused == 4
+    assert sample('sent_bytes') - sent_bytes == stub.received_bytes
+    assert stub.received_bytes < len(encode_put_metric_data('temp_agent', metric_data() * 20))
+
+def test_client_reconnects_when_idle_connection_closed():
+    """Check a call on a connection closed by the endpoint while idle is sent
+    on a new connection, without counting as a failed attempt"""
+    connections = []
+    class Handler(BaseHTTPRequestHandler):
+        """Answers one request per connection, closing it without telling"""
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self): # pylint: disable=invalid-name
+            """Answer and close"""
+            connections.append(self.client_address)
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            self.close_connection = True
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    timer = fake_timer()
+    try:
+        client = Session(Credentials('foo', 'bar'), 'us-east-1',
+                         endpoint_url=f"http://127.0.0.1:{server.server_port}",
+                         retry_policy=RetryPolicy(max_attempts=1), timer=timer) \
+            .client('cloudwatch')
+        for _ in range(3):
+            client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(set(connections)) == 3
+    assert timer.sleep.call_count == 0
+
+def test_boto3_session_retries_with_standard_mode():
+    """Check boto3 clients retry with the standard retry mode up to the
+    maximum attempts, and the throttling errors reach the caller after that"""
+    environment = {'AWS_ACCESS_KEY_ID': 'foo', 'AWS_SECRET_ACCESS_KEY': 'bar',
+                   'AWS_DEFAULT_REGION': 'us-east-1'}
+    with patch.dict(os.environ, environment), patch('botocore.endpoint.time.sleep') as sleep:
+        session = create_boto3_session(max_attempts=2)
+        for throttling_rate, error_rate in [(1, 0), (0, 1)]:
+            with CloudwatchStub(error_rate=error_rate, throttling_rate=throttling_rate) as stub:
+                client = session.client('cloudwatch', endpoint_url=stub.url)
+                with pytest.raises(botocore.exceptions.ClientError) as error:
+                    client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+            assert stub.requests == 2
+            assert is_throttling(error.value) == (throttling_rate == 1)
+        assert client.meta.config.retries == {'mode': 'standard', 'total_max_attempts': 2}
+        assert sleep.call_count == 2
+
+def test_main_uses_default_boto3_session():
+    """Check the boto3 clients are only configured when the configuration
+    changes their defaults"""
+    environment = {'AWS_ACCESS_KEY_ID': 'foo', 'AWS_SECRET_ACCESS_KEY': 'bar',
+                   'AWS_DEFAULT_REGION': 'us-east-1'}
+    with patch.dict(os.environ, environment), \
+        patch('tempd.cloudwatch.create_boto3_session') as create_session, \
+        patch('boto3.session.Session') as session:
+        Main({'cloudwatch': {'batch_size': 10}}).create_cloudwatch_recorder()
+        session.assert_called_once_with()
+        create_session.assert_not_called()
+        Main({'cloudwatch': {'throttling': {'max_calls_per_second': 2}, 'max_attempts': 4}}) \
+            .create_cloudwatch_recorder()
+        assert create_session.call_args[1] == {'max_attempts': 4}
+        Main({'cloudwatch': {'pool_size': 2}}).create_cloudwatch_recorder()
+        assert create_session.call_args[0][0].pool_size == 2
+        assert create_session.call_args[1] == {'max_attempts': None}
+
+def test_boto3_session_uses_connection_policy():
+    """Check the boto3 clients are configured with the policy, compress large
+    bodies and count the bytes they send"""
+    environment = {'AWS_ACCESS_KEY_ID': 'foo', 'AWS_SECRET_ACCESS_KEY': 'bar',
+                   'AWS_DEFAULT_REGION': 'us-east-1'}
+    sent_bytes = sample('sent_bytes')
+    with CloudwatchStub() as stub, patch.dict(os.environ, environment):
+        client = create_boto3_session(ConnectionPolicy(pool_size=3, min_compression_size=1000)) \
+            .client('cloudwatch', endpoint_url=stub.url)
+        client.put_metric_data(Namespace='temp_agent', MetricData=metric_data() * 20)
+        client.put_metric_data(Namespace='temp_agent', MetricData=metric_data())
+
+    assert (client.meta.config.max_pool_connections, client.meta.config.tcp_keepalive) == \
+        (3, True)
+    assert (stub.connections, stub.requests, stub.failures) == (1, 2, 0)
+    assert sample('sent_bytes') - sent_bytes == stub.received_bytes
+    assert stub.received_bytes < 2000
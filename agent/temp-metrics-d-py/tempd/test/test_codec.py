@@ -0,0 +1,52 @@
+"""
+Test for the module tempd.codec
+"""
+
+import random
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.spool import encode_measurement
+from tempd.codec import SeriesDecoder, SeriesEncoder, decode_frames, encode_frame
+
+
+def dht11_measurements(count: int):
+    """Measurements each 5 seconds with some jitter, with integer values
+    that change slowly, like the ones of a DHT11 sensor"""
+    rand = random.Random(42)
+    measurements, timestamp, temperature, humidity = [], 1600000000, 21.0, 45.0
+    for _ in range(count):
+        timestamp += 5 if rand.random() < 0.95 else 6
+        if rand.random() < 0.05:
+            temperature += rand.choice([-1, 1])
+        if rand.random() < 0.05:
+            humidity += rand.choice([-1, 1])
+        measurements.append(TempMeasurement('foo_source', timestamp, temperature, humidity))
+    return measurements
+
+def test_frames_round_trip_and_compress():
+    """Check frames are decoded as encoded, using less than a tenth of
+    the size of the spool records"""
+    measurements = dht11_measurements(1000)
+    data = encode_frame('foo_source', measurements[:600]) + \
+        encode_frame('foo_source', measurements[600:])
+
+    assert list(decode_frames(data)) == measurements
+    assert list(decode_frames(data[:-1])) == measurements[:600]
+    spool_size = sum(len(encode_measurement(measurement)) for measurement in measurements)
+    assert len(data) * 10 < spool_size
+
+def test_series_streaming():
+    """Check rows are decoded when fed byte by byte, and values are rounded
+    to the precision"""
+    encoder, decoder = SeriesEncoder(precision=1), SeriesDecoder(precision=1)
+    rows = [(10, 20.04, 40.0), (20, 20.06, 40.0), (30, 20.06, 40.0), (45, -3.5, 100.0)]
+    data = b''.join(encoder.encode(*row) for row in rows) + encoder.flush()
+
+    decoded = []
+    for byte in data:
+        decoded.extend(decoder.decode(bytes([byte])))
+    assert decoded == [(10, 20.0, 40.0), (20, 20.1, 40.0), (30, 20.1, 40.0), (45, -3.5, 100.0)]
+    with pytest.raises(ValueError):
+        encoder.encode(50, float('nan'), 40.0)
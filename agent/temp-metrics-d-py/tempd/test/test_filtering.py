@@ -0,0 +1,107 @@
+"""
+Test for the module tempd.filtering
+"""
+
+import random
+import statistics
+from unittest.mock import Mock
+
+from tempd.types import TempMeasurement
+from tempd.filtering import DeadbandFilter, FilteringMeasurementRecorder
+from tempd.filtering import HampelFilter, RangeFilter, apply_filters
+from tempd.filtering import _Window
+
+
+def measurements(values):
+    """Create measurements for a sequence of (temperature, humidity)"""
+    return [TempMeasurement('foo_source', timestamp, temperature, humidity)
+            for timestamp, (temperature, humidity) in enumerate(values)]
+
+def test_range_filter_discards_out_of_range_values():
+    """Check values out of range are discarded"""
+    range_filter = RangeFilter((0, 50), (20, 90))
+    valid, too_hot, too_humid = measurements([(25, 50), (51, 50), (25, 95)])
+
+    assert range_filter.apply(valid) == valid
+    assert range_filter.apply(too_hot) is None
+    assert range_filter.apply(too_humid) is None
+
+def test_hampel_filter_drops_spikes():
+    """Check spikes are dropped, while normal variations are kept"""
+    hampel_filter = HampelFilter(window_size=5, action='drop')
+    values = [(20.1, 50), (20.2, 51), (20.1, 50), (20.3, 50), (20.2, 49),
+              (20.3, 50), (20.2, 80), (20.4, 50)]
+
+    filtered = [hampel_filter.apply(measurement) for measurement in measurements(values)]
+
+    assert [measurement is not None for measurement in filtered] == \
+        [True, True, True, True, True, True, False, True]
+
+def test_hampel_filter_replaces_spikes_with_median():
+    """Check only the outlier value is replaced"""
+    hampel_filter = HampelFilter(window_size=3, action='replace')
+    values = [(20, 50), (20, 50), (20, 50), (35, 50)]
+
+    *_, filtered = [hampel_filter.apply(measurement) for measurement in measurements(values)]
+
+    assert (filtered.temperature, filtered.humidity) == (20, 50)
+
+def test_hampel_filter_accepts_lasting_changes():
+    """Check a lasting change is accepted once it fills half the window"""
+    hampel_filter = HampelFilter(window_size=5, action='drop')
+    values = [(20, 50)] * 5 + [(25, 50)] * 4
+
+    filtered = [hampel_filter.apply(measurement) for measurement in measurements(values)]
+
+    assert [measurement is not None for measurement in filtered[5:]] == \
+        [False, False, False, True]
+
+def test_hampel_filter_tracks_sources_independently():
+    """Check each source has its own window"""
+    hampel_filter = HampelFilter(window_size=3, action='drop')
+    for timestamp in range(3):
+        hampel_filter.apply(TempMeasurement('foo_source', timestamp, 20, 50))
+
+    assert hampel_filter.apply(TempMeasurement('bar_source', 3, 35, 50)) is not None
+    assert hampel_filter.apply(TempMeasurement('foo_source', 3, 35, 50)) is None
+
+def test_window_median_absolute_deviation():
+    """Check the MAD matches the median of the sorted absolute deviations,
+    for windows of odd and even sizes with repeated values"""
+    generator = random.Random(0)
+    for size in [1, 2, 5, 8]:
+        window = _Window(size)
+        values = []
+        for _ in range(50):
+            value = float(generator.randint(0, 10))
+            window.add(value)
+            values = (values + [value])[-size:]
+            median = window.median()
+            assert median == statistics.median(values)
+            assert window.median_absolute_deviation(median) == \
+                statistics.median(abs(other - median) for other in values)
+
+def test_apply_filters_stops_on_discard():
+    """Check filters after a discarding filter are not applied"""
+    measurement, = measurements([(200, 50)])
+    hampel_filter = HampelFilter(window_size=1)
+
+    assert apply_filters([RangeFilter(), hampel_filter], measurement) is None
+    assert apply_filters([hampel_filter], measurement) == measurement
+
+def test_deadband_filter():
+    """Check measurements are only kept when a value changes by more than
+    its threshold, or after the heartbeat"""
+    recorder = Mock()
+    deadband_recorder = FilteringMeasurementRecorder(recorder, [
+        DeadbandFilter(temperature_threshold=0.5, humidity_threshold=1.0, heartbeat=60)])
+    values = [(0, 20.0, 40.0), (10, 20.4, 40.0), (20, 21.0, 40.0), (30, 21.0, 41.0),
+              (40, 21.0, 41.5), (50, 21.0, 40.0), (110, 21.0, 40.0), (120, 21.0, 40.0)]
+    for timestamp, temperature, humidity in values:
+        deadband_recorder.record(TempMeasurement('foo', timestamp, temperature, humidity))
+    deadband_recorder.record(TempMeasurement('bar', 120, 21.0, 40.0))
+    deadband_recorder.flush()
+
+    assert [(args[0].source, args[0].timestamp) for args, _ in recorder.record.call_args_list] == \
+        [('foo', 0), ('foo', 20), ('foo', 40), ('foo', 50), ('foo', 110), ('bar', 120)]
+    recorder.flush.assert_called_once()
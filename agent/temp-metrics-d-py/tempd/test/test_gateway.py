@@ -0,0 +1,157 @@
+"""
+Test for the module tempd.gateway
+"""
+
+# This check is incompatible with pytests conventions
+# for fixtures
+# pylint: disable=redefined-outer-name
+import asyncio
+import socket
+from unittest.mock import Mock
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.codec import decode_frames, encode_frame
+from tempd.gateway import SIGNATURE_SIZE, Gateway, GatewayMeasurementRecorder, sign
+
+
+@pytest.fixture
+def recorder():
+    """Mock for the recorder of the gateway"""
+    return Mock()
+
+def recorded_timestamps(recorder: Mock):
+    """Timestamps of the measurements recorded with a mock recorder"""
+    return [args[0].timestamp for args, _kwargs in recorder.record.call_args_list]
+
+def measurements(source: str, timestamps):
+    """Measurements of a source on some timestamps"""
+    return [TempMeasurement(source, timestamp, (2000 + timestamp) / 100, 40.0)
+            for timestamp in timestamps]
+
+def test_gateway_discards_duplicates(recorder):
+    """Check repeated and late measurements are discarded, also when they arrive
+    out of order, as well as invalid datagrams"""
+    gateway = Gateway([recorder], dedup_window=100)
+
+    assert gateway.receive(encode_frame('foo', measurements('foo', [0, 10, 20]))) == 3
+    assert gateway.receive(encode_frame('foo', measurements('foo', [10, 5, 150])) +
+                           encode_frame('bar', measurements('bar', [10]))) == 3
+    assert gateway.receive(encode_frame('foo', measurements('foo', [40, 50, 60]))) == 1
+    assert gateway.receive(b'invalid') == 0
+
+    assert recorded_timestamps(recorder) == [0, 10, 20, 5, 150, 10, 60]
+
+def test_gateway_rejects_unsigned_datagrams(recorder):
+    """Check datagrams without a valid signature are discarded when the
+    gateway has a secret"""
+    gateway = Gateway([recorder], secret=b'foo')
+    frame = encode_frame('foo', measurements('foo', [0, 10]))
+
+    assert gateway.receive(frame) == 0
+    assert gateway.receive(sign(b'bar', frame) + frame) == 0
+    assert gateway.receive(sign(b'foo', frame)[:-1] + frame) == 0
+    assert gateway.receive(b'') == 0
+    assert gateway.receive(sign(b'foo', frame) + frame) == 2
+
+    assert recorded_timestamps(recorder) == [0, 10]
+
+def test_gateway_rejects_senders_not_allowed(recorder):
+    """Check datagrams from addresses out of the allowed networks are discarded"""
+    gateway = Gateway([recorder], allowed_networks=['192.168.1.0/24', '::1'])
+
+    assert gateway.receive(encode_frame('foo', measurements('foo', [0])), ('10.0.0.1', 8100)) == 0
+    assert gateway.receive(encode_frame('foo', measurements('foo', [10])), None) == 0
+    assert gateway.receive(encode_frame('foo', measurements('foo', [20])), ('foo', 8100)) == 0
+    assert gateway.receive(encode_frame('foo', measurements('foo', [30])),
+                           ('192.168.1.20', 8100)) == 1
+    assert gateway.receive(encode_frame('foo', measurements('foo', [40])), ('::1', 8100)) == 1
+
+    assert recorded_timestamps(recorder) == [30, 40]
+
+def test_gateway_recorder_batches_datagrams():
+    """Check measurements are sent in batches, with datagrams up to
+    the maximum size"""
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    gateway_recorder = GatewayMeasurementRecorder('127.0.0.1', receiver.getsockname()[1],
+                                                  batch_size=200, max_datagram_size=100)
+    sent = measurements('foo', range(0, 150)) + measurements('bar', range(0, 50))
+    try:
+        for measurement in sent[:-1]:
+            gateway_recorder.record(measurement)
+        receiver.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            receiver.recv(100)
+        receiver.setblocking(True)
+        gateway_recorder.record(sent[-1])
+        received = []
+        while len(received) < len(sent):
+            datagram = receiver.recv(2048)
+            assert len(datagram) <= 100
+            received.extend(decode_frames(datagram))
+    finally:
+        gateway_recorder.close()
+        receiver.close()
+
+    assert received == sent
+
+def test_gateway_recorder_signs_datagrams():
+    """Check datagrams are signed with the secret, and still fit in the
+    maximum size"""
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    gateway_recorder = GatewayMeasurementRecorder('127.0.0.1', receiver.getsockname()[1],
+                                                  batch_size=50, max_datagram_size=100,
+                                                  secret=b'foo')
+    sent = measurements('foo', range(0, 50))
+    try:
+        for measurement in sent:
+            gateway_recorder.record(measurement)
+        received = []
+        while len(received) < len(sent):
+            datagram = receiver.recv(2048)
+            assert len(datagram) <= 100
+            signature, frames = datagram[:SIGNATURE_SIZE], datagram[SIGNATURE_SIZE:]
+            assert signature == sign(b'foo', frames)
+            received.extend(decode_frames(frames))
+    finally:
+        gateway_recorder.close()
+        receiver.close()
+
+    assert received == sent
+
+def test_gateway_end_to_end(recorder):
+    """Check the measurements pushed by an agent are recorded by the gateway,
+    and the recorders are flushed"""
+    gateway = Gateway([recorder], flush_interval=0.05, secret=b'foo',
+                      allowed_networks=['127.0.0.0/8'])
+    sent = measurements('foo', range(0, 30))
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+
+    async def push_and_wait():
+        serving = asyncio.ensure_future(gateway.serve('127.0.0.1', port))
+        await asyncio.sleep(0.05)
+        gateway_recorder = GatewayMeasurementRecorder('127.0.0.1', port, batch_size=10,
+                                                      secret=b'foo')
+        for measurement in sent:
+            gateway_recorder.record(measurement)
+        gateway_recorder.close()
+        for _ in range(100):
+            if recorder.record.call_count == len(sent):
+                break
+            await asyncio.sleep(0.01)
+        serving.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await serving
+
+    asyncio.run(push_and_wait())
+
+    assert [args[0] for args, _kwargs in recorder.record.call_args_list] == sent
+    assert recorder.flush.call_count >= 1
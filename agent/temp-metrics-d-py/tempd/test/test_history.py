@@ -0,0 +1,75 @@
+"""
+Test for the module tempd.history
+"""
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.history import MeasurementHistory, MeasurementRing
+
+
+def test_measurement_is_compact():
+    """Check measurements have no __dict__ and are immutable"""
+    measurement = TempMeasurement('foo_source', 10, 20.1, 40.2)
+    assert not hasattr(measurement, '__dict__')
+    with pytest.raises(AttributeError):
+        measurement.temperature = 25.0 # type: ignore
+
+def test_ring_evicts_oldest():
+    """Check the ring keeps the latest measurements, and discards
+    measurements out of order"""
+    ring = MeasurementRing(4)
+    for timestamp in range(6):
+        assert ring.append(timestamp, 20.0 + timestamp, 40.0)
+    assert not ring.append(3, 0.0, 0.0)
+
+    assert len(ring) == 4
+    chunks = ring.slices(0, 100)
+    assert [list(chunk[0]) for chunk in chunks] == [[2, 3], [4, 5]]
+    assert [list(chunk[1]) for chunk in chunks] == [[22.0, 23.0], [24.0, 25.0]]
+
+def test_ring_slices_by_time_range():
+    """Check time ranges are half open, and chunks are views of the ring"""
+    ring = MeasurementRing(8)
+    for timestamp in range(0, 100, 10):
+        ring.append(timestamp, float(timestamp), 50.0)
+
+    assert [list(chunk[0]) for chunk in ring.slices(25, 60)] == [[30, 40, 50]]
+    assert ring.slices(200, 300) == []
+    assert ring.slices(60, 60) == []
+    (chunk,) = ring.slices(20, 50)
+    ring.append(100, 1.0, 1.0)
+    assert list(chunk[0]) == [100, 30, 40]
+
+def test_history_per_source():
+    """Check measurements are kept and queried per source"""
+    history = MeasurementHistory(capacity=3)
+    for timestamp in range(5):
+        history.record(TempMeasurement('foo', timestamp, 20.0, 40.0))
+    history.record(TempMeasurement('bar', 2, 21.0, 41.0))
+
+    assert history.sources() == ['bar', 'foo']
+    assert list(history.measurements('foo', 0, 4)) == \
+        [TempMeasurement('foo', timestamp, 20.0, 40.0) for timestamp in (2, 3)]
+    assert list(history.columns('bar', 0, 10).humidities) == [41.0]
+    assert not list(history.measurements('baz', 0, 10))
+
+def test_history_statistics_from_rollups():
+    """Check statistics are computed from the coarsest rollup that
+    divides the step, or from the measurements"""
+    history = MeasurementHistory(capacity=10, rollups=[(60, 10), (3600, 10)])
+    for timestamp in range(0, 2 * 3600, 30):
+        history.record(TempMeasurement('foo', timestamp, timestamp / 60, 50.0))
+
+    (hour,) = history.statistics('foo', 3600, 7200, 3600)
+    assert hour.timestamp == 3600
+    assert hour.temperature.count == 120
+    assert (hour.temperature.minimum, hour.temperature.maximum) == (60.0, 119.5)
+    # Only the latest 10 minutes are kept in the 1 minute rollup
+    two_minutes = history.statistics('foo', 0, 7200, 120)
+    assert [statistics.timestamp for statistics in two_minutes] == \
+        list(range(7200 - 600, 7200, 120))
+    assert two_minutes[0].temperature.average == pytest.approx((110 + 111.5) / 2)
+    # Only the latest 10 measurements are kept
+    assert [statistics.temperature.count
+            for statistics in history.statistics('foo', 0, 7200, 90)] == [1, 3, 3, 3]
@@ -0,0 +1,62 @@
+"""
+Test for the module tempd.__main__
+"""
+
+import json
+import os
+import subprocess
+import sys
+from unittest.mock import patch
+
+from tempd.__main__ import load_credentials, main
+
+
+def test_load_credentials(tmp_path):
+    """Check the variables of a credentials file are set, unless they are
+    already in the environment"""
+    credentials = tmp_path / 'credentials.sh'
+    credentials.write_text("# AWS credentials\n"
+                           "export TEMPD_TEST_KEY_ID='foo'\n"
+                           "export TEMPD_TEST_SECRET=\"bar baz\" # a comment\n"
+                           "TEMPD_TEST_REGION=''\n", encoding='utf-8')
+    with patch.dict(os.environ, {'TEMPD_TEST_REGION': 'eu-west-1'}):
+        os.environ.pop('TEMPD_TEST_KEY_ID', None)
+        load_credentials(str(credentials))
+
+        assert (os.environ['TEMPD_TEST_KEY_ID'], os.environ['TEMPD_TEST_SECRET'],
+                os.environ['TEMPD_TEST_REGION']) == ('foo', 'bar baz', 'eu-west-1')
+
+def test_main_runs_the_agent(tmp_path):
+    """Check the agent root is the parent of the configuration directory"""
+    conf_root = tmp_path / 'conf'
+    conf_root.mkdir()
+    (conf_root / 'credentials.sh').write_text("export TEMPD_TEST_KEY_ID='foo'\n",
+                                              encoding='utf-8')
+    config = {
+        'deploy': {'service_name': 'temp_metrics'},
+        'logging': {'level': 'INFO', 'rotationInterval': 1, 'rotationIntervalUnit': 'D',
+                    'maxLogFiles': 1},
+        'aws': {'credentials_filename': 'credentials.sh'}
+    }
+    (conf_root / 'dev.json').write_text(json.dumps(config), encoding='utf-8')
+
+    with patch.dict(os.environ), patch('tempd.__main__.Main') as main_class:
+        main([f"--conf={conf_root / 'dev.json'}"])
+        assert os.environ['TEMPD_TEST_KEY_ID'] == 'foo'
+
+    main_class.assert_called_once_with(config, str(tmp_path))
+    main_class.return_value.run.assert_called_once_with()
+    assert os.path.isfile(tmp_path / 'log' / 'temp_metrics.log')
+
+def test_entry_point_imports_lazily():
+    """Check the entry point doesn't import the sensor drivers, boto3, the
+    gateway nor the optional subsystems until they are configured"""
+    code = ("import sys, tempd.__main__; "
+            "print(sorted(set(sys.modules) & {'boto3', 'asyncio', 'cProfile', "
+            "'tempd.sensors.dht11', 'tempd.sensors.sht31', 'tempd.gateway', "
+            "'tempd.cloudwatch', 'tempd.filtering', 'tempd.history', 'tempd.server', "
+            "'tempd.storage', 'tempd.codec', 'tempd.throttling', 'tempd.spool'}))")
+    output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))).stdout
+    assert output.strip() == '[]'
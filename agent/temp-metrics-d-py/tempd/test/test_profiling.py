@@ -0,0 +1,88 @@
+"""
+Test for the module tempd.profiling
+"""
+
+import os
+import pstats
+import threading
+import tracemalloc
+
+import pytest
+
+from tempd.profiling import Profiler
+
+
+def measure():
+    """An action to profile"""
+    return sorted(range(1000), reverse=True)
+
+def test_profiler_samples_and_requests(tmp_path):
+    """Check runs are profiled each `every` runs and on request"""
+    profiler = Profiler(str(tmp_path), every=3)
+    action = profiler.wrap(measure, 'foo/bar')
+
+    for _ in range(4):
+        action()
+    profiler.request()
+    action()
+    action()
+
+    names = os.listdir(tmp_path)
+    assert all(name.startswith('foo%2Fbar-') and name.endswith('.pstats') for name in names)
+    assert sorted(int(name[:-len('.pstats')].rsplit('-', 1)[1]) for name in names) == [3, 5, 6]
+    (profile,) = [name for name in os.listdir(tmp_path) if name.endswith('-5.pstats')]
+    stats = pstats.Stats(str(tmp_path / profile))
+    assert any(function == 'measure' for (_file, _line, function) in stats.stats) # type: ignore
+
+def test_profiler_keeps_latest_files(tmp_path):
+    """Check only the latest profiles are kept, and failing runs are also profiled"""
+    def fail():
+        raise RuntimeError("Forcing a runtime error")
+    profiler = Profiler(str(tmp_path), every=1, max_files=2)
+    action = profiler.wrap(fail, 'foo')
+
+    for _ in range(4):
+        with pytest.raises(RuntimeError):
+            action()
+
+    assert sorted(name.rsplit('-', 1)[1] for name in os.listdir(tmp_path)) == \
+        ['3.pstats', '4.pstats']
+
+def test_profiler_tracemalloc(tmp_path):
+    """Check tracemalloc snapshots can be loaded"""
+    profiler = Profiler(str(tmp_path), 'tracemalloc', frames=5)
+    try:
+        action = profiler.wrap(measure, 'foo')
+        action()
+        profiler.request()
+        action()
+    finally:
+        profiler.stop()
+
+    (snapshot,) = os.listdir(tmp_path)
+    assert snapshot.endswith('-2.snapshot')
+    assert tracemalloc.Snapshot.load(str(tmp_path / snapshot)).traceback_limit == 5
+
+def test_profiler_stop_waits_for_profiled_run(tmp_path):
+    """Check stopping waits for the run being profiled to be written out,
+    and later runs are not profiled"""
+    profiling, release = threading.Event(), threading.Event()
+    def slow_measure():
+        profiling.set()
+        release.wait(5)
+    profiler = Profiler(str(tmp_path), every=1)
+    thread = threading.Thread(target=profiler.wrap(slow_measure, 'foo'))
+    thread.start()
+    profiling.wait(5)
+    threading.Timer(0.1, release.set).start()
+
+    profiler.stop()
+    assert [name.rsplit('-', 1)[1] for name in os.listdir(tmp_path)] == ['1.pstats']
+    profiler.wrap(measure, 'foo')()
+    thread.join(5)
+    assert len(os.listdir(tmp_path)) == 1
+
+def test_profiler_rejects_unknown_mode(tmp_path):
+    """Check the mode is validated"""
+    with pytest.raises(ValueError):
+        Profiler(str(tmp_path), 'perf')
@@ -0,0 +1,238 @@
+"""
+Test for the module tempd.remote_write
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import random
+import socket
+import struct
+import threading
+from typing import Any, Dict, List, Tuple
+from unittest.mock import Mock, patch
+
+from prometheus_client import REGISTRY
+import pytest
+
+from tempd.agent import AsyncMeasurementRecorder, ConfigError, Main
+from tempd import remote_write
+from tempd.remote_write import RemoteWriteMeasurementRecorder, encode_write_request
+from tempd.remote_write import snappy_compress, snappy_decompress
+from tempd.types import RetryPolicy, TempMeasurement
+
+_TIMESTAMP = 1625097600
+
+Series = Dict[Tuple[Tuple[str, str], ...], List[Tuple[float, int]]]
+
+
+def read_varint(data: bytes, position: int) -> Tuple[int, int]:
+    """Decode a protobuf varint, returning it and the position after it"""
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+def read_fields(data: bytes) -> List[Tuple[int, Any]]:
+    """Decode the fields of a protobuf message, as (field number, value) pairs"""
+    fields: List[Tuple[int, Any]] = []
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        wire_type = key & 7
+        value: Any
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value = struct.unpack('<d', data[position:position + 8])[0]
+            position += 8
+        else:
+            assert wire_type == 2
+            length, position = read_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        fields.append((key >> 3, value))
+    return fields
+
+def decode_write_request(body: bytes) -> Series:
+    """Decode a WriteRequest into its samples per labels, like a receiver"""
+    series: Series = {}
+    for _, time_series in read_fields(body):
+        labels, samples = [], []
+        for field_number, value in read_fields(time_series):
+            fields = dict(read_fields(value))
+            if field_number == 1:
+                labels.append((fields[1].decode('utf-8'), fields[2].decode('utf-8')))
+            else:
+                samples.append((fields[1], fields[2]))
+        series[tuple(labels)] = samples
+    return series
+
+def sample(name: str) -> float:
+    """Value of a counter of the module"""
+    return REGISTRY.get_sample_value(f"tempd_remote_write_{name}_total") or 0
+
+
+class Receiver: # pylint: disable=too-many-instance-attributes
+    """Local stand-in for a Prometheus remote write receiver, that decodes
+    the requests and fails with the statuses in `statuses` before accepting.
+    Connections are kept alive, or closed after each request without telling
+    the client if not `keep_alive`, like a receiver closing idle connections"""
+    def __init__(self, statuses: List[int], keep_alive: bool = True):
+        self.statuses = list(statuses)
+        self.keep_alive = keep_alive
+        self.connections = 0
+        self.requests = 0
+        self.series: Series = {}
+        self.headers: List[dict] = []
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), self.__handler())
+        self.url = f"http://127.0.0.1:{self.__server.server_port}/api/v1/write"
+
+    def __handler(self):
+        receiver, lock = self, threading.Lock()
+        class Handler(BaseHTTPRequestHandler):
+            """Decodes the request and answers with the next status"""
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with lock:
+                    receiver.connections += 1
+
+            def do_POST(self): # pylint: disable=invalid-name
+                """Record the series and answer"""
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with lock:
+                    receiver.requests += 1
+                    receiver.headers.append(dict(self.headers))
+                    status = receiver.statuses.pop(0) if len(receiver.statuses) > 0 else 204
+                    if status == 204:
+                        for labels, samples in \
+                            decode_write_request(snappy_decompress(body)).items():
+                            receiver.series.setdefault(labels, []).extend(samples)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.close_connection = not receiver.keep_alive
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                pass
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *_args):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def test_snappy_round_trip():
+    """Check snappy compresses repetitive data, and decompresses what it compresses"""
+    generator = random.Random(0)
+    texts = [b'', b'a', b'abcd' * 1000, bytes(generator.getrandbits(8) for _ in range(5000)),
+             encode_write_request({(('__name__', 'tempd_temperature'),):
+                                   [(20.0 + i / 10, _TIMESTAMP * 1000 + i) for i in range(500)]})]
+    for text in texts:
+        compressed = snappy_compress(text)
+        assert snappy_decompress(compressed) == text
+    assert len(snappy_compress(texts[2])) < 200
+    # literal of 100 bytes, and copy of 4 bytes with a 1 byte offset
+    assert snappy_decompress(bytes([104, 60 << 2, 99]) + b'x' * 100 + bytes([1, 1])) == \
+        b'x' * 104
+    with pytest.raises(ValueError):
+        snappy_decompress(bytes([4, 2, 1, 0]))
+
+def test_recorder_pushes_measurements_with_timestamps():
+    """Check the measurements reach the receiver in batches, as samples at their timestamps"""
+    sent_samples = sample('sent_samples')
+    with Receiver([]) as receiver:
+        recorder = RemoteWriteMeasurementRecorder(receiver.url, labels={'job': 'tempd'},
+                                                  batch_size=5, max_samples_per_request=6)
+        for offset in range(10):
+            recorder.record(TempMeasurement('foo', _TIMESTAMP + offset, 20.5 + offset, 40.0))
+        recorder.record(TempMeasurement('bar', _TIMESTAMP, 18.0, 60.0))
+        recorder.flush()
+        recorder.close()
+
+    assert (receiver.requests, receiver.connections) == (5, 1)
+    assert receiver.headers[0]['Content-Encoding'] == 'snappy'
+    assert receiver.headers[0]['X-Prometheus-Remote-Write-Version'] == '0.1.0'
+    assert receiver.series[(('__name__', 'tempd_temperature'), ('job', 'tempd'),
+                            ('source', 'foo'))] == \
+        [(20.5 + offset, (_TIMESTAMP + offset) * 1000) for offset in range(10)]
+    assert receiver.series[(('__name__', 'tempd_humidity'), ('job', 'tempd'),
+                            ('source', 'bar'))] == [(60.0, _TIMESTAMP * 1000)]
+    assert sample('sent_samples') - sent_samples == 22
+
+def test_recorder_labels_series_apart_from_scraped():
+    """Check the pushed series are labeled by default with a job of their own
+    and the hostname, so they don't collide with the scraped series"""
+    with Receiver([]) as receiver:
+        recorder = RemoteWriteMeasurementRecorder(receiver.url, batch_size=1)
+        recorder.record(TempMeasurement('foo', _TIMESTAMP, 20.5, 40.0))
+        recorder.close()
+
+    assert set(receiver.series) == {
+        (('__name__', metric_name), ('instance', socket.gethostname()),
+         ('job', 'tempd_remote_write'), ('source', 'foo'))
+        for metric_name in ('tempd_humidity', 'tempd_temperature')}
+
+def test_recorder_reconnects_closed_connections():
+    """Check a request on a connection closed by the receiver is sent again
+    on a new connection, without counting as a retry"""
+    timer = Mock()
+    timer.time.return_value = _TIMESTAMP
+    retries, connections = sample('retries'), sample('connections')
+    with Receiver([], keep_alive=False) as receiver:
+        recorder = RemoteWriteMeasurementRecorder(receiver.url, batch_size=1, timer=timer)
+        for offset in range(3):
+            recorder.record(TempMeasurement('foo', _TIMESTAMP + offset, 20.0, 40.0))
+        recorder.close()
+
+    assert (receiver.requests, receiver.connections) == (3, 3)
+    assert sample('connections') - connections == 3
+    assert (sample('retries') - retries, timer.sleep.call_count) == (0, 0)
+    assert [len(samples) for samples in receiver.series.values()] == [3, 3]
+
+def test_recorder_retries_and_keeps_samples():
+    """Check server errors are retried, and failed batches are kept in the
+    buffer until it is full, while rejected batches are discarded"""
+    timer = Mock()
+    timer.time.return_value = _TIMESTAMP
+    dropped_samples = sample('dropped_samples')
+    with Receiver([500, 503, 500, 503, 429, 400]) as receiver:
+        recorder = RemoteWriteMeasurementRecorder(receiver.url, batch_size=1,
+            max_buffered_samples=4, retry_policy=RetryPolicy(max_attempts=2), timer=timer)
+        measurements = [TempMeasurement('foo', _TIMESTAMP + offset, 20.0, 40.0)
+                        for offset in range(4)]
+        for measurement in measurements[:2]:
+            with pytest.raises(remote_write.RemoteWriteError):
+                recorder.record(measurement)
+        assert (receiver.requests, timer.sleep.call_count) == (4, 2)
+        recorder.record(measurements[2])
+        assert receiver.requests == 6
+        recorder.record(measurements[3])
+
+    assert receiver.requests == 7
+    assert sample('dropped_samples') - dropped_samples == 6
+    assert {labels[0][1]: samples for labels, samples in receiver.series.items()} == \
+        {'tempd_temperature': [(20.0, (_TIMESTAMP + 3) * 1000)],
+         'tempd_humidity': [(40.0, (_TIMESTAMP + 3) * 1000)]}
+
+def test_main_creates_remote_write_recorder():
+    """Check remote write is configured as an additional recorder"""
+    with patch('tempd.remote_write.RemoteWriteMeasurementRecorder') as recorder_class:
+        recorders, _ = Main({'remote_write': {'url': 'http://prometheus:9090/api/v1/write',
+                                              'max_attempts': 5, 'labels': {'job': 'foo'}}}) \
+            .create_measurement_recorders()
+    assert len(recorders) == 3
+    assert all(isinstance(recorder, AsyncMeasurementRecorder) for recorder in recorders)
+    args, kwargs = recorder_class.call_args
+    assert args == ('http://prometheus:9090/api/v1/write',)
+    assert (kwargs['labels'], kwargs['retry_policy']) == ({'job': 'foo'}, RetryPolicy(5))
+    with pytest.raises(ConfigError):
+        Main({'remote_write': {}}).create_remote_write_recorder()
@@ -0,0 +1,31 @@
+"""
+Test for the module tempd.sampling
+"""
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.sampling import AdaptiveSampling
+
+
+def update(sampling: AdaptiveSampling, temperatures):
+    """Update the sampling with measurements of some temperatures,
+    returning the periods"""
+    return [sampling.update(TempMeasurement('foo', 0, temperature, 50.0))
+            for temperature in temperatures]
+
+def test_period_grows_while_flat_and_shrinks_on_changes():
+    """Check the period grows after each full window of flat measurements,
+    and shrinks on each measurement while the measurements change"""
+    sampling = AdaptiveSampling(10, 5, 40, window_size=3, temperature_threshold=0.5)
+
+    assert update(sampling, [20.0] * 7) == [10, 10, 20, 20, 20, 40, 40]
+    assert update(sampling, [20.0, 22.0, 24.0, 24.0]) == [40, 20, 10, 5]
+    assert sampling.period == 5
+
+def test_period_limits():
+    """Check the initial period is kept within the limits, and invalid
+    limits are rejected"""
+    assert AdaptiveSampling(1, 5, 40).period == 5
+    with pytest.raises(ValueError):
+        AdaptiveSampling(10, 0, 40)
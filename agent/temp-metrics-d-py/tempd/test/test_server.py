@@ -0,0 +1,96 @@
+"""
+Test for the module tempd.server
+"""
+
+# This check is incompatible with pytests conventions
+# for fixtures
+# pylint: disable=redefined-outer-name
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.history import MeasurementHistory
+from tempd.profiling import Profiler
+from tempd.server import start_server
+
+
+@pytest.fixture
+def history():
+    """A history with measurements of a source each 30 seconds"""
+    history = MeasurementHistory()
+    for timestamp in range(0, 3600, 30):
+        history.record(TempMeasurement('foo', timestamp, 20.0 + timestamp // 60, 40.0))
+    return history
+
+@pytest.fixture
+def base_url(history):
+    """Start a server on a free port"""
+    server = start_server(0, history, address='127.0.0.1')
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def get(url: str):
+    """Get a URL returning the status and the body"""
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as http_error:
+        return http_error.code, http_error.read()
+
+def post(url: str):
+    """Post an empty body to a URL returning the status"""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=b'', method='POST')) \
+            as response:
+            return response.status
+    except urllib.error.HTTPError as http_error:
+        return http_error.code
+
+def test_server_queries(base_url):
+    """Check measurements are queried raw and downsampled"""
+    status, body = get(f"{base_url}/sources")
+    assert (status, json.loads(body)) == (200, ['foo'])
+
+    status, body = get(f"{base_url}/query?source=foo&start=60&end=120")
+    assert status == 200
+    assert json.loads(body) == [{'timestamp': 60, 'temperature': 21.0, 'humidity': 40.0},
+                                {'timestamp': 90, 'temperature': 21.0, 'humidity': 40.0}]
+
+    status, body = get(f"{base_url}/query?source=foo&start=0&end=3600&step=1800")
+    assert status == 200
+    windows = json.loads(body)
+    assert [window['timestamp'] for window in windows] == [0, 1800]
+    assert windows[0]['count'] == 60
+    assert windows[0]['temperature'] == {'min': 20.0, 'avg': 34.5, 'max': 49.0}
+
+def test_server_errors_and_metrics(base_url):
+    """Check invalid queries are rejected, and other paths serve
+    the Prometheus metrics"""
+    assert get(f"{base_url}/query?start=0")[0] == 400
+    assert get(f"{base_url}/query?source=foo&step=abc")[0] == 400
+    status, body = get(f"{base_url}/metrics")
+    assert status == 200
+    assert b'python_info' in body or b'process_' in body or b'tempd_' in body
+
+def test_server_profile_requests(base_url, tmp_path):
+    """Check a POST to '/profile' profiles the next run, if profiling is enabled"""
+    assert post(f"{base_url}/profile") == 404
+    profiler = Profiler(str(tmp_path))
+    action = profiler.wrap(lambda: None, 'foo')
+    server = start_server(0, None, address='127.0.0.1', profiler=profiler)
+    try:
+        profiler_url = f"http://127.0.0.1:{server.server_address[1]}"
+        assert post(f"{profiler_url}/metrics") == 404
+        action()
+        assert post(f"{profiler_url}/profile") == 202
+        action()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert [name.rsplit('-', 1)[1] for name in os.listdir(tmp_path)] == ['2.pstats']
@@ -0,0 +1,137 @@
+"""
+Test for the module tempd.sensors.sht31
+"""
+
+# This check is incompatible with pytests conventions
+# for fixtures
+# pylint: disable=redefined-outer-name
+from unittest.mock import patch
+from unittest.mock import Mock
+
+import pytest
+from prometheus_client import REGISTRY
+from retrying import RetryError
+
+from tempd.sensors import sht31
+
+
+@pytest.fixture
+def smbus():
+    """Mock for the I2C bus, returning 25 Celsius and 50% humidity"""
+    bus = Mock()
+    bus.read_i2c_block_data.return_value = [0x66, 0x66, 0x93, 0x80, 0x00, 0xA2]
+    return bus
+
+@patch('time.sleep')
+def test_measure_waits_for_measurement(sleep, smbus):
+    """Check a blocking measurement sends the command and waits for it"""
+    sensor = sht31.Sensor(smbus=smbus)
+
+    temperature, humidity = sensor.measure()
+
+    assert temperature == pytest.approx(25, abs=0.01)
+    assert humidity == pytest.approx(50, abs=0.01)
+    smbus.write_i2c_block_data.assert_called_once()
+    sleep.assert_called_once()
+
+@patch('time.sleep')
+def test_deferred_measure_doesnt_wait(sleep, smbus):
+    """Check a deferred measurement reads the result of the command sent
+    on the previous measurement"""
+    sensor = sht31.Sensor(smbus=smbus, deferred=True)
+
+    sensor.measure()
+    sensor.measure()
+
+    sleep.assert_called_once()
+    assert smbus.write_i2c_block_data.call_count == 3
+    assert smbus.read_i2c_block_data.call_count == 2
+
+@patch('time.sleep')
+def test_measure_retries_read_errors(_sleep, smbus):
+    """Check read errors are retried and counted"""
+    read_errors = sht31.Sensor.read_errors.labels('1', hex(sht31.Sensor.DEFAULT_ADDRESS))
+    initial_read_errors = read_errors._value.get() # pylint: disable=protected-access
+    labels = {'bus': '1', 'address': hex(sht31.Sensor.DEFAULT_ADDRESS)}
+    initial_retries = REGISTRY.get_sample_value('tempd_sht31_read_retries_sum', labels) or 0
+    data = smbus.read_i2c_block_data.return_value
+    smbus.read_i2c_block_data.side_effect = [OSError(121, 'Remote I/O error'), data]
+    sensor = sht31.Sensor(smbus=smbus)
+
+    temperature, _humidity = sensor.measure()
+
+    assert temperature == pytest.approx(25, abs=0.01)
+    assert read_errors._value.get() == initial_read_errors + 1 # pylint: disable=protected-access
+    assert REGISTRY.get_sample_value('tempd_sht31_read_retries_sum', labels) == \
+        initial_retries + 1
+
+@patch('time.sleep')
+def test_measure_gives_up_after_retry_budget(_sleep, smbus):
+    """Check a persistent read error fails within the retry budget"""
+    smbus.read_i2c_block_data.side_effect = OSError(121, 'Remote I/O error')
+    sensor = sht31.Sensor(smbus=smbus, retry_budget=0.1)
+
+    with pytest.raises(RetryError):
+        sensor.measure()
+
+def test_crc8():
+    """Check the checksum with the example of the datasheet"""
+    assert sht31.crc8([0xBE, 0xEF]) == 0x92
+
+@patch('time.sleep')
+def test_measure_retries_checksum_errors(_sleep, smbus):
+    """Check corrupted data is read again"""
+    data = smbus.read_i2c_block_data.return_value
+    corrupted_data = data[:4] + [0x01, data[5]]
+    smbus.read_i2c_block_data.side_effect = [corrupted_data, data]
+    sensor = sht31.Sensor(smbus=smbus)
+
+    _temperature, humidity = sensor.measure()
+
+    assert humidity == pytest.approx(50, abs=0.01)
+    assert smbus.read_i2c_block_data.call_count == 2
+
+@patch('time.sleep')
+def test_periodic_measure_fetches_data(_sleep, smbus):
+    """Check periodic measurement is started once, and then each
+    measurement just fetches the data"""
+    sensor = sht31.Sensor(smbus=smbus, periodic_mps=2, repeatability='medium')
+
+    sensor.measure()
+    sensor.measure()
+
+    address = sht31.Sensor.DEFAULT_ADDRESS
+    written_cmds = [args for args, _kwargs in smbus.write_i2c_block_data.call_args_list]
+    assert written_cmds == [
+        (address, 0x30, [0x93]),
+        (address, 0x22, [0x20]),
+        (address, 0xE0, [0x00]),
+        (address, 0xE0, [0x00]),
+    ]
+
+@patch('time.sleep')
+def test_periodic_measure_retries_fetch_without_restarting(sleep, smbus):
+    """Check the first fetch waits for a period, a fetch NACKed while the
+    sensor has no data is retried without restarting the periodic mode,
+    that is only restarted after several failed fetches in a row"""
+    data = smbus.read_i2c_block_data.return_value
+    nack = OSError(121, 'Remote I/O error')
+    smbus.read_i2c_block_data.side_effect = [nack, data] + \
+        [nack] * sht31.Sensor.MAX_FETCH_FAILURES + [data]
+    sensor = sht31.Sensor(smbus=smbus, periodic_mps=0.5, repeatability='medium')
+
+    sensor.measure()
+    assert sleep.call_args_list[0][0] == (2.0,)
+    sensor.measure()
+
+    address = sht31.Sensor.DEFAULT_ADDRESS
+    written_cmds = [args for args, _kwargs in smbus.write_i2c_block_data.call_args_list]
+    fetch, start = (address, 0xE0, [0x00]), [(address, 0x30, [0x93]), (address, 0x20, [0x24])]
+    assert written_cmds == start + [fetch] * 2 + \
+        [fetch] * sht31.Sensor.MAX_FETCH_FAILURES + start + [fetch]
+
+def test_invalid_periodic_mps(smbus):
+    """Check only the measurement frequencies supported by the sensor
+    are accepted"""
+    with pytest.raises(ValueError):
+        sht31.Sensor(smbus=smbus, periodic_mps=3)
@@ -0,0 +1,118 @@
+"""
+Test for the module tempd.spool
+"""
+
+# This check is incompatible with pytests conventions
+# for fixtures
+# pylint: disable=redefined-outer-name
+import os
+from unittest.mock import Mock
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.spool import Spool, SpoolDrainer, SpoolMeasurementRecorder
+from tempd.spool import decode_measurements, encode_measurement
+
+
+@pytest.fixture
+def measurements():
+    """Some measurements to spool"""
+    return [TempMeasurement('foo_source', i, 20.5 + i, 40.25) for i in range(10)]
+
+@pytest.fixture
+def spool(tmp_path):
+    """Create a spool on a temporary directory"""
+    return Spool(str(tmp_path), segment_size=1024, max_size=4096)
+
+def test_codec_ignores_truncated_records(measurements):
+    """Check measurements are decoded as encoded, discarding a partially
+    written record at the end"""
+    data = b''.join(encode_measurement(measurement) for measurement in measurements)
+
+    assert list(decode_measurements(data)) == measurements
+    assert list(decode_measurements(data[:-1])) == measurements[:-1]
+
+def test_spool_seals_segments(spool, measurements):
+    """Check the active segment is not visible until sealed"""
+    spool.append(measurements[:5])
+    assert spool.sealed_segments() == []
+
+    spool.rotate()
+    spool.append(measurements[5:])
+    spool.rotate()
+
+    segments = spool.sealed_segments()
+    assert len(segments) == 2
+    assert [measurement for segment in segments
+            for measurement in spool.read_segment(segment)] == measurements
+
+def test_spool_rotates_full_segments(spool, measurements):
+    """Check segments are sealed when they reach the segment size"""
+    for _ in range(40):
+        spool.append(measurements)
+
+    segments = spool.sealed_segments()
+    assert len(segments) > 1
+    assert sum(os.path.getsize(segment) for segment in segments) <= 4096
+
+def test_spool_recovers_segments(tmp_path, spool, measurements):
+    """Check segments from a previous spool are kept"""
+    spool.append(measurements)
+    spool.close()
+
+    new_spool = Spool(str(tmp_path))
+    new_spool.append(measurements)
+
+    assert len(new_spool.sealed_segments()) == 1
+
+def test_spool_recorder_writes_batches(spool, measurements):
+    """Check the recorder only writes full batches, or on flush"""
+    recorder = SpoolMeasurementRecorder(spool, batch_size=4)
+
+    for measurement in measurements:
+        recorder.record(measurement)
+    spool.rotate()
+    assert len(spool.read_segment(spool.sealed_segments()[0])) == 8
+
+    recorder.flush()
+    spool.rotate()
+    assert len(spool.read_segment(spool.sealed_segments()[1])) == 2
+
+def test_drainer_publishes_and_removes_segments(spool, measurements):
+    """Check drained segments are removed only after publishing them"""
+    publish = Mock()
+    publish.side_effect = [RuntimeError("Forcing a runtime error"), None]
+    drainer = SpoolDrainer(spool, publish)
+    spool.append(measurements)
+
+    assert not drainer.drain()
+    assert len(spool.sealed_segments()) == 1
+    assert drainer.drain()
+    assert spool.sealed_segments() == []
+    publish.assert_called_with(measurements)
+
+def test_codec_truncates_long_sources():
+    """Check long source names are truncated without splitting a character"""
+    (measurement,) = decode_measurements(
+        encode_measurement(TempMeasurement('é' * 200, 1, 20.0, 50.0)))
+
+    assert measurement == TempMeasurement('é' * 127, 1, 20.0, 50.0)
+
+def test_drainer_quarantines_unreadable_segments(spool, measurements):
+    """Check a segment that can't be decoded is quarantined, and the
+    segments after it are still drained"""
+    publish = Mock()
+    drainer = SpoolDrainer(spool, publish)
+    spool.append(measurements[:1])
+    spool.rotate()
+    (corrupt_segment,) = spool.sealed_segments()
+    with open(corrupt_segment, 'r+b') as segment_file:
+        segment_file.seek(1)
+        segment_file.write(b'\xff')
+    spool.append(measurements[1:])
+
+    assert drainer.drain()
+    assert spool.sealed_segments() == []
+    assert os.path.exists(corrupt_segment + Spool.quarantine_suffix)
+    publish.assert_called_once_with(measurements[1:])
@@ -0,0 +1,104 @@
+"""
+Test for the module tempd.storage
+"""
+
+# This check is incompatible with pytests conventions
+# for fixtures
+# pylint: disable=redefined-outer-name
+import os
+
+import pytest
+
+from tempd.types import TempMeasurement
+from tempd.storage import MeasurementStorage, Tier
+
+TIERS = [Tier('raw', None, 600, 1200), Tier('1m', 60, 3600, 7200)]
+
+@pytest.fixture
+def storage(tmp_path):
+    """Create a storage on a temporary directory, with small partitions"""
+    return MeasurementStorage(str(tmp_path), tiers=TIERS)
+
+def record_minutes(storage: MeasurementStorage, start: int, end: int, source: str = 'foo'):
+    """Record a measurement each 15 seconds, with the temperature
+    equal to the minute"""
+    for timestamp in range(start, end, 15):
+        storage.record(TempMeasurement(source, timestamp, float(timestamp // 60), 50.0))
+
+def test_storage_queries(storage):
+    """Check measurements and statistics are queried across partitions,
+    including the statistics of the current window"""
+    record_minutes(storage, 0, 1290)
+    storage.record(TempMeasurement('bar/baz', 10, 20.0, 40.0))
+
+    assert storage.sources() == ['bar/baz', 'foo']
+    assert [measurement.timestamp for measurement in storage.measurements('foo', 585, 630)] == \
+        [585, 600, 615]
+    windows = storage.statistics('foo', 0, 1320, 120)
+    assert [window.timestamp for window in windows] == list(range(0, 1320, 120))
+    assert windows[0].temperature.count == 8
+    assert (windows[0].temperature.minimum, windows[0].temperature.maximum) == (0.0, 1.0)
+    # The last window includes minute 21, that is not complete
+    assert windows[-1].temperature.count == 6
+    # Without a tier for the step, statistics are computed from the measurements
+    assert [window.temperature.count for window in storage.statistics('foo', 0, 90, 45)] == \
+        [3, 3]
+
+def test_storage_flush_and_reopen(storage, tmp_path):
+    """Check flushing stores the current windows, that are merged with later
+    rows of the same window, also after reopening the storage"""
+    record_minutes(storage, 0, 30)
+    storage.flush()
+    reopened = MeasurementStorage(str(tmp_path), tiers=TIERS)
+    record_minutes(reopened, 30, 75)
+    reopened.flush()
+
+    (minute, second_minute) = reopened.statistics('foo', 0, 120, 60)
+    assert (minute.timestamp, minute.temperature.count) == (0, 4)
+    assert (second_minute.timestamp, second_minute.temperature.count) == (60, 1)
+    assert len(list(reopened.measurements('foo', 0, 120))) == 5
+
+def test_storage_compaction_and_retention(storage, tmp_path):
+    """Check sealed partitions are compacted, and expired partitions are removed"""
+    record_minutes(storage, 0, 30)
+    storage.flush()
+    record_minutes(storage, 30, 60)
+    storage.record(TempMeasurement('foo', 3600, 0.0, 0.0))
+    record_minutes(storage, 3600, 2 * 3600 + 700)
+    first_rollup = os.path.join(str(tmp_path), '1m', 'foo', f"{0:012d}.seg")
+    assert os.path.getsize(first_rollup) == 64
+    assert storage.statistics('foo', 0, 60, 60)[0].temperature.count == 4
+    assert sorted(os.listdir(os.path.join(str(tmp_path), 'raw', 'foo'))) == \
+        [f"{start:012d}.seg" for start in (6600, 7200, 7800)]
+    assert sorted(os.listdir(os.path.dirname(first_rollup))) == \
+        [f"{start:012d}.seg" for start in (0, 3600, 7200)]
+    assert len(list(storage.measurements('foo', 0, 6000))) == 0
+
+def test_storage_max_size(tmp_path):
+    """Check the oldest partitions of the finest tier are removed first
+    when the storage is full"""
+    tiers = [Tier('raw', None, 600, 10 * 3600), TIERS[1]]
+    storage = MeasurementStorage(str(tmp_path), tiers=tiers, max_size=3100)
+    record_minutes(storage, 0, 3000)
+
+    # Each partition of measurements takes 53 bytes, and the rollup 64 bytes per minute,
+    # so the current rollup partition takes 3008 bytes
+    assert sorted(os.listdir(os.path.join(str(tmp_path), 'raw', 'foo'))) == \
+        [f"{start:012d}.seg" for start in (1800, 2400)]
+    assert storage.statistics('foo', 0, 3600, 3600)[0].temperature.count == 200
+
+def test_storage_max_size_in_single_partition(tmp_path):
+    """Check the size limit is enforced while a partition grows, emptying
+    the current partition when there are no older ones to remove"""
+    tiers = [Tier('raw', None, 24 * 3600, 7 * 24 * 3600)]
+    storage = MeasurementStorage(str(tmp_path), tiers=tiers, max_size=1600, frame_size=10)
+    for timestamp in range(0, 20000, 5):
+        storage.record(TempMeasurement('foo', timestamp, 20.0 + (timestamp * 7 % 13) / 10,
+                                       50.0 + (timestamp * 3 % 11) / 10))
+        assert os.path.getsize(os.path.join(str(tmp_path), 'raw', 'foo',
+                                            f"{0:012d}.seg")) <= 1600 + 1600 // 16
+    storage.flush()
+
+    measurements = list(storage.measurements('foo', 0, 20000))
+    assert 0 < len(measurements) < 4000
+    assert measurements[-1].timestamp == 19995
@@ -0,0 +1,60 @@
+"""
+Test for the module tempd.sensors.synthetic
+"""
+
+import math
+
+import pytest
+
+from tempd.sensors.synthetic import Sensor, SyntheticConfig, create_fleet
+
+
+def test_synthetic_daily_cycle():
+    """Check the values follow the daily cycle, and are reproducible"""
+    config = SyntheticConfig(temperature_noise=0, humidity_noise=0)
+    hour = 60 * 60
+    for timestamp, expected in [(15 * hour, (24.0, 40.0)), (3 * hour, (18.0, 60.0)),
+                                (21 * hour, (21.0, 50.0))]:
+        assert Sensor(config, clock=lambda timestamp=timestamp: timestamp).measure() == expected
+
+    sensors = create_fleet(3, SyntheticConfig(), seed=7, clock=lambda: 0)
+    readings = [[sensor.measure() for _ in range(5)] for sensor in sensors]
+    sensor = Sensor(seed=7, clock=lambda: 0)
+    assert readings[0] == [sensor.measure() for _ in range(5)]
+    assert readings[0] != readings[1]
+    assert all(abs(temperature - 18.0) < 1 for temperature, _humidity in readings[2])
+
+def test_synthetic_failures():
+    """Check NaN readings, read errors and spikes are injected with their rates,
+    and the latency is waited"""
+    sleeps = []
+    config = SyntheticConfig(temperature_noise=0, humidity_noise=0, temperature_amplitude=0,
+                             humidity_amplitude=0, nan_rate=0.2, error_rate=0.1,
+                             spike_rate=0.1, latency=0.01, latency_sigma=0.5)
+    sensor = Sensor(config, seed=1, sleep=sleeps.append)
+    nans, errors, spikes = 0, 0, 0
+    for _ in range(1000):
+        try:
+            temperature, humidity = sensor.measure()
+        except OSError as os_error:
+            assert os_error.errno == 121
+            errors += 1
+            continue
+        if math.isnan(temperature):
+            nans += 1
+        elif (temperature, humidity) != (21.0, 50.0):
+            assert abs(temperature - 21.0) in (0, 10) and abs(humidity - 50.0) in (0, 10)
+            spikes += 1
+
+    assert 150 < nans < 250
+    assert 50 < errors < 150
+    assert 40 < spikes < 110
+    assert len(sleeps) == 1000
+    assert 0.009 < sorted(sleeps)[500] < 0.011
+    assert min(sleeps) < 0.005 < 0.02 < max(sleeps)
+
+@pytest.mark.parametrize("seed", [0, 1, 2 ** 70])
+def test_synthetic_values_in_range(seed):
+    """Check the humidity stays in range with large noise"""
+    sensor = Sensor(SyntheticConfig(humidity_noise=50), seed=seed)
+    assert all(0 <= sensor.measure()[1] <= 100 for _ in range(200))
@@ -0,0 +1,84 @@
+"""
+Test for the module tempd.throttling
+"""
+
+import threading
+
+import pytest
+
+from tempd.throttling import AdaptiveRateLimiter, TokenBucket
+
+
+class FakeTimer:
+    """Timer with a time that only advances when sleeping"""
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def sleep(self, sleep_time: float):
+        """Advance the time"""
+        self.now += sleep_time
+
+    def time(self) -> float:
+        """Current time"""
+        return self.now
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """Advance the time"""
+        self.now += timeout
+        return event.is_set()
+
+def acquired(bucket: TokenBucket, timer: FakeTimer, seconds: float,
+             step: float = 0.25) -> int:
+    """Number of tokens taken trying to take one each `step` seconds"""
+    taken = 0
+    for _ in range(int(round(seconds / step))):
+        taken += bucket.try_acquire()
+        timer.sleep(step)
+    return taken
+
+def test_token_bucket_limits_rate():
+    """Check the bucket allows a burst, and then the rate"""
+    timer = FakeTimer()
+    bucket = TokenBucket(2, 5, timer=timer)
+
+    assert [bucket.try_acquire() for _ in range(6)] == [True] * 5 + [False]
+    assert bucket.wait_time() == pytest.approx(0.5)
+    assert 19 <= acquired(bucket, timer, 10) <= 20
+    bucket.drain()
+    assert not bucket.try_acquire()
+
+def test_rate_limiter_aimd():
+    """Check the rate halves on throttling, and grows back additively
+    on success, between the minimum and the maximum"""
+    timer = FakeTimer()
+    limiter = AdaptiveRateLimiter(8, min_rate=1, increase=0.5, timer=timer)
+
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    for expected_rate in [4, 2, 1, 1]:
+        limiter.on_throttling()
+        assert limiter.rate == expected_rate
+    assert not limiter.try_acquire()
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.rate == 3
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.rate == limiter.max_rate == 8
+
+def test_rate_limiter_acquire_waits():
+    """Check acquire waits for a token up to the timeout"""
+    timer = FakeTimer()
+    limiter = AdaptiveRateLimiter(0.5, timer=timer)
+
+    assert limiter.acquire(0)
+    assert not limiter.acquire(1)
+    assert limiter.acquire(2)
+    assert timer.now == pytest.approx(2)
+
+def test_rate_limiter_rejects_invalid_rates():
+    """Check the range of rates is validated"""
+    with pytest.raises(ValueError):
+        AdaptiveRateLimiter(1, min_rate=2)
+    with pytest.raises(ValueError):
+        AdaptiveRateLimiter(1, decrease_factor=1)
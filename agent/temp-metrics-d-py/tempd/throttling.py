@@ -0,0 +1,135 @@
+"""
+Client side rate limiting of the calls to an API with a limit of
+transactions per second shared by many clients, like PutMetricData
+"""
+
+import logging
+import threading
+from typing import Optional
+
+from .types import Timer, TimeTimer
+
+_timer = TimeTimer()
+
+
+class RateLimitExceeded(Exception):
+    """A call was not made because the rate limiter didn't allow it in time"""
+
+
+class TokenBucket:
+    """Allows up to `rate` calls per second on average, and bursts of
+    up to `burst` calls. The bucket starts full"""
+    def __init__(self, rate: float, burst: float, *, timer: Timer = _timer):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate {rate} or burst {burst}")
+        self.__rate = rate
+        self.__burst = burst
+        self.__timer = timer
+        self.__tokens = burst
+        self.__last_time = timer.time()
+        self.__lock = threading.Lock()
+
+    def __refill(self):
+        now = self.__timer.time()
+        self.__tokens = min(self.__burst,
+                            self.__tokens + max(now - self.__last_time, 0) * self.__rate)
+        self.__last_time = now
+
+    @property
+    def rate(self) -> float:
+        """Tokens added per second"""
+        return self.__rate
+
+    @rate.setter
+    def rate(self, rate: float):
+        with self.__lock:
+            self.__refill()
+            self.__rate = rate
+
+    def try_acquire(self) -> bool:
+        """Take a token if there is one, returning whether it was taken"""
+        with self.__lock:
+            self.__refill()
+            if self.__tokens < 1:
+                return False
+            self.__tokens -= 1
+            return True
+
+    def wait_time(self) -> float:
+        """Seconds until there is a token"""
+        with self.__lock:
+            self.__refill()
+            return max(1 - self.__tokens, 0) / self.__rate
+
+    def drain(self):
+        """Discard the tokens"""
+        with self.__lock:
+            self.__refill()
+            self.__tokens = min(self.__tokens, 0)
+
+
+class AdaptiveRateLimiter:
+    """A TokenBucket with a rate that adapts to the throttling errors of the
+    API, with additive increase and multiplicative decrease (AIMD) like
+    TCP congestion control.
+
+    The rate starts at `max_rate` calls per second, the share of the API
+    limit for this client. Each throttled call multiplies the rate by
+    `decrease_factor` and discards the tokens, and each successful call adds
+    `increase` calls per second, by default a tenth of `max_rate`, so the
+    clients that share the limit converge to a rate the API accepts. The
+    rate is always between `min_rate`, by default a 64th of `max_rate`,
+    and `max_rate`
+    """
+    logger = logging.getLogger('AdaptiveRateLimiter')
+
+    def __init__(self, max_rate: float, *, burst: float = 1.0, # pylint: disable=too-many-arguments
+                 min_rate: Optional[float] = None, increase: Optional[float] = None,
+                 decrease_factor: float = 0.5, timer: Timer = _timer):
+        min_rate = min_rate if min_rate is not None else max_rate / 64
+        if not 0 < min_rate <= max_rate or not 0 < decrease_factor < 1:
+            raise ValueError(f"Invalid rate range [{min_rate}, {max_rate}] "
+                             f"or decrease factor {decrease_factor}")
+        self.__max_rate = max_rate
+        self.__min_rate = min_rate
+        self.__increase = increase if increase is not None else max_rate / 10
+        self.__decrease_factor = decrease_factor
+        self.__bucket = TokenBucket(max_rate, max(burst, 1.0), timer=timer)
+        self.__timer = timer
+
+    @property
+    def rate(self) -> float:
+        """Current calls per second allowed"""
+        return self.__bucket.rate
+
+    @property
+    def max_rate(self) -> float:
+        """Calls per second allowed without throttling errors"""
+        return self.__max_rate
+
+    def try_acquire(self) -> bool:
+        """Whether a call can be made now, taking a token if so"""
+        return self.__bucket.try_acquire()
+
+    def acquire(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds until a call can be made, taking
+        a token if so. Returns whether the token was taken"""
+        while not self.__bucket.try_acquire():
+            wait_time = self.__bucket.wait_time()
+            if wait_time > timeout:
+                return False
+            self.__timer.sleep(wait_time)
+            timeout -= wait_time
+        return True
+
+    def on_success(self):
+        """Record a successful call, increasing the rate"""
+        self.__bucket.rate = min(self.__bucket.rate + self.__increase, self.__max_rate)
+
+    def on_throttling(self):
+        """Record a throttled call, decreasing the rate"""
+        rate = max(self.__bucket.rate * self.__decrease_factor, self.__min_rate)
+        self.__class__.logger.warning('Throttled, decreasing the rate from %.3f to %.3f '
+                                      'calls per second', self.__bucket.rate, rate)
+        self.__bucket.rate = rate
+        self.__bucket.drain()
@@ -0,0 +1,155 @@
+"""
+Type declarations for the tempd package
+"""
+import math
+import time
+import threading
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+from typing_extensions import Protocol
+
+@dataclass(frozen=True)
+class TempMeasurement:
+    """A temperature measurement. Measurements are immutable and
+    don't have a `__dict__`, to keep them small
+
+    Args:
+        timestamp (int): timestamp as a unix epoch time
+    """
+    __slots__ = ('source', 'timestamp', 'temperature', 'humidity')
+    source: str
+    timestamp: int
+    temperature: float
+    humidity: float
+
+@dataclass
+class StatisticSet:
+    """Incremental summary of a series of values, that doesn't
+    store the values"""
+    minimum: float = math.inf
+    maximum: float = -math.inf
+    sum: float = 0.0
+    count: int = 0
+
+    def add(self, value: float):
+        """Add a value to the summary"""
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: 'StatisticSet'):
+        """Add the values summarized by another summary"""
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.sum += other.sum
+        self.count += other.count
+
+    @property
+    def average(self) -> float:
+        """Average of the values, that is NaN when there are no values"""
+        return self.sum / self.count if self.count > 0 else math.nan
+
+@dataclass
+class TempStatistics:
+    """Statistics of the measurements of a source on a time window
+
+    Args:
+        timestamp (int): start of the window as a unix epoch time
+    """
+    source: str
+    timestamp: int
+    temperature: StatisticSet = field(default_factory=StatisticSet)
+    humidity: StatisticSet = field(default_factory=StatisticSet)
+
+    def add(self, measurement: TempMeasurement):
+        """Add a measurement of the window"""
+        self.temperature.add(measurement.temperature)
+        self.humidity.add(measurement.humidity)
+
+    def merge(self, other: 'TempStatistics'):
+        """Add the measurements summarized by statistics of
+        the same source on a time window inside this window"""
+        self.temperature.merge(other.temperature)
+        self.humidity.merge(other.humidity)
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Retries of the requests that fail with a throttling or transient
+    error, or a connection error, up to `max_attempts` requests in total.
+    Retries wait a random time up to `base_delay * 2 ** retry` seconds,
+    capped to `max_delay`, like the standard retry mode of boto3. Throttling
+    errors are only retried if `retry_throttling`, e.g. it's disabled when the
+    caller already backs off with a rate limiter"""
+    max_attempts: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 20.0
+    retry_throttling: bool = True
+
+    def delay(self, retry: int, draw: float) -> float:
+        """Seconds to wait before the retry number `retry`, starting with 0,
+        for a uniform random `draw` in [0, 1)"""
+        return draw * min(self.max_delay, self.base_delay * 2.0 ** retry)
+
+class MeasurementRecorder(Protocol): # pylint: disable=too-few-public-methods
+    """A measurement recorder is able to record measurements in some
+    permanent storage"""
+    def record(self, measurement: TempMeasurement):
+        """Records a measurement in some permanent storage"""
+
+    def flush(self):
+        """Records any measurement buffered by this recorder. By default
+        recorders don't buffer, so this does nothing"""
+        return None
+
+class StatisticsRecorder(MeasurementRecorder, Protocol):
+    """A recorder that is also able to record statistics of measurements"""
+    def record_statistics(self, statistics: TempStatistics):
+        """Records statistics in some permanent storage"""
+
+class MeasurementQuery(Protocol):
+    """A store of measurements that can be queried by time range"""
+    def sources(self) -> List[str]:
+        """Sources with some stored measurement"""
+
+    def measurements(self, source: str, start: int, end: int) -> Iterator[TempMeasurement]:
+        """Measurements of a source with timestamp in [start, end), from
+        oldest to newest"""
+
+    def statistics(self, source: str, start: int, end: int,
+                   step: int) -> List[TempStatistics]:
+        """Statistics of the measurements of a source with timestamp in
+        [start, end), for each window of `step` seconds, from oldest to newest.
+        Windows without measurements are skipped"""
+
+class MeasurementFilter(Protocol): # pylint: disable=too-few-public-methods
+    """A measurement filter decides which measurements are recorded,
+    possibly correcting them"""
+    def apply(self, measurement: TempMeasurement) -> Optional[TempMeasurement]:
+        """Returns the measurement to record, or None to discard it"""
+
+class Timer(Protocol):
+    """A timer.
+    This makes the code more testeable, because even if
+    we patch the time module, we don't know how other third modules
+    might be using the time module"""
+    def sleep(self, sleep_time:float):
+        """Block this thread for a number of milliseconds"""
+
+    def time(self) -> float:
+        """Give the current epoch time in milliseconds"""
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """Block this thread until the event is set, or for a number
+        of seconds. Returns whether the event is set"""
+
+class TimeTimer(Timer):
+    """Timer based on time module"""
+    def sleep(self, sleep_time):
+        time.sleep(sleep_time)
+
+    def time(self):
+        return time.time()
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)